@@ -2,4 +2,5 @@ from .completion import router as completion_router
 from .usage import router as usage_router
 from .users import router as users_router
 from .webhooks import router as webhooks_router
-from .stats import router as stats_router
\ No newline at end of file
+from .stats import router as stats_router
+from .metrics import router as metrics_router
\ No newline at end of file
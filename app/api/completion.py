@@ -4,6 +4,7 @@ from typing import Annotated, List
 import sentry_sdk
 from fastapi import Depends, APIRouter, HTTPException
 from sse_starlette.sse import EventSourceResponse
+from starlette.background import BackgroundTask
 from app.depends.llm import get_llm_service
 from app.depends.usage import get_usage_service
 from app.services.rewrite.rewrite_manager import RewriteManager
@@ -23,7 +24,6 @@ logger = structlog.get_logger(__name__)
 @router.post("/v2/rephrase")
 async def rephrase_new(
         request: RephraseRequest,
-        llm_service: LLMServiceBase = Depends(get_llm_service),
         usage_service: BaseFreeTierUsageService = Depends(get_usage_service)
 ):
     is_valid_user_id = True
@@ -34,12 +34,43 @@ async def rephrase_new(
         is_valid_user_id = False
     try:
         rewrite_service = RewriteManager(usage_service=usage_service if is_valid_user_id else None)
-        return EventSourceResponse(rewrite_service.rewrite(request))
+        stream = rewrite_service.rewrite(request)
+        # EventSourceResponse stops iterating the stream when the client disconnects, closing it
+        # afterwards propagates the cancellation down to the upstream LLM stream right away
+        return EventSourceResponse(stream, background=BackgroundTask(stream.aclose))
     except Exception as e:
         logger.error(f"Error in rephrase: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@router.post("/v2/rephrase/batch")
+async def rephrase_batch(
+        requests: List[RephraseRequest],
+        usage_service: BaseFreeTierUsageService = Depends(get_usage_service)
+):
+    if not requests:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(requests) > settings.batch_rewrite_config.max_size:
+        raise HTTPException(status_code=400, detail=f"Batch is limited to {settings.batch_rewrite_config.max_size} requests")
+    if len({request.uid for request in requests}) != 1:
+        raise HTTPException(status_code=400, detail="All requests in a batch must belong to the same user")
+
+    uid = requests[0].uid
+    is_valid_user_id = True
+    try:
+        _ = uuid.UUID(uid)
+    except ValueError as e:
+        sentry_sdk.capture_message(f'Invalid user id - {uid}, {repr(e)}')
+        is_valid_user_id = False
+    try:
+        rewrite_service = RewriteManager(usage_service=usage_service if is_valid_user_id else None)
+        stream = rewrite_service.rewrite_batch(requests)
+        return EventSourceResponse(stream, background=BackgroundTask(stream.aclose))
+    except Exception as e:
+        logger.error(f"Error in batch rephrase: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get("/highlight")
 def highlight(highlighting_service: Annotated[TextHighlightingService, Depends(TextHighlightingService)]) -> List[int]:
     return highlighting_service.create_highlight_list()
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.responses import Response
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    """
+    Prometheus metrics of this worker, not exposed through nginx
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
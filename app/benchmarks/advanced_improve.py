@@ -0,0 +1,126 @@
+"""
+Concurrency benchmark of AdvancedImproveAction, meant to run against the mock LLM server:
+
+    python -m app.mock_llm --port 8901
+    LLM_BASE_URL=http://127.0.0.1:8901/v1 python -m app.benchmarks.advanced_improve --concurrency 200 --engine native
+
+Reports throughput, latency and time to first token of the rewrites, along with the peak number
+of threads and the worst event loop lag seen while they ran. The CPU time and garbage collections
+(a proxy of allocations) per rewrite and the share of the time the process was busy on the CPU
+(the event loop's occupancy, the mock server should run in another process) compare the engines.
+"""
+import argparse
+import asyncio
+import gc
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import aclosing
+from typing import List, Optional, Tuple
+
+from app.models.config import AdvancedImproveEngine, AnalysisCacheConfig
+from app.models.sse import SSEEvent
+from app.services.cache.redis_cache import RedisCacheService
+from app.services.llm.clients import LLMClientPool
+from app.services.rewrite.actions.advanced_improve_writing_action import AdvancedImproveAction
+from app.services.rewrite.analysis_cache import AnalysisCache
+from app.settings import settings
+
+TEXT = "i has went to the store yesterday and buyed some apple, it were realy expensive than i think"
+
+
+class _Monitor:
+    """Samples the thread count and the event loop lag until stopped"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.max_threads = threading.active_count()
+        self.max_loop_lag = 0.
+        self._stopped = False
+
+    async def run(self):
+        while not self._stopped:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.max_loop_lag = max(self.max_loop_lag, time.perf_counter() - started - self.interval)
+            self.max_threads = max(self.max_threads, threading.active_count())
+
+    def stop(self):
+        self._stopped = True
+
+
+async def _rewrite(action: AdvancedImproveAction, semaphore: asyncio.Semaphore) -> Tuple[float, Optional[float], bool]:
+    """Latency, time to first token and whether the rewrite succeeded"""
+    async with semaphore:
+        started = time.perf_counter()
+        first_token = None
+        try:
+            async with aclosing(action.perform(TEXT, None, locale="en_US")) as events:
+                async for event, _ in events:
+                    if event == SSEEvent.DATA and first_token is None:
+                        first_token = time.perf_counter() - started
+        except Exception:
+            return time.perf_counter() - started, first_token, False
+        return time.perf_counter() - started, first_token, True
+
+
+def _quantile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+async def run(requests: int, concurrency: int, engine: AdvancedImproveEngine, trace_allocations: bool = False):
+    settings.advanced_improve_engine = engine
+    # every rewrite runs all the steps
+    action = AdvancedImproveAction(
+        analysis_cache=AnalysisCache(RedisCacheService(), AnalysisCacheConfig(enabled=False))
+    )
+    # opens the pooled connections, so the first requests don't pay for it
+    await _rewrite(action, asyncio.Semaphore(1))
+
+    monitor = _Monitor()
+    monitor_task = asyncio.create_task(monitor.run())
+    semaphore = asyncio.Semaphore(concurrency)
+    if trace_allocations:
+        tracemalloc.start()
+    gc_collections = gc.get_stats()[0]["collections"]
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_rewrite(action, semaphore) for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    cpu_time = time.process_time() - cpu_started
+    gc_collections = gc.get_stats()[0]["collections"] - gc_collections
+    peak_memory = tracemalloc.get_traced_memory()[1] if trace_allocations else None
+    tracemalloc.stop()
+    monitor.stop()
+    await monitor_task
+    await LLMClientPool().close()
+
+    latencies = [latency for latency, _, ok in results if ok]
+    ttfts = [ttft for _, ttft, ok in results if ok and ttft is not None]
+    print(f"requests:        {requests} ({len(latencies)} succeeded), concurrency {concurrency}, engine {engine.value}")
+    print(f"throughput:      {len(latencies) / elapsed:.1f} rewrites/s over {elapsed:.2f}s")
+    print(f"latency:         p50 {_quantile(latencies, 0.5):.3f}s, p95 {_quantile(latencies, 0.95):.3f}s, "
+          f"mean {statistics.fmean(latencies) if latencies else float('nan'):.3f}s")
+    print(f"first token:     p50 {_quantile(ttfts, 0.5):.3f}s, p95 {_quantile(ttfts, 0.95):.3f}s")
+    print(f"cpu per rewrite: {cpu_time / requests * 1000:.1f}ms, loop busy {cpu_time / elapsed:.0%}")
+    print(f"gc per rewrite:  {gc_collections / requests:.1f} gen0 collections")
+    if peak_memory is not None:
+        print(f"peak memory:     {peak_memory / 2 ** 20:.1f}MiB traced")
+    print(f"peak threads:    {monitor.max_threads}")
+    print(f"max loop lag:    {monitor.max_loop_lag * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrency benchmark of the advanced improve chain")
+    parser.add_argument("--requests", type=int, default=500, help="Rewrites to run")
+    parser.add_argument("--concurrency", type=int, default=200, help="Rewrites in flight at once")
+    parser.add_argument("--engine", type=AdvancedImproveEngine, default=AdvancedImproveEngine.NATIVE,
+                        choices=list(AdvancedImproveEngine), help="Engine running the steps")
+    parser.add_argument("--trace-allocations", action="store_true",
+                        help="Report the peak of traced memory, slows everything down")
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.concurrency, args.engine, args.trace_allocations))
@@ -1,11 +1,46 @@
+import hashlib
+from functools import lru_cache
+from typing import List
+
+from app.models.config import LLMBackendConfig
 from app.services.llm.anthropic_service import AnthropicService
 from app.services.llm.llm_service import LLMServiceBase
 from app.services.llm.openai_service import AsyncOpenAIService
+from app.services.llm.router import LLMBackend, LLMRouter
 from app.settings import settings, LLMProvider
 
 
+def get_llm_backend_configs() -> List[LLMBackendConfig]:
+    if settings.llm_backends:
+        return settings.llm_backends
+    return [LLMBackendConfig(
+        provider=settings.llm_provider,
+        api_key=settings.llm_api_key,
+        model=settings.llm_model,
+        base_url=settings.llm_base_url
+    )]
+
+
+@lru_cache(maxsize=None)
+def get_llm_models_version() -> str:
+    """
+    Hash of the models the router may serve a request from, so cached results are invalidated when the
+    backend mix changes instead of being keyed on a single model that may not have produced them
+    """
+    models = sorted({f"{config.provider.value}/{config.model}" for config in get_llm_backend_configs()})
+    return hashlib.sha256("|".join(models).encode()).hexdigest()[:12]
+
+
+def _create_backend(index: int, config: LLMBackendConfig) -> LLMBackend:
+    service_class = AnthropicService if config.provider == LLMProvider.ANTHROPIC else AsyncOpenAIService
+    name = config.name or f"{config.provider.value}/{config.model}#{index}"
+    return LLMBackend(
+        name=name,
+        service=service_class(api_key=config.api_key, model=config.model, base_url=config.base_url, name=name)
+    )
+
+
+@lru_cache(maxsize=None)
 def get_llm_service() -> LLMServiceBase:
-    if settings.llm_provider == LLMProvider.ANTHROPIC:
-        return AnthropicService()
-    else:
-        return AsyncOpenAIService()
+    """Router over the configured backends shared by all requests, SDK clients come from the LLMClientPool"""
+    return LLMRouter([_create_backend(index, config) for index, config in enumerate(get_llm_backend_configs())])
@@ -3,11 +3,16 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from app.api import completion_router, stats_router, users_router, webhooks_router
+from app.api import completion_router, stats_router, users_router, webhooks_router, metrics_router
 import sentry_sdk
 
+from app.depends.llm import get_llm_backend_configs
+from app.depends.usage import get_usage_service
 from app.services.cache.redis_cache import RedisCacheService
 from app.services.db.supabase import SupabaseConnectionService
+from app.services.llm.clients import LLMClientPool
+from app.services.usage.free_tier_usage.user_state_cache import UserStateCache
+from app.services.usage.free_tier_usage.write_behind import UsageWriteBehindQueue
 from app.settings import settings
 
 if not settings.debug:
@@ -28,8 +33,18 @@ async def lifespan(app: FastAPI):
     try:
         await RedisCacheService().connect()
         await SupabaseConnectionService().connect()
+        for provider, base_url in {(backend.provider, backend.base_url) for backend in get_llm_backend_configs()}:
+            await LLMClientPool().warm(provider, base_url)
+        if settings.usage_write_behind_config.enabled:
+            usage_service = await get_usage_service()
+            await UsageWriteBehindQueue().start(RedisCacheService(), flush=usage_service.flush_usage_batch)
+        if settings.user_state_cache_config.enabled:
+            await UserStateCache().start(RedisCacheService())
         yield
     finally:
+        await UserStateCache().stop()
+        await UsageWriteBehindQueue().stop()
+        await LLMClientPool().close()
         await RedisCacheService().disconnect()
 
 
@@ -47,6 +62,7 @@ app.include_router(completion_router)
 app.include_router(users_router)
 app.include_router(webhooks_router)
 app.include_router(stats_router)
+app.include_router(metrics_router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,18 @@
+import argparse
+
+import uvicorn
+
+from app.mock_llm.server import MockLLMConfig, create_app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Mock OpenAI/Anthropic streaming API, point LLM_BASE_URL (or a backend's base_url) at it"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    for name, field in MockLLMConfig.model_fields.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=field.annotation, default=field.default)
+
+    args = vars(parser.parse_args())
+    host, port = args.pop("host"), args.pop("port")
+    uvicorn.run(create_app(MockLLMConfig(**args)), host=host, port=port, log_level="warning")
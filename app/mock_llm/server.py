@@ -0,0 +1,215 @@
+"""
+Stand-in for the OpenAI chat completions and Anthropic messages APIs, for load tests without network access.
+
+Replies echo the user's text back (the part after "original message:" when the prompt has one), streamed word
+by word after a configurable time to first token. Errors, stalls, dropped streams and rate limiting with the
+providers' headers can be injected. JSON mode requests get a placeholder `AnalyzeOutput`.
+Doesn't import the app settings, so it runs without any configuration.
+"""
+import asyncio
+import datetime
+import json
+import random
+import re
+import time
+import uuid
+from typing import AsyncGenerator, Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+from app.models.actions.advanced_improve import AnalyzeOutput
+
+_token_re = re.compile(r"\s*\S+")
+
+
+class MockLLMConfig(BaseModel):
+    ttft: float = 0.3                   # seconds before the first token
+    ttft_jitter: float = 0.1            # uniformly added on top of ttft
+    tokens_per_second: float = 50
+    error_rate: float = 0               # share of requests answered with 500 before streaming
+    drop_rate: float = 0                # share of streams cut off halfway
+    stall_rate: float = 0               # share of requests whose first token takes stall_seconds
+    stall_seconds: float = 10
+    rate_limit_requests: int = 0        # requests per rate_limit_window, 0 for no limit
+    rate_limit_window: float = 60
+
+
+class _RateLimiter:
+    def __init__(self, config: MockLLMConfig):
+        self.config = config
+        self._window_start = time.monotonic()
+        self._count = 0
+
+    def take(self) -> Tuple[bool, int, float]:
+        """Whether the request is allowed, requests remaining and seconds until the window resets"""
+        now = time.monotonic()
+        if now - self._window_start >= self.config.rate_limit_window:
+            self._window_start, self._count = now, 0
+        reset_in = self._window_start + self.config.rate_limit_window - now
+        if not self.config.rate_limit_requests:
+            return True, 1_000_000, reset_in
+        if self._count >= self.config.rate_limit_requests:
+            return False, 0, reset_in
+        self._count += 1
+        return True, self.config.rate_limit_requests - self._count, reset_in
+
+
+def _reply_text(prompt: str, json_mode: bool) -> str:
+    if json_mode:
+        return json.dumps({field: "mock" for field in AnalyzeOutput.model_fields})
+    marker = "original message:"
+    if marker in prompt:
+        prompt = prompt.rsplit(marker, 1)[1]
+    return prompt.strip() or "Mock reply."
+
+
+def _tokens(text: str, max_tokens: Optional[int]) -> Tuple[List[str], bool]:
+    tokens = _token_re.findall(text)
+    if max_tokens is not None and len(tokens) > max_tokens:
+        return tokens[:max_tokens], True
+    return tokens, False
+
+
+def _openai_rate_limit_headers(remaining: int, reset_in: float) -> Dict[str, str]:
+    return {
+        "x-ratelimit-remaining-requests": str(remaining),
+        "x-ratelimit-reset-requests": f"{reset_in:.3f}s",
+    }
+
+
+def _anthropic_rate_limit_headers(remaining: int, reset_in: float) -> Dict[str, str]:
+    reset_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=reset_in)
+    return {
+        "anthropic-ratelimit-requests-remaining": str(remaining),
+        "anthropic-ratelimit-requests-reset": reset_at.isoformat().replace("+00:00", "Z"),
+    }
+
+
+def _sse(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def create_app(config: Optional[MockLLMConfig] = None) -> FastAPI:
+    config = config or MockLLMConfig()
+    rate_limiter = _RateLimiter(config)
+    app = FastAPI(title="Mock LLM")
+
+    async def stream_tokens(tokens: List[str]) -> AsyncGenerator[Tuple[int, str], None]:
+        stalled = random.random() < config.stall_rate
+        await asyncio.sleep(config.stall_seconds if stalled else config.ttft + random.uniform(0, config.ttft_jitter))
+        drop_at = len(tokens) // 2 if random.random() < config.drop_rate else None
+        for index, token in enumerate(tokens):
+            if index == drop_at:
+                # aborts the response mid-stream, like a dropped upstream connection
+                raise ConnectionResetError("Mock stream dropped")
+            if index:
+                await asyncio.sleep(1 / config.tokens_per_second)
+            yield index, token
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        allowed, remaining, reset_in = rate_limiter.take()
+        headers = _openai_rate_limit_headers(remaining, reset_in)
+        if not allowed:
+            return JSONResponse(
+                {"error": {"message": "Mock rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                status_code=429,
+                headers=headers | {"retry-after": f"{reset_in:.0f}"}
+            )
+        if random.random() < config.error_rate:
+            return JSONResponse({"error": {"message": "Mock server error", "type": "server_error"}}, status_code=500)
+
+        prompt = next((m["content"] for m in reversed(body["messages"]) if m["role"] == "user"), "")
+        json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+        tokens, truncated = _tokens(
+            _reply_text(prompt, json_mode),
+            body.get("max_completion_tokens") or body.get("max_tokens")
+        )
+        finish_reason = "length" if truncated else "stop"
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {"id": completion_id, "created": int(time.time()), "model": body["model"]}
+
+        if not body.get("stream"):
+            await asyncio.sleep(config.ttft + len(tokens) / config.tokens_per_second)
+            return JSONResponse(base | {
+                "object": "chat.completion",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": finish_reason,
+                }],
+                "usage": {"prompt_tokens": len(_token_re.findall(prompt)), "completion_tokens": len(tokens),
+                          "total_tokens": len(_token_re.findall(prompt)) + len(tokens)},
+            }, headers=headers)
+
+        async def events() -> AsyncGenerator[str, None]:
+            chunk = base | {"object": "chat.completion.chunk"}
+            async for index, token in stream_tokens(tokens):
+                delta = {"role": "assistant", "content": token} if index == 0 else {"content": token}
+                yield _sse(chunk | {"choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+            yield _sse(chunk | {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]})
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    @app.post("/v1/messages")
+    async def messages(request: Request):
+        body = await request.json()
+        allowed, remaining, reset_in = rate_limiter.take()
+        headers = _anthropic_rate_limit_headers(remaining, reset_in)
+        if not allowed:
+            return JSONResponse(
+                {"type": "error", "error": {"type": "rate_limit_error", "message": "Mock rate limit reached"}},
+                status_code=429,
+                headers=headers | {"retry-after": f"{reset_in:.0f}"}
+            )
+        if random.random() < config.error_rate:
+            return JSONResponse(
+                {"type": "error", "error": {"type": "api_error", "message": "Mock server error"}},
+                status_code=500
+            )
+
+        user_messages = [m["content"] for m in body["messages"] if m["role"] == "user"]
+        prompt = user_messages[-1] if user_messages else ""
+        if isinstance(prompt, list):
+            prompt = "".join(block.get("text", "") for block in prompt)
+        tokens, truncated = _tokens(_reply_text(prompt, json_mode=False), body.get("max_tokens"))
+        stop_reason = "max_tokens" if truncated else "end_turn"
+        message = {
+            "id": f"msg_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": body["model"],
+            "stop_sequence": None,
+        }
+        input_tokens = len(_token_re.findall(prompt))
+
+        if not body.get("stream"):
+            await asyncio.sleep(config.ttft + len(tokens) / config.tokens_per_second)
+            return JSONResponse(message | {
+                "content": [{"type": "text", "text": "".join(tokens)}],
+                "stop_reason": stop_reason,
+                "usage": {"input_tokens": input_tokens, "output_tokens": len(tokens)},
+            }, headers=headers)
+
+        async def events() -> AsyncGenerator[str, None]:
+            yield _sse({"type": "message_start", "message": message | {
+                "content": [], "stop_reason": None, "usage": {"input_tokens": input_tokens, "output_tokens": 0}
+            }}, "message_start")
+            yield _sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                       "content_block_start")
+            async for _, token in stream_tokens(tokens):
+                yield _sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}},
+                           "content_block_delta")
+            yield _sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+            yield _sse({"type": "message_delta", "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+                        "usage": {"output_tokens": len(tokens)}}, "message_delta")
+            yield _sse({"type": "message_stop"}, "message_stop")
+
+        return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+    return app
@@ -1,8 +1,19 @@
 from enum import Enum
+from typing import List, Optional
 
 from pydantic import BaseModel
 
 
+class LLMProvider(str, Enum):
+    OPENAI = "openai"
+    ANTHROPIC = "anthropic"
+
+
+class AdvancedImproveEngine(str, Enum):
+    NATIVE = "native"           # steps run directly on the LLM service
+    LANGCHAIN = "langchain"
+
+
 class DBConfig(BaseModel):
     url: str
     password: str
@@ -25,3 +36,140 @@ class ThrottlingPeriod(str, Enum):
 class ThrottlingConfig(BaseModel):
     limit: int
     period: ThrottlingPeriod
+
+
+class RewriteCacheConfig(BaseModel):
+    enabled: bool = True
+    task_types: List[str] = ["fix_grammar", "concise"]
+    ttl: int = 60 * 60 * 24
+    max_text_length: int = 4000
+    prompt_version: Optional[str] = None    # defaults to a hash of the prompts config
+    models_version: Optional[str] = None    # defaults to a hash of the configured backends' models
+
+
+class AnalysisCacheConfig(BaseModel):
+    enabled: bool = True
+    ttl: int = 60 * 60 * 24
+    max_text_length: int = 4000
+    prompt_version: Optional[str] = None    # defaults to a hash of the analysis prompt
+    models_version: Optional[str] = None    # defaults to a hash of the configured backends' models
+
+
+class AdvancedImproveFastModeConfig(BaseModel):
+    # share of advanced improve rewrites made in a single call, needs the fast_prompt
+    traffic_percentage: float = 0
+    delimiter: str = "###"              # separates the analysis from the final text in the reply
+
+
+class SSEBatchingConfig(BaseModel):
+    enabled: bool = True
+    max_delay_ms: int = 30
+    max_chars: int = 80
+
+
+class LLMSchedulerConfig(BaseModel):
+    max_concurrency: int = 32
+    premium_reserved_slots: int = 8     # slots only premium users can take
+    premium_weight: int = 8
+    free_weight: int = 4
+    throttled_weight: int = 1
+    throttled_delay: float = 5      # seconds an over-quota user waits before being queued
+
+
+class ChunkedRewriteConfig(BaseModel):
+    enabled: bool = True
+    task_types: List[str] = ["fix_grammar", "concise"]
+    min_text_length: int = 2000     # shorter texts are rewritten in a single stream
+    max_chunk_length: int = 1000
+    max_parallel: int = 4           # chunks of a request rewritten at once, each in a scheduler slot of its own
+
+
+class SpellingConfig(BaseModel):
+    enabled: bool = True
+    max_edit_distance: int = 2
+    min_word_count: int = 300_000   # dictionary words rarer than this aren't trusted as they are
+    min_dominance: float = 20   # how many times more frequent the best correction has to be than the runner-up
+    min_typo_length: int = 4    # unknown words shorter than this are left to the LLM
+
+
+class BatchRewriteConfig(BaseModel):
+    max_size: int = 50
+    max_concurrency: int = 8
+
+
+class UsageWriteBehindConfig(BaseModel):
+    enabled: bool = True
+    flush_interval: float = 2
+    max_batch_size: int = 500       # users per bulk write, flush early once this many users have pending updates
+    stale_batch_timeout: float = 60     # batches taken longer ago are written by any worker
+    max_backoff: float = 60             # longest pause after consecutive failed flushes
+
+
+class UserStateCacheConfig(BaseModel):
+    enabled: bool = True
+    max_entries: int = 10000            # per worker, for each of the premium flags and usage counters
+    premium_ttl: float = 60
+    usage_max_staleness: float = 1      # seconds a usage counter may lag behind increments of other workers
+    channel: str = "users:invalidate"   # Redis pub/sub channel of the invalidations
+    retry_delay: float = 1              # before re-subscribing after the channel failed
+
+
+class LLMClientConfig(BaseModel):
+    http2: bool = True
+    max_connections: int = 100      # per provider
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60
+    connect_timeout: float = 5
+    timeout: float = 60
+    warm_connections: int = 2       # opened on startup, so the first requests skip the TLS handshake
+
+
+class LLMBackendConfig(BaseModel):
+    provider: LLMProvider
+    api_key: str
+    model: str
+    base_url: Optional[str] = None      # provider default if not set
+    name: Optional[str] = None          # used in logs and metrics, defaults to provider/model#index
+
+
+class LLMRouterConfig(BaseModel):
+    ewma_alpha: float = 0.2             # weight of the latest sample in the TTFT and error rate averages
+    error_penalty: float = 10           # seconds added to a backend's score per unit of error rate
+    degraded_error_rate: float = 0.5    # backends above this error rate are drained
+    degraded_cooldown: float = 30       # seconds before a drained backend gets traffic again
+    explore_ratio: float = 0.05         # share of calls sent to a random healthy backend to keep its stats fresh
+    max_attempts: int = 2               # backends tried for a call that fails before its first token
+    hedge_enabled: bool = True
+    hedge_same_backend: bool = True     # hedge on the late backend itself when no other candidate is left
+    hedge_delay: Optional[float] = None  # fixed first token deadline before hedging, rolling quantile if not set
+    hedge_quantile: float = 0.9
+    hedge_min_delay: float = 0.5
+    hedge_default_delay: float = 2      # until a backend has hedge_min_samples TTFT samples
+    hedge_min_samples: int = 20
+    hedge_window: int = 200             # TTFT samples kept per backend
+    hedge_budget_ratio: float = 0.1     # extra prompt tokens spent on hedges, relative to all routed prompt tokens
+    hedge_budget_burst: int = 20000     # prompt tokens the hedge budget can save up
+
+
+class RateLimitConfig(BaseModel):
+    enabled: bool = True
+    max_pacing_delay: float = 2     # calls waiting longer for the key's rate limit go to another backend
+
+
+class LLMResilienceConfig(BaseModel):
+    first_token_timeout: float = 10     # seconds from the request to its first token, connecting included
+    inter_token_timeout: float = 10     # seconds between two tokens
+    max_retries: int = 2                # retries of a call that failed before its first token, router's backends included
+    first_token_deadline: float = 20    # seconds to the first token of a call, across its retries and backends
+    retry_base_delay: float = 0.2
+    retry_max_delay: float = 2
+    max_resumes: int = 1                # continuations of a stream that failed after emitting part of the output
+
+
+class GenerationBudgetConfig(BaseModel):
+    enabled: bool = True
+    min_tokens: int = 64                # floor of the max_tokens budget, short inputs still need some room
+    margin: float = 2                   # budget relative to the expected output length
+    allowance: int = 32                 # tokens added to every budget
+    max_tokens: int = 4096
+    analysis_max_tokens: int = 300      # structured analysis of AdvancedImproveAction, independent of the input
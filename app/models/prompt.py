@@ -1,11 +1,13 @@
 from pydantic import BaseModel as PydanticBaseModel
-from typing import Dict
+from typing import Dict, Optional
 
 
 class AdvancedImprovePrompts(PydanticBaseModel):
     analyze_prompt: str
     rewrite_prompt: str
     humanize_prompt: str
+    # single call fast mode, analysis JSON, then the delimiter, then the final text
+    fast_prompt: Optional[str] = None
 
 
 class PromptsConfig(PydanticBaseModel):
@@ -6,4 +6,5 @@ class SSEEvent(str, Enum):
     EOS = "eos"
     THROTTLE = "throttle"
     ANALYSIS = "analysis"
+    ANALYSIS_PARTIAL = "analysis_partial"
     ERROR = "error"
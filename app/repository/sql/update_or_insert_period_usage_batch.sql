@@ -0,0 +1,49 @@
+-- Bulk version of update_or_insert_period_usage, called by the usage write-behind with the deltas of many users.
+-- Each batch id is applied once: a batch retried after a lost response or a crashed worker is skipped.
+-- Applied ids are kept for 7 days, far longer than a batch waits in Redis for its retry, and deleted by the calls.
+
+create table if not exists period_usage_batches (
+    batch_id text primary key,
+    applied_at timestamptz not null default now()
+);
+
+create index if not exists period_usage_batches_applied_at_idx on period_usage_batches (applied_at);
+
+create or replace function update_or_insert_period_usage_batch(
+    p_batch_id text,
+    p_deltas jsonb,             -- [{"uid": ..., "delta": ...}]
+    p_date timestamp,
+    p_interval_days int
+)
+returns table (
+    user_id users.id%type,
+    usage period_usage.usage%type,
+    time_to period_usage.time_to%type
+)
+language plpgsql
+as $$
+declare
+    v_delta jsonb;
+    v_uid users.id%type;
+begin
+    -- concurrent calls with the same id wait for the first one to commit, then find its row
+    insert into period_usage_batches (batch_id) values (p_batch_id) on conflict do nothing;
+    if not found then
+        return;
+    end if;
+
+    delete from period_usage_batches where applied_at < now() - interval '7 days';
+
+    for v_delta in select * from jsonb_array_elements(p_deltas) loop
+        v_uid := v_delta ->> 'uid';
+        return query
+            select v_uid, u.usage, u.time_to
+            from update_or_insert_period_usage(
+                p_uid => v_uid,
+                p_date => p_date,
+                p_delta => (v_delta ->> 'delta')::int,
+                p_interval_days => p_interval_days
+            ) u;
+    end loop;
+end;
+$$;
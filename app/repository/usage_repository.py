@@ -0,0 +1,48 @@
+import datetime
+from typing import Dict, Tuple
+
+import structlog
+from supabase import AsyncClient
+
+from app.settings import settings
+
+logger = structlog.getLogger(__name__)
+
+
+class UsageRepository:
+    table_name = "period_usage"
+
+    def __init__(self, db: AsyncClient):
+        self.db = db
+
+    async def update_or_insert_period_usage(self, user_id: str, usage_delta: int) -> Tuple[int, datetime.datetime]:
+        resp = await self.db.rpc("update_or_insert_period_usage", {
+            "p_uid": user_id,
+            "p_date": datetime.datetime.now().isoformat(),
+            "p_delta": usage_delta,
+            "p_interval_days": settings.throttling_config.period.days,
+        }).execute()
+        if not resp.data:
+            raise ValueError("Failed to update user usage")
+        usage = resp.data[0]
+        return usage.get("usage", 0), datetime.datetime.fromisoformat(usage.get("time_to"))
+
+    async def update_or_insert_period_usage_batch(
+            self,
+            batch_id: str,
+            usage_deltas: Dict[str, int]
+    ) -> Dict[str, Tuple[int, datetime.datetime]]:
+        """
+        Applies the deltas of many users in one transaction, see sql/update_or_insert_period_usage_batch.sql.
+        A batch id that was already applied is skipped, nothing is returned for it then.
+        """
+        resp = await self.db.rpc("update_or_insert_period_usage_batch", {
+            "p_batch_id": batch_id,
+            "p_deltas": [{"uid": user_id, "delta": usage_delta} for user_id, usage_delta in usage_deltas.items()],
+            "p_date": datetime.datetime.now().isoformat(),
+            "p_interval_days": settings.throttling_config.period.days,
+        }).execute()
+        return {
+            usage["user_id"]: (usage.get("usage", 0), datetime.datetime.fromisoformat(usage.get("time_to")))
+            for usage in resp.data or []
+        }
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 from app.utils.singleton import AbstractSingleton
 
@@ -26,4 +27,27 @@ class BaseCacheService(ABC, metaclass=AbstractSingleton):
 
     @abstractmethod
     async def exists(self, key: str):
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def set_many(self, items: Dict[str, Tuple[Any, Optional[int]]]):
+        """Sets the keys to their (value, ttl) in a single round trip"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def run_script(self, script: str, keys: List[str], args: List[Any]):
+        """Runs a Lua script on the cache server, atomically and in a single round trip"""
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def hgetall(self, key: str) -> Dict[bytes, bytes]:
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str):
+        raise NotImplementedError()
+
+    @abstractmethod
+    async def subscribe(self, channel: str) -> AsyncIterator[bytes]:
+        """Subscribes to the channel, returns the iterator of its messages published from then on"""
+        raise NotImplementedError()
@@ -0,0 +1,67 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+local_cache_requests = Counter(
+    "local_cache_requests_total",
+    "Lookups in in-process caches, by result",
+    ["cache", "result"]
+)
+local_cache_evictions = Counter(
+    "local_cache_evictions_total",
+    "Entries dropped from in-process caches before they expired",
+    ["cache", "reason"]
+)
+local_cache_entries = Gauge(
+    "local_cache_entries",
+    "Entries held by in-process caches",
+    ["cache"]
+)
+
+
+class LocalTTLCache:
+    """
+    In-process cache holding at most `max_entries`, each for its own TTL.
+    The least recently used entry is evicted when it's full, expired entries are dropped when they're looked up.
+    """
+
+    def __init__(self, name: str, max_entries: int):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            local_cache_requests.labels(cache=self.name, result="miss").inc()
+            return None
+        self._entries.move_to_end(key)
+        local_cache_requests.labels(cache=self.name, result="hit").inc()
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            local_cache_evictions.labels(cache=self.name, reason="capacity").inc()
+        local_cache_entries.labels(cache=self.name).set(len(self._entries))
+
+    def delete(self, key: str) -> bool:
+        if self._entries.pop(key, None) is None:
+            return False
+        local_cache_evictions.labels(cache=self.name, reason="invalidated").inc()
+        local_cache_entries.labels(cache=self.name).set(len(self._entries))
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        local_cache_entries.labels(cache=self.name).set(0)
@@ -1,4 +1,4 @@
-from typing import Any, Optional
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
 
 import redis.asyncio as redis
 from app.services.cache.base import BaseCacheService
@@ -81,6 +81,68 @@ class RedisCacheService(BaseCacheService):
             print(f"Error getting TTL for key {key}: {e}")
             return -1
 
+    async def set_many(self, items: Dict[str, Tuple[Any, Optional[int]]]) -> bool:
+        if not self.redis:
+            raise RuntimeError("Redis connection not established")
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for key, (value, ttl) in items.items():
+                pipeline.set(key, value, ex=ttl)
+            await pipeline.execute()
+            return True
+        except Exception as e:
+            print(f"Error setting values for keys {list(items)}: {e}")
+            return False
+
+    async def run_script(self, script: str, keys: List[str], args: List[Any]) -> Any:
+        if not self.redis:
+            raise RuntimeError("Redis connection not established")
+        try:
+            # called by its SHA, the script is only sent when the server doesn't know it yet
+            return await self.redis.register_script(script)(keys=keys, args=args)
+        except Exception as e:
+            print(f"Error running script on keys {keys}: {e}")
+            return None
+
+    async def hgetall(self, key: str) -> Dict[bytes, bytes]:
+        if not self.redis:
+            raise RuntimeError("Redis connection not established")
+        try:
+            return await self.redis.hgetall(key)
+        except Exception as e:
+            print(f"Error getting hash {key}: {e}")
+            return {}
+
+    async def publish(self, channel: str, message: str) -> bool:
+        if not self.redis:
+            raise RuntimeError("Redis connection not established")
+        try:
+            await self.redis.publish(channel, message)
+            return True
+        except Exception as e:
+            print(f"Error publishing to channel {channel}: {e}")
+            return False
+
+    async def subscribe(self, channel: str) -> AsyncGenerator[bytes, None]:
+        # errors are raised, the subscriber can't tell a quiet channel from a lost one otherwise
+        if not self.redis:
+            raise RuntimeError("Redis connection not established")
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(channel)
+        except Exception:
+            await pubsub.aclose()
+            raise
+        return self._listen(pubsub)
+
+    @staticmethod
+    async def _listen(pubsub: redis.client.PubSub) -> AsyncGenerator[bytes, None]:
+        try:
+            async for message in pubsub.listen():
+                yield message["data"]
+        finally:
+            await pubsub.aclose()
+
     async def exists(self, key: str) -> bool:
         if not self.redis:
             raise RuntimeError("Redis connection not established")
@@ -1,15 +1,36 @@
-from typing import List, AsyncGenerator
+from contextlib import aclosing
+from typing import List, AsyncGenerator, Optional
+import anthropic
 from anthropic import AsyncAnthropic
 import structlog
-from app.models.message import BaseChatMessage, SystemMessage
-from app.settings import settings
-from .llm_service import LLMServiceBase
+from app.models.message import AssistantMessage, BaseChatMessage, SystemMessage
+from app.settings import LLMProvider, settings
+from app.services.llm.clients import LLMClientPool
+from app.services.llm.rate_limits import RateLimitTracker, estimate_request_tokens
+from app.services.llm.resilience import StreamTimeout, resilient_stream
+from app.utils.stage_timer import StageTimer
+from .llm_service import LLMServiceBase, record_completion
 
 logger = structlog.get_logger(__name__)
 
+DEFAULT_MAX_TOKENS = 1024   # the messages API requires a budget, used when the caller has none
+
 class AnthropicService(LLMServiceBase):
-    def __init__(self):
-        self.client = AsyncAnthropic(api_key=settings.llm_api_key)
+    def __init__(
+            self,
+            api_key: Optional[str] = None,
+            model: Optional[str] = None,
+            base_url: Optional[str] = None,
+            name: Optional[str] = None
+    ):
+        self.api_key = api_key or settings.llm_api_key
+        self.base_url = base_url
+        self.model = model or settings.llm_model
+        self.name = name or f"{LLMProvider.ANTHROPIC.value}/{self.model}"
+
+    @property
+    def client(self) -> AsyncAnthropic:
+        return LLMClientPool().anthropic(self.api_key, self.base_url)
 
     def _prepare_messages(self, messages: List[BaseChatMessage]):
         system_message = next((m for m in messages if isinstance(m, SystemMessage)), None)
@@ -20,29 +41,90 @@ class AnthropicService(LLMServiceBase):
             "messages": [{"role": m.role, "content": m.content} for m in other_messages]
         }
 
+    async def _create(self, messages: List[BaseChatMessage], **kwargs):
+        """Creates the message within the key's rate limit budget, refreshed from the response headers"""
+        max_tokens = kwargs.pop("max_tokens", None) or DEFAULT_MAX_TOKENS
+        # no JSON mode, the prompt has to ask for JSON
+        kwargs.pop("json_mode", None)
+        rate_limits = RateLimitTracker()
+        await rate_limits.acquire(
+            self.name,
+            estimate_request_tokens("".join(m.content for m in messages), max_tokens)
+        )
+        try:
+            response = await self.client.messages.with_raw_response.create(
+                model=self.model,
+                **self._prepare_messages(messages),
+                max_tokens=max_tokens,
+                **kwargs
+            )
+        except anthropic.APIStatusError as e:
+            rate_limits.update(self.name, LLMProvider.ANTHROPIC, e.response.headers)
+            raise
+        rate_limits.update(self.name, LLMProvider.ANTHROPIC, response.headers)
+        return response.parse()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        return isinstance(error, (StreamTimeout, anthropic.APIConnectionError, anthropic.InternalServerError))
+
+    @staticmethod
+    def _resume_messages(messages: List[BaseChatMessage], partial: str) -> List[BaseChatMessage]:
+        # prefilled assistant turn is continued by the model, it can't end with whitespace
+        prefill = partial.rstrip()
+        if not prefill:
+            return messages
+        return [*messages, AssistantMessage(content=prefill)]
+
     async def generate_stream(self, messages: List[BaseChatMessage], **kwargs) -> AsyncGenerator[str, None]:
-        prepared_messages = self._prepare_messages(messages)
-        stream = await self.client.messages.create(
-            model=settings.llm_model,
-            **prepared_messages,
-            max_tokens=1024,
-            stream=True,
-            **kwargs
+        max_tokens = kwargs.pop("max_tokens", None) or DEFAULT_MAX_TOKENS
+        budget = kwargs.pop("attempt_budget", None)
+        stream = resilient_stream(
+            lambda partial, tokens_left: self._stream(self._resume_messages(messages, partial), tokens_left, **kwargs),
+            is_retryable=self._is_retryable,
+            name=self.name,
+            max_tokens=max_tokens,
+            budget=budget
         )
-        async for event in stream:
-            if event.type == "content_block_start":
-                continue
-            elif event.type == "content_block_delta":
-                yield event.delta.text
-            elif event.type == "message_stop":
-                break
+        async with aclosing(stream):
+            async for token in stream:
+                yield token
 
-    async def generate(self, messages: List[BaseChatMessage], **kwargs) -> str:
-        prepared_messages = self._prepare_messages(messages)
-        response = await self.client.messages.create(
-            model=settings.llm_model,
-            **prepared_messages,
-            max_tokens=1024,
+    async def _stream(
+            self,
+            messages: List[BaseChatMessage],
+            max_tokens: Optional[int] = None,
             **kwargs
+    ) -> AsyncGenerator[str, None]:
+        if max_tokens is not None:
+            kwargs["max_tokens"] = max_tokens
+        stream = await self._create(messages, stream=True, **kwargs)
+        timer = StageTimer.current()
+        if timer:
+            timer.mark_connected(provider=LLMProvider.ANTHROPIC.value)
+        try:
+            async for event in stream:
+                if event.type == "content_block_start":
+                    continue
+                elif event.type == "content_block_delta":
+                    yield event.delta.text
+                elif event.type == "message_delta":
+                    record_completion(
+                        self.name,
+                        event.delta.stop_reason == "max_tokens",
+                        kwargs.get("max_tokens") or DEFAULT_MAX_TOKENS
+                    )
+                elif event.type == "message_stop":
+                    break
+        finally:
+            # releases the upstream connection when the consumer stops early (e.g. client disconnected)
+            await stream.close()
+
+    async def generate(self, messages: List[BaseChatMessage], **kwargs) -> str:
+        response = await self._create(messages, **kwargs)
+        record_completion(
+            self.name,
+            response.stop_reason == "max_tokens",
+            kwargs.get("max_tokens") or DEFAULT_MAX_TOKENS
         )
         return response.content[0].text
\ No newline at end of file
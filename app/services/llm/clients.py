@@ -0,0 +1,102 @@
+import asyncio
+from typing import Dict, Optional, Tuple
+
+import httpx
+import openai
+import structlog
+from anthropic import AsyncAnthropic
+
+from app.models.config import LLMClientConfig
+from app.settings import LLMProvider, settings
+from app.utils.singleton import Singleton
+
+logger = structlog.get_logger(__name__)
+
+
+class LLMClientPool(metaclass=Singleton):
+    """
+    Provider SDK clients shared by all requests of the worker, each with its own keep-alive connection pool.
+
+    SDK clients (one per API key and base URL) of a provider share its connection pool. Clients are created
+    on first use and re-created after `close`, the lifespan warms the pools on startup and closes them on shutdown.
+    """
+
+    def __init__(self, config: Optional[LLMClientConfig] = None):
+        self.config = config or settings.llm_client_config
+        self._http_clients: Dict[LLMProvider, httpx.AsyncClient] = {}
+        self._sync_http_clients: Dict[LLMProvider, httpx.Client] = {}
+        self._openai: Dict[Tuple[str, Optional[str]], openai.AsyncClient] = {}
+        self._anthropic: Dict[Tuple[str, Optional[str]], AsyncAnthropic] = {}
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.config.timeout, connect=self.config.connect_timeout)
+
+    def http_client(self, provider: LLMProvider) -> httpx.AsyncClient:
+        client = self._http_clients.get(provider)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(http2=self.config.http2, limits=self._limits(), timeout=self._timeout())
+            self._http_clients[provider] = client
+        return client
+
+    def sync_http_client(self, provider: LLMProvider) -> httpx.Client:
+        """Blocking client for SDK calls made from worker threads (LangChain `invoke`)"""
+        client = self._sync_http_clients.get(provider)
+        if client is None or client.is_closed:
+            client = httpx.Client(http2=self.config.http2, limits=self._limits(), timeout=self._timeout())
+            self._sync_http_clients[provider] = client
+        return client
+
+    def openai(self, api_key: Optional[str] = None, base_url: Optional[str] = None) -> openai.AsyncClient:
+        key = (api_key or settings.llm_api_key, base_url)
+        if key not in self._openai:
+            self._openai[key] = openai.AsyncClient(
+                api_key=key[0],
+                base_url=base_url,
+                http_client=self.http_client(LLMProvider.OPENAI),
+                # retried by the services within their deadlines, see resilient_stream
+                max_retries=0
+            )
+        return self._openai[key]
+
+    def anthropic(self, api_key: Optional[str] = None, base_url: Optional[str] = None) -> AsyncAnthropic:
+        key = (api_key or settings.llm_api_key, base_url)
+        if key not in self._anthropic:
+            self._anthropic[key] = AsyncAnthropic(
+                api_key=key[0],
+                base_url=base_url,
+                http_client=self.http_client(LLMProvider.ANTHROPIC),
+                # retried by the services within their deadlines, see resilient_stream
+                max_retries=0
+            )
+        return self._anthropic[key]
+
+    async def warm(self, provider: LLMProvider, base_url: Optional[str] = None):
+        """Opens keep-alive connections to the provider API, the response itself doesn't matter"""
+        sdk_client = self.openai(base_url=base_url) if provider == LLMProvider.OPENAI else self.anthropic(base_url=base_url)
+        http_client = self.http_client(provider)
+        results = await asyncio.gather(
+            *(http_client.head(str(sdk_client.base_url)) for _ in range(self.config.warm_connections)),
+            return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, Exception)]
+        if errors:
+            logger.warning("Failed to warm LLM client", provider=provider.value, error=str(errors[0]))
+        else:
+            logger.info("LLM client warmed", provider=provider.value, connections=len(results))
+
+    async def close(self):
+        for client in self._http_clients.values():
+            await client.aclose()
+        for sync_client in self._sync_http_clients.values():
+            sync_client.close()
+        self._http_clients.clear()
+        self._sync_http_clients.clear()
+        self._openai.clear()
+        self._anthropic.clear()
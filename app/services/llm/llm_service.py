@@ -1,12 +1,50 @@
 from abc import ABC, abstractmethod
-from typing import AsyncGenerator, List, Dict
+from typing import AsyncGenerator, List, Dict, Optional
+
+import structlog
+from prometheus_client import Counter
+
 from app.models.message import BaseChatMessage
+from app.utils.stage_timer import StageTimer
+
+logger = structlog.get_logger(__name__)
+
+completions = Counter(
+    "llm_completions_total",
+    "Completed LLM calls, truncated ones ran out of their max_tokens budget",
+    ["backend", "truncated"]
+)
+
+
+class CompletionTruncated(Exception):
+    """The completion ran out of its max_tokens budget, what was generated is incomplete"""
+
+
+def record_completion(backend: str, truncated: bool, max_tokens: Optional[int]):
+    """Counts the finished completion, raises CompletionTruncated if it was cut by max_tokens"""
+    completions.labels(backend=backend, truncated=str(truncated).lower()).inc()
+    if truncated:
+        timer = StageTimer.current()
+        logger.warning(
+            "LLM completion truncated by max_tokens",
+            backend=backend,
+            max_tokens=max_tokens,
+            task_type=timer.task_type if timer else None
+        )
+        raise CompletionTruncated(f"Completion of {backend} truncated at {max_tokens} tokens")
+
 
 class LLMServiceBase(ABC):
+    """
+    Keyword arguments of the calls are passed to the provider API (temperature, max_tokens...),
+    besides `json_mode`, which asks for a JSON object reply where the provider supports it,
+    and `attempt_budget`, the AttemptBudget a stream's retries share with the caller's (see LLMRouter).
+    """
+
     @abstractmethod
     async def generate_stream(self, messages: List[BaseChatMessage], **kwargs) -> AsyncGenerator[str, None]:
         pass
 
     @abstractmethod
     async def generate(self, messages: List[BaseChatMessage], **kwargs) -> str:
-        pass
\ No newline at end of file
+        pass
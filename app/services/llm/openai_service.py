@@ -1,41 +1,110 @@
-from typing import List, AsyncGenerator
+from contextlib import aclosing
+from typing import List, AsyncGenerator, Optional
 
 import openai
 import structlog
 
-from app.models.message import BaseChatMessage
-from app.settings import settings
-from app.services.llm.llm_service import LLMServiceBase
+from app.models.message import AssistantMessage, BaseChatMessage, UserMessage
+from app.settings import LLMProvider, settings
+from app.services.llm.clients import LLMClientPool
+from app.services.llm.llm_service import LLMServiceBase, record_completion
+from app.services.llm.rate_limits import RateLimitTracker, estimate_request_tokens
+from app.services.llm.resilience import RESUME_PROMPT, StreamTimeout, resilient_stream
+from app.utils.stage_timer import StageTimer
 
 logger = structlog.get_logger(__name__)
 
 
 class AsyncOpenAIService(LLMServiceBase):
-    def __init__(self):
-        self.client = openai.AsyncClient(api_key=settings.llm_api_key)
-        self.base_url = "https://api.openai.com/v1"
-        self.model = settings.llm_model
+    def __init__(
+            self,
+            api_key: Optional[str] = None,
+            model: Optional[str] = None,
+            base_url: Optional[str] = None,
+            name: Optional[str] = None
+    ):
+        self.api_key = api_key or settings.llm_api_key
+        self.base_url = base_url or "https://api.openai.com/v1"
+        self.model = model or settings.llm_model
+        self.name = name or f"{LLMProvider.OPENAI.value}/{self.model}"
+
+    @property
+    def client(self) -> openai.AsyncClient:
+        return LLMClientPool().openai(self.api_key, self.base_url)
+
+    async def _create(self, messages: List[BaseChatMessage], **kwargs):
+        """Creates the completion within the key's rate limit budget, refreshed from the response headers"""
+        if kwargs.pop("json_mode", False):
+            kwargs["response_format"] = {"type": "json_object"}
+        rate_limits = RateLimitTracker()
+        await rate_limits.acquire(
+            self.name,
+            estimate_request_tokens("".join(m.content for m in messages), kwargs.get("max_tokens"))
+        )
+        try:
+            response = await self.client.chat.completions.with_raw_response.create(
+                model=self.model,
+                messages=[m.model_dump() for m in messages],
+                n=1,
+                **kwargs
+            )
+        except openai.APIStatusError as e:
+            rate_limits.update(self.name, LLMProvider.OPENAI, e.response.headers)
+            raise
+        rate_limits.update(self.name, LLMProvider.OPENAI, response.headers)
+        return response.parse()
+
+    @staticmethod
+    def _is_retryable(error: Exception) -> bool:
+        return isinstance(error, (StreamTimeout, openai.APIConnectionError, openai.InternalServerError))
+
+    @staticmethod
+    def _resume_messages(messages: List[BaseChatMessage], partial: str) -> List[BaseChatMessage]:
+        if not partial:
+            return messages
+        return [*messages, AssistantMessage(content=partial), UserMessage(content=RESUME_PROMPT)]
 
     async def generate_stream(self, messages: List[BaseChatMessage], **kwargs) -> AsyncGenerator[str, None]:
-        response_gen = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[m.model_dump() for m in messages],
-            stream=True,
-            n=1,
-            **kwargs
+        max_tokens = kwargs.pop("max_tokens", None)
+        budget = kwargs.pop("attempt_budget", None)
+        stream = resilient_stream(
+            lambda partial, tokens_left: self._stream(self._resume_messages(messages, partial), tokens_left, **kwargs),
+            is_retryable=self._is_retryable,
+            name=self.name,
+            max_tokens=max_tokens,
+            budget=budget
         )
-        async for response in response_gen:
-            if not response.choices:
-                continue
-            completion_delta = response.choices[0].delta.content
-            if completion_delta:
-                yield completion_delta
+        async with aclosing(stream):
+            async for token in stream:
+                yield token
 
-    async def generate(self, messages: List[BaseChatMessage], **kwargs) -> str:
-        response = await self.client.chat.completions.create(
-            model=self.model,
-            messages=[m.model_dump() for m in messages],
-            n=1,
+    async def _stream(
+            self,
+            messages: List[BaseChatMessage],
+            max_tokens: Optional[int] = None,
             **kwargs
-        )
-        return response.choices[0].message.content
+    ) -> AsyncGenerator[str, None]:
+        if max_tokens is not None:
+            kwargs["max_tokens"] = max_tokens
+        response_gen = await self._create(messages, stream=True, **kwargs)
+        timer = StageTimer.current()
+        if timer:
+            timer.mark_connected(provider=LLMProvider.OPENAI.value)
+        try:
+            async for response in response_gen:
+                if not response.choices:
+                    continue
+                choice = response.choices[0]
+                if choice.delta.content:
+                    yield choice.delta.content
+                if choice.finish_reason:
+                    record_completion(self.name, choice.finish_reason == "length", kwargs.get("max_tokens"))
+        finally:
+            # releases the upstream connection when the consumer stops early (e.g. client disconnected)
+            await response_gen.close()
+
+    async def generate(self, messages: List[BaseChatMessage], **kwargs) -> str:
+        response = await self._create(messages, **kwargs)
+        choice = response.choices[0]
+        record_completion(self.name, choice.finish_reason == "length", kwargs.get("max_tokens"))
+        return choice.message.content
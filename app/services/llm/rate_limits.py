@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Mapping, Optional
+
+import structlog
+from prometheus_client import Gauge
+
+from app.models.config import LLMProvider, RateLimitConfig
+from app.settings import settings
+from app.utils.singleton import Singleton
+from app.utils.tokens import estimate_token_count
+
+logger = structlog.get_logger(__name__)
+
+rate_limit_remaining = Gauge(
+    "llm_rate_limit_remaining",
+    "Requests or tokens left in the provider rate limit window of an API key, as last reported and reserved since",
+    ["backend", "kind"]
+)
+rate_limit_reset = Gauge(
+    "llm_rate_limit_reset_timestamp_seconds",
+    "Unix time at which the provider rate limit window of an API key resets",
+    ["backend", "kind"]
+)
+
+_duration_part = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_duration_units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+class RateLimitExhausted(Exception):
+    """The API key's budget won't allow the call within the pacing delay, it should go elsewhere"""
+
+
+def estimate_request_tokens(prompt: str, max_tokens: Optional[int] = None) -> int:
+    """Tokens a call counts against the limit, the completion is assumed as long as the prompt unless capped"""
+    prompt_tokens = estimate_token_count(prompt)
+    return prompt_tokens + (max_tokens or prompt_tokens)
+
+
+def parse_openai_duration(value: str) -> Optional[float]:
+    """Seconds of an OpenAI reset header, e.g. `1s`, `6m0s` or `20ms`"""
+    parts = _duration_part.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _duration_units[unit] for amount, unit in parts)
+
+
+def parse_anthropic_reset(value: str) -> Optional[float]:
+    """Seconds until an Anthropic reset header, which is an RFC 3339 timestamp"""
+    try:
+        reset_at = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max((reset_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds(), 0.)
+
+
+@dataclass
+class _Budget:
+    remaining: Optional[float] = None
+    reset_at: float = 0.        # monotonic time
+
+    def is_current(self) -> bool:
+        return self.remaining is not None and self.reset_at > time.monotonic()
+
+
+@dataclass
+class RateLimitState:
+    requests: _Budget
+    tokens: _Budget
+
+
+class RateLimitTracker(metaclass=Singleton):
+    """
+    Request and token budget of every API key, refreshed from the rate limit headers of each response
+    and reserved locally by calls in flight, so a burst is paced before the provider starts answering 429.
+    """
+
+    def __init__(self, config: Optional[RateLimitConfig] = None):
+        self.config = config or settings.rate_limit_config
+        self._states: Dict[str, RateLimitState] = {}
+
+    def _state(self, key: str) -> RateLimitState:
+        if key not in self._states:
+            self._states[key] = RateLimitState(requests=_Budget(), tokens=_Budget())
+        return self._states[key]
+
+    def _set(self, key: str, kind: str, remaining: Optional[str], reset_in: Optional[float]):
+        if remaining is None or reset_in is None:
+            return
+        try:
+            remaining_value = float(remaining)
+        except ValueError:
+            return
+        budget = getattr(self._state(key), kind)
+        budget.remaining = remaining_value
+        budget.reset_at = time.monotonic() + reset_in
+        rate_limit_remaining.labels(backend=key, kind=kind).set(remaining_value)
+        rate_limit_reset.labels(backend=key, kind=kind).set(time.time() + reset_in)
+
+    def update(self, key: str, provider: LLMProvider, headers: Mapping[str, str]):
+        if provider == LLMProvider.OPENAI:
+            for kind in ("requests", "tokens"):
+                reset = headers.get(f"x-ratelimit-reset-{kind}")
+                self._set(
+                    key, kind,
+                    headers.get(f"x-ratelimit-remaining-{kind}"),
+                    parse_openai_duration(reset) if reset else None
+                )
+        else:
+            for kind in ("requests", "tokens"):
+                reset = headers.get(f"anthropic-ratelimit-{kind}-reset")
+                self._set(
+                    key, kind,
+                    headers.get(f"anthropic-ratelimit-{kind}-remaining"),
+                    parse_anthropic_reset(reset) if reset else None
+                )
+
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            # 429 responses, nothing is left until the provider says so
+            try:
+                self._set(key, "requests", "0", float(retry_after))
+            except ValueError:
+                pass
+
+    def delay(self, key: str, tokens: int) -> float:
+        """Seconds until the key has budget for a call of `tokens` tokens"""
+        state = self._states.get(key)
+        if not self.config.enabled or state is None:
+            return 0.
+        now = time.monotonic()
+        delay = 0.
+        if state.requests.is_current() and state.requests.remaining < 1:
+            delay = max(delay, state.requests.reset_at - now)
+        if state.tokens.is_current() and state.tokens.remaining < tokens:
+            delay = max(delay, state.tokens.reset_at - now)
+        return delay
+
+    def is_limited(self, key: str) -> bool:
+        return self.delay(key, 1) > 0
+
+    def _reserve(self, key: str, tokens: int):
+        state = self._state(key)
+        for kind, amount in (("requests", 1), ("tokens", tokens)):
+            budget: _Budget = getattr(state, kind)
+            if budget.is_current():
+                budget.remaining -= amount
+                rate_limit_remaining.labels(backend=key, kind=kind).set(budget.remaining)
+
+    async def acquire(self, key: str, tokens: int):
+        """Waits until the key has budget for the call, raises RateLimitExhausted if that takes too long"""
+        delay = self.delay(key, tokens)
+        if delay > self.config.max_pacing_delay:
+            raise RateLimitExhausted(f"Rate limit of {key} resets in {delay:.1f}s")
+        if delay > 0:
+            logger.info("Pacing LLM call for the rate limit", backend=key, delay=delay)
+            await asyncio.sleep(delay)
+        self._reserve(key, tokens)
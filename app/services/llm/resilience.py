@@ -0,0 +1,122 @@
+import asyncio
+import random
+import time
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import AsyncGenerator, AsyncIterator, Callable, Optional
+
+import structlog
+from prometheus_client import Counter
+
+from app.models.config import LLMResilienceConfig
+from app.settings import settings
+from app.utils.tokens import estimate_token_count
+
+logger = structlog.get_logger(__name__)
+
+stream_recoveries = Counter(
+    "llm_stream_recoveries_total",
+    "Upstream streams that failed and were retried (nothing emitted yet) or resumed from their partial output",
+    ["backend", "kind"]
+)
+
+RESUME_PROMPT = (
+    "Your previous reply was cut off. Continue it exactly where it stops, "
+    "reply only with the rest of it and don't repeat anything."
+)
+
+
+class StreamTimeout(Exception):
+    """The upstream stream missed its first-token or inter-token deadline"""
+
+
+@dataclass
+class AttemptBudget:
+    """
+    Retries and deadline of a call until its first token, shared by the LLMRouter and the retries of its backends,
+    so a failing call doesn't multiply the retries of every layer. `reserved` retries are kept for the backends
+    the router hasn't tried yet, which are preferred over retrying the same backend.
+    """
+    retries: int
+    deadline: float
+    reserved: int = 0
+
+    @classmethod
+    def from_config(cls, config: Optional[LLMResilienceConfig] = None) -> "AttemptBudget":
+        config = config or settings.llm_resilience_config
+        return cls(retries=config.max_retries, deadline=time.monotonic() + config.first_token_deadline)
+
+    def time_left(self) -> float:
+        return max(self.deadline - time.monotonic(), 0)
+
+    def take(self, reserved: bool = False) -> bool:
+        """Takes a retry if any is left before the deadline, `reserved` ones are only taken by the router"""
+        if self.retries <= (0 if reserved else self.reserved) or not self.time_left():
+            return False
+        self.retries -= 1
+        return True
+
+
+async def resilient_stream(
+        open_stream: Callable[[str, Optional[int]], AsyncIterator[str]],
+        is_retryable: Callable[[Exception], bool],
+        name: str,
+        max_tokens: Optional[int] = None,
+        budget: Optional[AttemptBudget] = None,
+        config: Optional[LLMResilienceConfig] = None
+) -> AsyncGenerator[str, None]:
+    """
+    Streams tokens of `open_stream("", max_tokens)` within the first-token and inter-token deadlines.
+
+    A stream failing with a retryable error before emitting anything is retried with jittered backoff,
+    within the retries and deadline of the call's `budget`.
+    Once part of the output was emitted, a restart would duplicate it downstream, so the stream is instead
+    re-opened with `open_stream(partial_output, max_tokens_left)`, which is expected to continue after the
+    partial output, so the whole reply stays within `max_tokens`.
+    """
+    config = config or settings.llm_resilience_config
+    budget = budget or AttemptBudget.from_config(config)
+    emitted = ""
+    remaining_tokens = max_tokens
+    retries = resumes = 0
+    while True:
+        resuming = bool(emitted)
+        try:
+            async with aclosing(open_stream(emitted, remaining_tokens)) as stream:
+                timeout = config.first_token_timeout if emitted else min(config.first_token_timeout, budget.time_left())
+                while True:
+                    try:
+                        token = await asyncio.wait_for(stream.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        return
+                    except asyncio.TimeoutError:
+                        raise StreamTimeout(f"No token from {name} within {timeout}s")
+                    timeout = config.inter_token_timeout
+                    if resuming:
+                        resuming = False
+                        # whitespace at the cut is often repeated by the continuation
+                        if emitted[-1:].isspace():
+                            token = token.lstrip()
+                    if token:
+                        emitted += token
+                        yield token
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            if not emitted:
+                retries += 1
+                delay = min(config.retry_base_delay * 2 ** (retries - 1), config.retry_max_delay)
+                delay *= random.uniform(0.5, 1)
+                if delay >= budget.time_left() or not budget.take():
+                    raise
+                logger.warning("LLM stream failed, retrying", backend=name, error=str(e), retry=retries, delay=delay)
+                stream_recoveries.labels(backend=name, kind="retry").inc()
+                await asyncio.sleep(delay)
+            else:
+                if max_tokens is not None:
+                    remaining_tokens = max_tokens - estimate_token_count(emitted)
+                if resumes >= config.max_resumes or (remaining_tokens is not None and remaining_tokens < 1):
+                    raise
+                resumes += 1
+                logger.warning("LLM stream failed, resuming", backend=name, error=str(e), emitted=len(emitted))
+                stream_recoveries.labels(backend=name, kind="resume").inc()
@@ -0,0 +1,285 @@
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import aclosing, suppress
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, AsyncIterator, Deque, Dict, List, Optional, Tuple
+
+import sentry_sdk
+import structlog
+from prometheus_client import Counter, Gauge
+
+from app.models.config import LLMRouterConfig
+from app.models.message import BaseChatMessage
+from app.services.llm.llm_service import CompletionTruncated, LLMServiceBase
+from app.services.llm.rate_limits import RateLimitExhausted, RateLimitTracker
+from app.services.llm.resilience import AttemptBudget
+from app.settings import settings
+from app.utils.tokens import estimate_token_count
+
+logger = structlog.get_logger(__name__)
+
+backend_ttft = Gauge(
+    "llm_backend_ttft_ewma_seconds",
+    "Moving average of the time to first token of an LLM backend",
+    ["backend"]
+)
+backend_error_rate = Gauge(
+    "llm_backend_error_rate",
+    "Moving average of the error rate of an LLM backend",
+    ["backend"]
+)
+backend_degraded = Gauge(
+    "llm_backend_degraded",
+    "Whether an LLM backend is drained because of its error rate",
+    ["backend"]
+)
+router_calls = Counter(
+    "llm_router_calls_total",
+    "LLM calls routed to a backend, by result",
+    ["backend", "result"]
+)
+hedges = Counter(
+    "llm_router_hedges_total",
+    "Streams whose first token was late, by what happened to the hedge",
+    ["result"]
+)
+hedge_budget = Gauge(
+    "llm_router_hedge_budget_tokens",
+    "Prompt tokens currently available for hedged requests"
+)
+
+
+@dataclass
+class LLMBackend:
+    name: str
+    service: LLMServiceBase
+    ttft: Optional[float] = None        # None until the first successful call
+    error_rate: float = 0.
+    degraded_until: float = 0.
+    ttft_samples: Deque[float] = field(default_factory=deque)
+
+    @property
+    def is_degraded(self) -> bool:
+        return self.degraded_until > time.monotonic()
+
+
+@dataclass
+class _Attempt:
+    backend: LLMBackend
+    stream: AsyncIterator[str]
+    started_at: float
+    is_hedge: bool
+
+
+class LLMRouter(LLMServiceBase):
+    """
+    Routes every call to one of several backends (provider, API key, model), preferring the lowest
+    moving average of time to first token, penalised by the backend's error rate.
+
+    A backend whose error rate crosses `degraded_error_rate` is drained for `degraded_cooldown` seconds.
+    Streams failing before their first token are retried on the next best backend, failures after that
+    are raised, since the consumer already received part of the output. These retries and the backends' own
+    share one AttemptBudget per call, which keeps a retry for each backend not tried yet.
+
+    Streams are hedged: when the first token is later than the backend's usual (rolling quantile of its TTFT),
+    the same request is started on the next backend (or again on the same one when it is the only candidate,
+    see `hedge_same_backend`) and whichever produces a token first is streamed, the other one is cancelled. Hedges are paid from a budget of prompt tokens that grows with routed traffic.
+    """
+
+    def __init__(self, backends: List[LLMBackend], config: Optional[LLMRouterConfig] = None):
+        if not backends:
+            raise ValueError("At least one LLM backend is required")
+        self.backends = backends
+        self.config = config or settings.llm_router_config
+        self._hedge_budget = 0.
+
+    def _score(self, backend: LLMBackend) -> float:
+        # backends without samples yet go first, so they get measured
+        return (backend.ttft or 0.) + backend.error_rate * self.config.error_penalty
+
+    def _ranked(self) -> List[LLMBackend]:
+        rate_limits = RateLimitTracker()
+        healthy = sorted(
+            (b for b in self.backends if not b.is_degraded and not rate_limits.is_limited(b.name)),
+            key=self._score
+        )
+        limited = sorted(
+            (b for b in self.backends if not b.is_degraded and rate_limits.is_limited(b.name)),
+            key=lambda b: rate_limits.delay(b.name, 1)
+        )
+        degraded = sorted((b for b in self.backends if b.is_degraded), key=lambda b: b.degraded_until)
+        if len(healthy) > 1 and random.random() < self.config.explore_ratio:
+            explored = random.choice(healthy[1:])
+            healthy.remove(explored)
+            healthy.insert(0, explored)
+        # keys out of budget may still get it back within the pacing delay,
+        # drained backends are the last resort when all others fail
+        return healthy + limited + degraded
+
+    def _record_success(self, backend: LLMBackend, ttft: Optional[float]):
+        alpha = self.config.ewma_alpha
+        if ttft is not None:
+            backend.ttft = ttft if backend.ttft is None else alpha * ttft + (1 - alpha) * backend.ttft
+            backend_ttft.labels(backend=backend.name).set(backend.ttft)
+            backend.ttft_samples.append(ttft)
+            if len(backend.ttft_samples) > self.config.hedge_window:
+                backend.ttft_samples.popleft()
+        backend.error_rate *= 1 - alpha
+        backend_error_rate.labels(backend=backend.name).set(backend.error_rate)
+        router_calls.labels(backend=backend.name, result="success").inc()
+
+    def _record_error(self, backend: LLMBackend, error: Exception):
+        if isinstance(error, CompletionTruncated):
+            # the budget of the call was too small, the backend answered normally
+            router_calls.labels(backend=backend.name, result="truncated").inc()
+            return
+        if isinstance(error, RateLimitExhausted):
+            # rejected locally before calling the provider, says nothing about the backend's health
+            router_calls.labels(backend=backend.name, result="rate_limited").inc()
+            logger.info("LLM backend out of rate limit budget", backend=backend.name)
+            return
+        alpha = self.config.ewma_alpha
+        backend.error_rate = alpha + (1 - alpha) * backend.error_rate
+        backend_error_rate.labels(backend=backend.name).set(backend.error_rate)
+        router_calls.labels(backend=backend.name, result="error").inc()
+        logger.warning("LLM backend failed", backend=backend.name, error=str(error), error_rate=backend.error_rate)
+        if backend.error_rate >= self.config.degraded_error_rate and not backend.is_degraded:
+            logger.error("LLM backend degraded, draining it", backend=backend.name)
+            sentry_sdk.capture_message(f"LLM backend {backend.name} degraded", level="warning")
+            backend.degraded_until = time.monotonic() + self.config.degraded_cooldown
+            # it starts over once the cooldown passes
+            backend.error_rate = 0.
+            backend_degraded.labels(backend=backend.name).set(1)
+
+    def _candidates(self) -> List[LLMBackend]:
+        for backend in self.backends:
+            if not backend.is_degraded:
+                backend_degraded.labels(backend=backend.name).set(0)
+        return self._ranked()[:self.config.max_attempts]
+
+    def _hedge_delay(self, backend: LLMBackend) -> float:
+        if self.config.hedge_delay is not None:
+            return self.config.hedge_delay
+        if len(backend.ttft_samples) < self.config.hedge_min_samples:
+            return self.config.hedge_default_delay
+        samples = sorted(backend.ttft_samples)
+        quantile = samples[int(self.config.hedge_quantile * (len(samples) - 1))]
+        return max(quantile, self.config.hedge_min_delay)
+
+    def _deposit_hedge_budget(self, prompt_tokens: int):
+        self._hedge_budget = min(
+            self._hedge_budget + prompt_tokens * self.config.hedge_budget_ratio,
+            self.config.hedge_budget_burst
+        )
+        hedge_budget.set(self._hedge_budget)
+
+    def _withdraw_hedge_budget(self, prompt_tokens: int) -> bool:
+        if self._hedge_budget < prompt_tokens:
+            return False
+        self._hedge_budget -= prompt_tokens
+        hedge_budget.set(self._hedge_budget)
+        return True
+
+    async def _race_first_token(
+            self,
+            candidates: List[LLMBackend],
+            messages: List[BaseChatMessage],
+            prompt_tokens: int,
+            **kwargs
+    ) -> Tuple[_Attempt, Optional[str]]:
+        """
+        Returns the attempt that produced a first token (None if its stream was empty) before any other.
+        Attempts failing before their first token are replaced by the next candidate, the losers are closed.
+        """
+        remaining = list(candidates)
+        pending: Dict[asyncio.Future, _Attempt] = {}
+        can_hedge = self.config.hedge_enabled
+        last_error: Optional[Exception] = None
+        budget = AttemptBudget.from_config()
+
+        def launch(is_hedge: bool = False, backend: Optional[LLMBackend] = None):
+            backend = backend or remaining.pop(0)
+            budget.reserved = len(remaining)
+            stream = backend.service.generate_stream(messages, attempt_budget=budget, **kwargs)
+            pending[asyncio.ensure_future(stream.__anext__())] = _Attempt(backend, stream, time.monotonic(), is_hedge)
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if can_hedge and (remaining or self.config.hedge_same_backend) and len(pending) == 1:
+                    attempt = next(iter(pending.values()))
+                    timeout = max(attempt.started_at + self._hedge_delay(attempt.backend) - time.monotonic(), 0)
+                done, _ = await asyncio.wait(pending.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # only one hedge per call
+                    can_hedge = False
+                    if self._withdraw_hedge_budget(prompt_tokens):
+                        late = next(iter(pending.values())).backend
+                        logger.info("First token late, hedging", backend=late.name)
+                        hedges.labels(result="started").inc()
+                        # a single backend is hedged with a second request to itself
+                        launch(is_hedge=True, backend=None if remaining else late)
+                    else:
+                        hedges.labels(result="over_budget").inc()
+                    continue
+
+                for future in done:
+                    attempt = pending.pop(future)
+                    try:
+                        first_token = future.result()
+                    except StopAsyncIteration:
+                        first_token = None
+                    except Exception as e:
+                        last_error = e
+                        self._record_error(attempt.backend, e)
+                        await attempt.stream.aclose()
+                        if remaining and not pending and budget.take(reserved=True):
+                            logger.info("Retrying LLM call on another backend", failed=attempt.backend.name)
+                            launch()
+                        continue
+                    self._record_success(attempt.backend, time.monotonic() - attempt.started_at)
+                    if attempt.is_hedge:
+                        hedges.labels(result="won").inc()
+                    elif pending:
+                        hedges.labels(result="lost").inc()
+                    return attempt, first_token
+            raise last_error
+        finally:
+            for future, attempt in pending.items():
+                future.cancel()
+                with suppress(BaseException):
+                    await future
+                await attempt.stream.aclose()
+
+    async def generate_stream(self, messages: List[BaseChatMessage], **kwargs) -> AsyncGenerator[str, None]:
+        prompt_tokens = estimate_token_count("".join(m.content for m in messages))
+        self._deposit_hedge_budget(prompt_tokens)
+        winner, first_token = await self._race_first_token(self._candidates(), messages, prompt_tokens, **kwargs)
+        if first_token is None:
+            return
+        async with aclosing(winner.stream) as stream:
+            try:
+                yield first_token
+                async for token in stream:
+                    yield token
+            except Exception as e:
+                self._record_error(winner.backend, e)
+                raise
+
+    async def generate(self, messages: List[BaseChatMessage], **kwargs) -> str:
+        candidates = self._candidates()
+        for attempt, backend in enumerate(candidates, start=1):
+            try:
+                response = await backend.service.generate(messages, **kwargs)
+            except Exception as e:
+                self._record_error(backend, e)
+                if attempt == len(candidates):
+                    raise
+                logger.info("Retrying LLM call on another backend", failed=backend.name)
+                continue
+            # full response time isn't comparable with the time to first token, only the error rate is updated
+            self._record_success(backend, None)
+            return response
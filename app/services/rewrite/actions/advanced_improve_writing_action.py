@@ -1,14 +1,110 @@
-from typing import AsyncGenerator, Optional, List, Type, Any, Dict
+import json
+import random
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator, Optional, List, Any, Dict, Tuple
 
+import httpx
+import structlog
+from langchain_core.callbacks.manager import adispatch_custom_event
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import Runnable, RunnableParallel, RunnableLambda
+from langchain_core.runnables import Runnable, RunnablePassthrough
 from langchain_openai import ChatOpenAI
+from prometheus_client import Histogram
 
+from app.depends.llm import get_llm_service
 from app.models.actions.advanced_improve import ChainInputs, AnalyzeOutput
 from app.models.completion import RephraseTaskType
+from app.models.config import AdvancedImproveEngine
+from app.models.message import UserMessage
 from app.models.sse import SSEEvent
+from app.services.llm.clients import LLMClientPool
+from app.services.cache.redis_cache import RedisCacheService
+from app.services.llm.llm_service import LLMServiceBase, record_completion
 from app.services.rewrite.actions.base import BaseRephraseAction
+from app.services.rewrite.analysis_cache import AnalysisCache
+from app.services.rewrite.pipeline import PipelineState, StepPipeline
 from app.settings import LLMProvider, settings
+from app.utils.partial_json import IncrementalJSONObjectParser
+
+logger = structlog.get_logger(__name__)
+
+_latency_buckets = (.25, .5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60)
+mode_time_to_first_token = Histogram(
+    "advanced_improve_time_to_first_token_seconds",
+    "Time from the start of an advanced improve rewrite to its first token, by mode",
+    ["mode"],
+    buckets=_latency_buckets
+)
+mode_duration = Histogram(
+    "advanced_improve_duration_seconds",
+    "Duration of successful advanced improve rewrites, by mode",
+    ["mode"],
+    buckets=_latency_buckets
+)
+
+
+async def _writing_style(inputs: Dict[str, Any]) -> str:
+    return inputs.get("writing_style") or AdvancedImproveAction._default_writing_style
+
+
+_required_analysis_fields = {name for name, field in AnalyzeOutput.model_fields.items() if field.is_required()}
+
+
+async def _analysis_fields(tokens: AsyncGenerator[str, None]) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Fields of the streamed analysis JSON each time some complete, for the analysis_partial events.
+    The Improve prompt takes the whole analysis, so rewriting still starts after its last field,
+    reading only stops there instead of at the end of the reply.
+    """
+    parser = IncrementalJSONObjectParser()
+    content = ""
+    async with aclosing(tokens):
+        async for token in tokens:
+            content += token
+            if parser.feed(token):
+                yield dict(parser.fields)
+                if _required_analysis_fields <= parser.fields.keys():
+                    return
+    # the reply ended first, it's validated as a whole to report what's wrong with it
+    yield AnalyzeOutput.model_validate_json(content).model_dump()
+
+
+async def _analyze(inputs: Dict[str, Any]) -> AnalyzeOutput:
+    # parsed here, LangChain's structured output parsers run in the default executor
+    fields: Dict[str, Any] = {}
+    updates = _analysis_fields(AdvancedImproveAction._stream_langchain(
+        inputs["prompt"],
+        AdvancedImproveAction._analyze_temp,
+        name="Analysis",
+        max_tokens=settings.generation_budget_config.analysis_max_tokens,
+        json_mode=True
+    ))
+    async with aclosing(updates):
+        async for fields in updates:
+            await adispatch_custom_event(SSEEvent.ANALYSIS_PARTIAL.value, fields)
+    return AnalyzeOutput.model_validate(fields)
+
+
+async def _rephrase_prompt(inputs: Dict[str, Any]) -> str:
+    fields = {key: value for key, value in inputs.items() if key != "analysis"}
+    return AdvancedImproveAction._get_rephrase_prompt(
+        {**inputs["analysis"].model_dump(), **fields},
+        inputs.get("prev_rewrites")
+    )
+
+
+async def _improve_message(inputs: Dict[str, Any]) -> str:
+    response = await AdvancedImproveAction.get_llm(
+        AdvancedImproveAction._rewrite_temp,
+        name="Improve",
+        max_tokens=inputs.get("max_tokens")
+    ).ainvoke(inputs["prompt"])
+    return response.content
+
+
+async def _locale_instructions(inputs: Dict[str, Any]) -> str:
+    return AdvancedImproveAction._get_locale_instructions(inputs.get("locale"))
 
 
 class AdvancedImproveAction(BaseRephraseAction):
@@ -19,99 +115,153 @@ class AdvancedImproveAction(BaseRephraseAction):
     _analyze_prompt = PromptTemplate.from_template(settings.prompts.advanced_improve_prompt.analyze_prompt)
     _rewrite_prompt = PromptTemplate.from_template(settings.prompts.advanced_improve_prompt.rewrite_prompt)
     _humanize_prompt = PromptTemplate.from_template(settings.prompts.advanced_improve_prompt.humanize_prompt)
+    _fast_prompt = PromptTemplate.from_template(settings.prompts.advanced_improve_prompt.fast_prompt) \
+        if settings.prompts.advanced_improve_prompt.fast_prompt else None
 
     _analyze_temp = _rewrite_temp = _humanize_temp = base_temperature
 
     _default_writing_style = "natural style, direct and clear"
 
-    _inputs = RunnableParallel({
-        "original_message": lambda inputs: inputs.get("original_message"),
-        "writing_style": lambda inputs: inputs.get("writing_style") or AdvancedImproveAction._default_writing_style,
-        "app_name": lambda inputs: inputs.get("app_name"),
-        "prompt": _analyze_prompt,
-        "prev_rewrites": lambda inputs: inputs.get("prev_rewrites"),
-        "locale": lambda inputs: inputs.get("locale")
-    }).with_types(input_type=ChainInputs)
-
-    # most inputs from the previous step are just passed through to the next step,
-    # analysis doesn't use them
-    _analysis = RunnableParallel({
-        "original_message": lambda x: x.get('original_message'),
-        "app_name": lambda x: x.get('app_name'),
-        "writing_style": lambda x: x.get('writing_style'),
-        "prev_rewrites": lambda x: x.get('prev_rewrites'),
-        "locale": lambda x: x.get('locale'),
-        "analysis": lambda x: AdvancedImproveAction.get_llm(
-            AdvancedImproveAction._analyze_temp,
-            name="Analysis",
-            structure=AnalyzeOutput
-        ).invoke(x.get("prompt"))
-    })
+    # models are reused across requests, they only hold the configuration and the pooled HTTP clients
+    _llms: Dict[Tuple[float, Optional[str], httpx.AsyncClient], ChatOpenAI] = {}
+
+    # every step adds its output to its inputs, which pass through to the following steps.
+    # steps are coroutines, plain functions would each take a thread of the default executor
+    _inputs = (
+            RunnablePassthrough.assign(writing_style=_writing_style) |
+            RunnablePassthrough.assign(prompt=_analyze_prompt)
+    ).with_types(input_type=ChainInputs)
+
+    _analysis = RunnablePassthrough.assign(analysis=_analyze)
     _analysis.name = "Analysis"
 
-    _rewrite = RunnableParallel({
-        "prompt": RunnableLambda(
-            lambda x: AdvancedImproveAction._get_rephrase_prompt(
-                {**(x.pop("analysis")).dict(), **x}, 
-                x.get("prev_rewrites")
-            )
-        ),
-        "original_message": lambda x: x.get("original_message"),
-        "locale": lambda x: x.get("locale")
-    } )
+    _rewrite = RunnablePassthrough.assign(prompt=_rephrase_prompt)
     _rewrite.name = "Rewrite"
 
-    _improve = RunnableParallel({
-        "original_message": lambda x: x.get("original_message"),
-        "improved_message": lambda x: AdvancedImproveAction.get_llm(
-            AdvancedImproveAction._rewrite_temp
-        ).invoke(x.get("prompt")).content,
-        "locale_instructions": lambda x: AdvancedImproveAction._get_locale_instructions(x.get("locale"))
-    })
+    _improve = RunnablePassthrough.assign(
+        improved_message=_improve_message,
+        locale_instructions=_locale_instructions
+    )
     _improve.name = "Improve"
 
-    def get_chain(self) -> Runnable:
-        humanize_llm = self.get_llm(self._humanize_temp, name="Humanize")
-        chain = (
-                self._inputs |
-                self._analysis |
+    def __init__(self, llm_service: Optional[LLMServiceBase] = None, analysis_cache: Optional[AnalysisCache] = None):
+        self.llm_service = llm_service or get_llm_service()
+        self.analysis_cache = analysis_cache or AnalysisCache(cache=RedisCacheService())
+        self.pipeline = StepPipeline("advanced_improve", [
+            ("analysis", self._analysis_step),
+            ("improve", self._improve_step),
+            ("humanize", self._humanize_step),
+        ])
+
+    def get_chain(self, max_tokens: Optional[int] = None, analyzed: bool = False) -> Runnable:
+        """Chain of the rewrite, `analyzed` if the inputs already have the analysis of the text"""
+        humanize_llm = self.get_llm(self._humanize_temp, name="Humanize", max_tokens=max_tokens)
+        chain = self._inputs
+        if not analyzed:
+            chain = chain | self._analysis
+        return (
+                chain |
                 self._rewrite |
                 self._improve |
                 self._humanize_prompt |
                 humanize_llm
         )
-        return chain
 
     @classmethod
-    def _get_rephrase_prompt(cls, input: Dict[str, Any], prev_rewrites: List[str] | None) -> str:
+    def _get_rephrase_prompt(
+            cls,
+            input: Dict[str, Any],
+            prev_rewrites: List[str] | None,
+            template: Optional[PromptTemplate] = None
+    ) -> str:
+        template = template or cls._rewrite_prompt
         if prev_rewrites:
-            prompt = cls._rewrite_prompt + (
+            prompt = template + (
                     "\n" +
                     "These were the previously revised texts which user wasn't happy with, generate different rewrites with similar meaning: " +
                     "\n".join(prev_rewrites)
             )
         else:
-            prompt = cls._rewrite_prompt
+            prompt = template
         return prompt.invoke(input).to_string()
 
     @classmethod
-    def get_llm(cls, temp: float, name: Optional[str] = None, structure: Optional[Type] = None) -> ChatOpenAI:
+    def get_llm(
+            cls,
+            temp: float,
+            name: Optional[str] = None,
+            json_mode: bool = False,
+            max_tokens: Optional[int] = None
+    ) -> Runnable:
+        """Shared model with the options of the call (JSON output, generation budget) bound to it"""
         if settings.llm_provider == LLMProvider.OPENAI:
-            model = ChatOpenAI(
-                api_key=settings.llm_api_key,
-                model=settings.llm_model,
-                temperature=temp,
-            )
-            if name:
-                model.name = name
-            if structure:
-                model = model.with_structured_output(structure, method="json_mode")
-            return model
+            clients = LLMClientPool()
+            http_async_client = clients.http_client(LLMProvider.OPENAI)
+            # keyed by the pooled client too, so models of a closed pool aren't reused
+            key = (temp, name, http_async_client)
+            if key not in cls._llms:
+                model = ChatOpenAI(
+                    api_key=settings.llm_api_key,
+                    model=settings.llm_model,
+                    base_url=settings.llm_base_url,
+                    temperature=temp,
+                    http_client=clients.sync_http_client(LLMProvider.OPENAI),
+                    http_async_client=http_async_client,
+                )
+                if name:
+                    model.name = name
+                cls._llms[key] = model
+            options: Dict[str, Any] = {}
+            if json_mode:
+                options["response_format"] = {"type": "json_object"}
+            if max_tokens:
+                options["max_tokens"] = max_tokens
+            return cls._llms[key].bind(**options) if options else cls._llms[key]
         else:
             raise NotImplementedError(
                 f"LLM provider {settings.llm_provider} is not supported for advanced rwerite"
             )
 
+    @classmethod
+    async def _stream_langchain(
+            cls,
+            prompt: str,
+            temp: float,
+            name: str,
+            max_tokens: Optional[int] = None,
+            json_mode: bool = False
+    ) -> AsyncGenerator[str, None]:
+        chunks = cls.get_llm(temp, name=name, json_mode=json_mode, max_tokens=max_tokens).astream(prompt)
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                finish_reason = chunk.response_metadata.get("finish_reason")
+                if finish_reason:
+                    record_completion(
+                        f"{settings.llm_provider.value}/{settings.llm_model}",
+                        finish_reason == "length",
+                        max_tokens
+                    )
+                if chunk.content:
+                    yield chunk.content
+
+    def _stream_llm(
+            self,
+            prompt: str,
+            temp: float,
+            name: str,
+            max_tokens: Optional[int] = None,
+            json_mode: bool = False
+    ) -> AsyncGenerator[str, None]:
+        """Tokens of a single prompt completion, by the configured engine"""
+        if settings.advanced_improve_engine == AdvancedImproveEngine.LANGCHAIN:
+            return self._stream_langchain(prompt, temp, name, max_tokens, json_mode)
+        return self.llm_service.generate_stream(
+            messages=[UserMessage(content=prompt)],
+            temperature=temp,
+            max_tokens=max_tokens,
+            json_mode=json_mode
+        )
+
     @classmethod
     def _get_locale_instructions(cls, locale: Optional[str] = None) -> str:
         """Get locale instructions for the humanize step."""
@@ -125,22 +275,210 @@ class AdvancedImproveAction(BaseRephraseAction):
         else:
             return ""
 
+    @classmethod
+    def _use_fast_mode(cls) -> bool:
+        if cls._fast_prompt is None:
+            return False
+        return random.random() * 100 < settings.advanced_improve_fast_mode_config.traffic_percentage
+
     async def _perform(
             self,
             original_message: str,
             prev_rewrites: List[str] | None,
             application: Optional[str] = None,
             locale: Optional[str] = None
-    ) -> AsyncGenerator[str, None]:
-        chain = self.get_chain()
-        async for event in chain.astream_events({
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        mode = "fast" if self._use_fast_mode() else "chain"
+        if mode == "fast":
+            perform = self._perform_fast
+        elif settings.advanced_improve_engine == AdvancedImproveEngine.LANGCHAIN:
+            perform = self._perform_langchain
+        else:
+            perform = self._perform_native
+        started = time.perf_counter()
+        first_token = True
+        async with aclosing(perform(original_message, prev_rewrites, application, locale)) as events:
+            async for event, content in events:
+                if first_token and event == SSEEvent.DATA and content:
+                    first_token = False
+                    mode_time_to_first_token.labels(mode=mode).observe(time.perf_counter() - started)
+                yield event, content
+        mode_duration.labels(mode=mode).observe(time.perf_counter() - started)
+
+    async def _perform_fast(
+            self,
+            original_message: str,
+            prev_rewrites: List[str] | None,
+            application: Optional[str] = None,
+            locale: Optional[str] = None
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        """
+        Single streamed call replying with the analysis JSON, the delimiter and the final text.
+        Text before the delimiter is held back, the rest is streamed as it comes.
+        """
+        delimiter = settings.advanced_improve_fast_mode_config.delimiter
+        max_tokens = self._get_max_tokens(original_message)
+        prompt = self._get_rephrase_prompt({
+            "original_message": original_message,
+            "app_name": application,
+            "writing_style": self._default_writing_style,
+            "locale_instructions": self._get_locale_instructions(locale),
+            "delimiter": delimiter,
+        }, prev_rewrites, self._fast_prompt)
+        tokens = self._stream_llm(
+            prompt,
+            self._rewrite_temp,
+            name="Fast",
+            max_tokens=max_tokens + settings.generation_budget_config.analysis_max_tokens if max_tokens else None
+        )
+
+        prefix = ""
+        parser = IncrementalJSONObjectParser()
+        analyzed = text_started = False
+        async with aclosing(tokens):
+            async for token in tokens:
+                if analyzed:
+                    text = token
+                else:
+                    prefix += token
+                    if parser.feed(token):
+                        yield SSEEvent.ANALYSIS_PARTIAL, json.dumps(parser.fields)
+                    head, found, text = prefix.partition(delimiter)
+                    if not found:
+                        continue
+                    analyzed = True
+                    analysis = self._parse_fast_analysis(head)
+                    if analysis:
+                        yield SSEEvent.ANALYSIS, analysis.model_dump_json()
+                        analysis_key = self._get_analysis_key(original_message, locale)
+                        if analysis_key:
+                            await self.analysis_cache.set(analysis_key, analysis)
+                if not text_started:
+                    # whitespace after the delimiter
+                    text = text.lstrip()
+                    text_started = bool(text)
+                if text:
+                    yield SSEEvent.DATA, text
+        if not analyzed:
+            raise ValueError("Fast mode reply has no analysis delimiter")
+
+    @staticmethod
+    def _parse_fast_analysis(head: str) -> Optional[AnalyzeOutput]:
+        # models sometimes wrap the JSON in a code block
+        try:
+            return AnalyzeOutput.model_validate_json(head[head.index("{"):head.rindex("}") + 1])
+        except ValueError as e:
+            logger.warning("Invalid analysis in fast mode reply", error=str(e))
+            return None
+
+    def _get_analysis_key(self, original_message: str, locale: Optional[str]) -> Optional[str]:
+        return self.analysis_cache.get_key(original_message, self._get_locale_mapping(locale) if locale else None)
+
+    async def _analysis_step(self, state: PipelineState) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        if state["analysis"] is not None:
+            return
+        fields: Dict[str, Any] = {}
+        updates = _analysis_fields(self._stream_llm(
+            self._analyze_prompt.format(**state),
+            self._analyze_temp,
+            name="Analysis",
+            max_tokens=settings.generation_budget_config.analysis_max_tokens,
+            json_mode=True
+        ))
+        async with aclosing(updates):
+            async for fields in updates:
+                yield SSEEvent.ANALYSIS_PARTIAL, json.dumps(fields)
+        state["analysis"] = AnalyzeOutput.model_validate(fields)
+        yield SSEEvent.ANALYSIS, state["analysis"].model_dump_json()
+        if state["analysis_key"]:
+            await self.analysis_cache.set(state["analysis_key"], state["analysis"])
+
+    async def _improve_step(self, state: PipelineState):
+        prompt = self._get_rephrase_prompt({**state["analysis"].model_dump(), **state}, state["prev_rewrites"])
+        tokens = self._stream_llm(prompt, self._rewrite_temp, name="Improve", max_tokens=state["max_tokens"])
+        async with aclosing(tokens):
+            state["improved_message"] = "".join([token async for token in tokens])
+
+    async def _humanize_step(self, state: PipelineState) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        tokens = self._stream_llm(
+            self._humanize_prompt.format(**state),
+            self._humanize_temp,
+            name="Humanize",
+            max_tokens=state["max_tokens"]
+        )
+        async with aclosing(tokens):
+            async for token in tokens:
+                yield SSEEvent.DATA, token
+
+    async def _perform_native(
+            self,
+            original_message: str,
+            prev_rewrites: List[str] | None,
+            application: Optional[str] = None,
+            locale: Optional[str] = None
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        """Analysis, rewrite and humanize steps, one LLM call each, run by the native pipeline"""
+        # regenerations resend the same text, its analysis is reused
+        analysis_key = self._get_analysis_key(original_message, locale)
+        analysis = await self.analysis_cache.get(analysis_key) if analysis_key else None
+        if analysis:
+            yield SSEEvent.ANALYSIS, analysis.model_dump_json()
+
+        events = self.pipeline.run({
+            "original_message": original_message,
+            "app_name": application,
+            "writing_style": self._default_writing_style,
+            "prev_rewrites": prev_rewrites,
+            "locale": locale,
+            "locale_instructions": self._get_locale_instructions(locale),
+            "max_tokens": self._get_max_tokens(original_message),
+            "analysis": analysis,
+            "analysis_key": analysis_key,
+        })
+        async with aclosing(events):
+            async for event in events:
+                yield event
+
+    async def _perform_langchain(
+            self,
+            original_message: str,
+            prev_rewrites: List[str] | None,
+            application: Optional[str] = None,
+            locale: Optional[str] = None
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        """Same steps as `_perform_native`, run as a LangChain chain"""
+        max_tokens = self._get_max_tokens(original_message)
+        analysis_key = self._get_analysis_key(original_message, locale)
+        analysis = await self.analysis_cache.get(analysis_key) if analysis_key else None
+        if analysis:
+            yield SSEEvent.ANALYSIS, analysis.model_dump_json()
+
+        chain = self.get_chain(max_tokens, analyzed=analysis is not None)
+        events = chain.astream_events({
             "original_message": original_message,
             "app_name": application,
             "writing_style": self._default_writing_style,
             "prev_rewrites": prev_rewrites,
-            "locale": locale
-        }, version="v2"):
-            if event['event'] == 'on_chat_model_stream' and event['name'] == 'Humanize':
-                yield SSEEvent.DATA,  event['data']['chunk'].content
-            elif event['event'] == 'on_chat_model_end' and event['name'] == 'Analysis':
-                yield SSEEvent.ANALYSIS, event['data']['output'].content
\ No newline at end of file
+            "locale": locale,
+            "max_tokens": max_tokens,
+            "analysis": analysis
+        }, version="v2")
+        async with aclosing(events):
+            async for event in events:
+                if event['event'] == 'on_chat_model_stream' and event['name'] == 'Humanize':
+                    yield SSEEvent.DATA,  event['data']['chunk'].content
+                elif event['event'] == 'on_custom_event' and event['name'] == SSEEvent.ANALYSIS_PARTIAL.value:
+                    yield SSEEvent.ANALYSIS_PARTIAL, json.dumps(event['data'])
+                elif event['event'] == 'on_chain_end' and event['name'] == 'Analysis':
+                    analysis = event['data']['output']['analysis']
+                    yield SSEEvent.ANALYSIS, analysis.model_dump_json()
+                    if analysis_key:
+                        await self.analysis_cache.set(analysis_key, analysis)
+                elif event['event'] == 'on_chat_model_end' and event['name'] in ('Improve', 'Humanize'):
+                    finish_reason = event['data']['output'].response_metadata.get('finish_reason')
+                    if finish_reason:
+                        record_completion(
+                            f"{settings.llm_provider.value}/{settings.llm_model}",
+                            finish_reason == "length",
+                            max_tokens
+                        )
\ No newline at end of file
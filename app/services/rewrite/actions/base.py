@@ -1,4 +1,6 @@
 import abc
+import math
+from contextlib import aclosing
 from typing import AsyncGenerator, List, Optional, Tuple
 
 import sentry_sdk
@@ -6,6 +8,9 @@ import structlog
 
 from app.models.completion import RephraseTaskType
 from app.models.sse import SSEEvent
+from app.settings import settings
+from app.utils.stage_timer import StageTimer
+from app.utils.tokens import estimate_max_token_count
 
 logger = structlog.get_logger(__name__)
 
@@ -20,6 +25,7 @@ class BaseRephraseAction(abc.ABC):
     base_temperature: float
     max_rewrite_temp: float
     task_type: RephraseTaskType
+    output_ratio: float = 1.5   # expected output length relative to the input, before the generation budget margin
 
     @staticmethod
     def _get_locale_mapping(locale: str) -> str:
@@ -41,6 +47,25 @@ class BaseRephraseAction(abc.ABC):
         else:
             return 'en_US'  # Default fallback
 
+    def _get_max_tokens(self, original_message: str) -> Optional[int]:
+        """Generation budget of a rewrite, bounds runaway completions. None if disabled"""
+        config = settings.generation_budget_config
+        if not config.enabled:
+            return None
+        # a budget too small truncates the rewrite, tokenizers and texts (code, URLs) vary a lot, hence the margin
+        expected = estimate_max_token_count(original_message) * self.output_ratio
+        budget = math.ceil(expected * config.margin) + config.allowance
+        return min(max(budget, config.min_tokens), config.max_tokens)
+
+    def perform_locally(
+            self,
+            original_message: str,
+            prev_rewrites: List[str] | None,
+            locale: Optional[str] = None
+    ) -> Optional[str]:
+        """Result computed in-process without calling the LLM, None if the action has to be performed"""
+        return None
+
     @abc.abstractmethod
     async def _perform(
             self,
@@ -58,9 +83,15 @@ class BaseRephraseAction(abc.ABC):
             application: Optional[str] = None,
             locale: Optional[str] = None
     ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        timer = StageTimer.current()
+        if timer:
+            timer.mark_dispatched()
         try:
             # TODO: Instead of none pass application
-            async for event, content in self._perform(original_message, prev_rewrites, None, locale):
-                yield event, content
+            async with aclosing(self._perform(original_message, prev_rewrites, None, locale)) as events:
+                async for event, content in events:
+                    if timer and event == SSEEvent.DATA:
+                        timer.mark_token(content)
+                    yield event, content
         except Exception as e:
             raise ActionFailed(self.task_type, str(e))
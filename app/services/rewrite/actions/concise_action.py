@@ -7,5 +7,6 @@ class ConciseAction(BaseLLMAction):
     action_prompt = settings.prompts.concise_prompt
     task_type = RephraseTaskType.CONCISE
     base_temperature = settings.rephrase_temperature
+    output_ratio = 1.0   # should end up shorter than the input
     max_rewrite_temp = 1
     _is_creative_rewrite = True
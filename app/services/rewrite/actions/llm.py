@@ -1,4 +1,5 @@
 import abc
+from contextlib import aclosing
 from typing import List, Optional, AsyncGenerator, Tuple
 
 from app.models.message import SystemMessage, UserMessage
@@ -30,10 +31,12 @@ class BaseLLMAction(BaseRephraseAction):
         messages = self._get_messages(original_message, prev_rewrites, application, locale)
         response_generator = self.llm_service.generate_stream(
             messages=messages,
-            temperature=temperature
+            temperature=temperature,
+            max_tokens=self._get_max_tokens(original_message)
         )
-        async for response in response_generator:
-            yield SSEEvent.DATA,  response
+        async with aclosing(response_generator):
+            async for response in response_generator:
+                yield SSEEvent.DATA,  response
 
     def _get_temperature(self, prev_rewrites: List[str] | None) -> float:
         base_temperature = self.base_temperature
@@ -1,5 +1,8 @@
+from typing import List, Optional
+
 from app.models.completion import RephraseTaskType
 from app.services.rewrite.actions.llm import BaseLLMAction
+from app.services.spelling.corrector import SpellingCorrector
 from app.settings import settings
 
 
@@ -7,4 +10,16 @@ class ProofreadAction(BaseLLMAction):
     task_type = RephraseTaskType.FIX_GRAMMAR
     action_prompt = settings.prompts.fix_grammar_prompt
     base_temperature = settings.fix_grammar_temperature
+    output_ratio = 1.3   # roughly as long as the input
     max_rewrite_temp = base_temperature
+
+    def perform_locally(
+            self,
+            original_message: str,
+            prev_rewrites: List[str] | None,
+            locale: Optional[str] = None
+    ) -> Optional[str]:
+        # regenerations mean the user wasn't happy with the result, let the LLM handle those
+        if prev_rewrites or len(original_message.split()) != 1:
+            return None
+        return SpellingCorrector().correct(original_message, self._get_locale_mapping(locale))
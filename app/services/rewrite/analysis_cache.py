@@ -0,0 +1,68 @@
+import hashlib
+import json
+import unicodedata
+from typing import Optional
+
+import structlog
+from prometheus_client import Counter
+
+from app.models.actions.advanced_improve import AnalyzeOutput
+from app.depends.llm import get_llm_models_version
+from app.models.config import AnalysisCacheConfig
+from app.services.cache.base import BaseCacheService
+from app.settings import settings
+
+logger = structlog.get_logger(__name__)
+
+analysis_cache_requests = Counter(
+    "rewrite_analysis_cache_requests_total",
+    "Lookups of cached AdvancedImproveAction analyses",
+    ["result"]
+)
+
+
+class AnalysisCache:
+    """
+    Caches the analysis (tone, vocabulary, formality, goal, language) of a text, which doesn't change
+    when the user regenerates its rewrite, so regenerations go straight to rewriting.
+    """
+    _cache_key = 'rewrite:analysis'
+
+    def __init__(self, cache: BaseCacheService, config: Optional[AnalysisCacheConfig] = None):
+        self.cache = cache
+        self.config = config or settings.analysis_cache_config
+        self.prompt_version = self.config.prompt_version or hashlib.sha256(
+            settings.prompts.advanced_improve_prompt.analyze_prompt.encode()
+        ).hexdigest()[:12]
+        self.models_version = self.config.models_version or get_llm_models_version()
+
+    def get_key(self, text: str, locale: Optional[str]) -> str | None:
+        """Returns the cache key of the text's analysis, or None if it shouldn't be cached"""
+        if not self.config.enabled:
+            return None
+        text = unicodedata.normalize("NFC", text).strip()
+        if not text or len(text) > self.config.max_text_length:
+            return None
+        digest = hashlib.sha256(json.dumps([
+            text,
+            locale,
+            self.models_version,
+            self.prompt_version,
+        ]).encode()).hexdigest()
+        return f'{self._cache_key}:{digest}'
+
+    async def get(self, key: str) -> AnalyzeOutput | None:
+        try:
+            cached = await self.cache.get(key)
+            analysis = AnalyzeOutput.model_validate_json(cached) if cached is not None else None
+        except Exception as e:
+            logger.warning("Failed to read analysis cache", error=str(e))
+            analysis = None
+        analysis_cache_requests.labels(result="hit" if analysis else "miss").inc()
+        return analysis
+
+    async def set(self, key: str, analysis: AnalyzeOutput):
+        try:
+            await self.cache.set(key, analysis.model_dump_json(), ttl=self.config.ttl)
+        except Exception as e:
+            logger.warning("Failed to write analysis cache", error=str(e))
@@ -0,0 +1,99 @@
+import asyncio
+from contextlib import suppress
+from typing import AsyncGenerator, AsyncIterator, List, Optional, Tuple
+
+from prometheus_client import Counter
+
+from app.models.config import SSEBatchingConfig
+from app.models.sse import SSEEvent
+from app.settings import settings
+
+sse_frames = Counter(
+    "rewrite_sse_frames_total",
+    "SSE frames before (in) and after (out) chunk batching",
+    ["task_type", "stage"]
+)
+
+
+class ChunkBatcher:
+    """
+    Coalesces consecutive data chunks into fewer SSE frames. The first data chunk is flushed right away
+    so time-to-first-token is unchanged, the rest is flushed once `max_chars` are buffered or
+    `max_delay_ms` passed since the oldest buffered chunk. Other events flush the buffer and pass through.
+    """
+
+    def __init__(self, task_type: str, config: Optional[SSEBatchingConfig] = None):
+        self.task_type = task_type
+        self.config = config or settings.sse_batching_config
+        self._frames_in = sse_frames.labels(task_type=task_type, stage="in")
+        self._frames_out = sse_frames.labels(task_type=task_type, stage="out")
+
+    async def batch(self, stream: AsyncIterator[Tuple[SSEEvent, str]]) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        if not self.config.enabled:
+            async for event, content in stream:
+                self._frames_in.inc()
+                self._frames_out.inc()
+                yield event, content
+            return
+
+        loop = asyncio.get_running_loop()
+        max_delay = self.config.max_delay_ms / 1000
+        iterator = stream.__aiter__()
+        next_chunk: Optional[asyncio.Future] = None
+        buffer: List[str] = []
+        buffered_chars = 0
+        flush_at = 0.
+        first_data_sent = False
+        try:
+            while True:
+                if next_chunk is None:
+                    next_chunk = asyncio.ensure_future(iterator.__anext__())
+                timeout = max(flush_at - loop.time(), 0) if buffer else None
+                done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                if not done:
+                    yield self._flush(buffer)
+                    buffered_chars = 0
+                    continue
+
+                try:
+                    event, content = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    next_chunk = None
+                self._frames_in.inc()
+
+                if event != SSEEvent.DATA:
+                    if buffer:
+                        yield self._flush(buffer)
+                        buffered_chars = 0
+                    self._frames_out.inc()
+                    yield event, content
+                elif not first_data_sent:
+                    first_data_sent = True
+                    self._frames_out.inc()
+                    yield event, content
+                else:
+                    if not buffer:
+                        flush_at = loop.time() + max_delay
+                    buffer.append(content)
+                    buffered_chars += len(content)
+                    if buffered_chars >= self.config.max_chars:
+                        yield self._flush(buffer)
+                        buffered_chars = 0
+
+            if buffer:
+                yield self._flush(buffer)
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+                with suppress(BaseException):
+                    await next_chunk
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    def _flush(self, buffer: List[str]) -> Tuple[SSEEvent, str]:
+        content = "".join(buffer)
+        buffer.clear()
+        self._frames_out.inc()
+        return SSEEvent.DATA, content
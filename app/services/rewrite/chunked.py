@@ -0,0 +1,131 @@
+import asyncio
+import re
+from contextlib import aclosing
+from typing import AsyncGenerator, AsyncIterator, Callable, List, Optional, Tuple
+
+import sentry_sdk
+import structlog
+
+from app.models.completion import RephraseRequest
+from app.models.config import ChunkedRewriteConfig
+from app.models.sse import SSEEvent
+from app.settings import settings
+
+logger = structlog.get_logger(__name__)
+
+_paragraph_separator = re.compile(r"(\n\s*\n)")
+_sentence_separator = re.compile(r"(?<=[.!?])(\s+)")
+
+_chunk_done = object()
+
+
+def _split_keeping_separators(text: str, separator: re.Pattern) -> List[Tuple[str, str]]:
+    parts = separator.split(text)
+    return [(parts[i], parts[i + 1] if i + 1 < len(parts) else "") for i in range(0, len(parts), 2)]
+
+
+def split_text(text: str, max_chunk_length: int) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    Splits text on paragraph boundaries, falling back to sentence boundaries for paragraphs longer
+    than `max_chunk_length`, and merges neighbouring pieces back up to `max_chunk_length`.
+    Returns leading whitespace and a list of (chunk, separator following the chunk), so that
+    joining them gives back the original text.
+    """
+    stripped = text.strip()
+    leading = text[:len(text) - len(text.lstrip())]
+    trailing = text[len(text.rstrip()):]
+
+    units: List[Tuple[str, str]] = []
+    for paragraph, paragraph_separator in _split_keeping_separators(stripped, _paragraph_separator):
+        if len(paragraph) <= max_chunk_length:
+            units.append((paragraph, paragraph_separator))
+            continue
+        sentences = _split_keeping_separators(paragraph, _sentence_separator)
+        last_sentence, last_separator = sentences[-1]
+        sentences[-1] = (last_sentence, last_separator + paragraph_separator)
+        units.extend(sentences)
+
+    chunks: List[Tuple[str, str]] = []
+    chunk, chunk_separator = "", ""
+    for unit, separator in units:
+        if chunk and len(chunk) + len(chunk_separator) + len(unit) > max_chunk_length:
+            chunks.append((chunk, chunk_separator))
+            chunk, chunk_separator = "", ""
+        chunk = chunk + chunk_separator + unit if chunk else unit
+        chunk_separator = separator
+    if chunk:
+        chunks.append((chunk, chunk_separator + trailing))
+    return leading, chunks
+
+
+class ChunkedRewriter:
+    """
+    Rewrites long texts chunk by chunk with bounded parallelism. Output is streamed in the original
+    order: chunks are generated concurrently and buffered until all preceding chunks were flushed.
+
+    A chunk failing before anything was streamed fails the whole rewrite, so the caller can fall back.
+    Once earlier chunks were streamed, the rewrite ends with an error event instead.
+    """
+
+    def __init__(self, config: Optional[ChunkedRewriteConfig] = None):
+        self.config = config or settings.chunked_rewrite_config
+
+    def split(self, rephrase_request: RephraseRequest) -> Tuple[str, List[Tuple[str, str]]] | None:
+        """Returns the text split into chunks, or None if the request should be rewritten in one stream"""
+        if not self.config.enabled or rephrase_request.completion_task_type.value not in self.config.task_types:
+            return None
+        if len(rephrase_request.text) < self.config.min_text_length:
+            return None
+        leading, chunks = split_text(rephrase_request.text, self.config.max_chunk_length)
+        if len(chunks) < 2:
+            return None
+        return leading, chunks
+
+    async def perform(
+            self,
+            leading: str,
+            chunks: List[Tuple[str, str]],
+            rewrite_chunk: Callable[[str], AsyncIterator[Tuple[SSEEvent, str]]]
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        logger.debug("Rewriting in chunks", chunks=len(chunks))
+        semaphore = asyncio.Semaphore(self.config.max_parallel)
+        outputs: List[asyncio.Queue] = [asyncio.Queue() for _ in chunks]
+
+        async def worker(index: int, chunk: str):
+            try:
+                async with semaphore:
+                    async with aclosing(rewrite_chunk(chunk)) as events:
+                        async for item in events:
+                            outputs[index].put_nowait(item)
+                outputs[index].put_nowait(_chunk_done)
+            except Exception as e:
+                outputs[index].put_nowait(e)
+
+        workers = [asyncio.create_task(worker(index, chunk)) for index, (chunk, _) in enumerate(chunks)]
+        has_output = False
+        # whitespace between chunks is held back until some rewritten text goes out
+        pending = leading
+        try:
+            for index, (output, (_, separator)) in enumerate(zip(outputs, chunks)):
+                while (item := await output.get()) is not _chunk_done:
+                    if isinstance(item, Exception):
+                        if not has_output:
+                            raise item
+                        logger.error("Chunk rewrite failed", chunk=index, chunks=len(chunks), error=str(item))
+                        sentry_sdk.capture_exception(item)
+                        # the client already has the previous chunks, it's told the rewrite is incomplete
+                        yield SSEEvent.ERROR, "rewrite failed"
+                        return
+                    if item[0] == SSEEvent.DATA:
+                        has_output = True
+                        if pending:
+                            yield SSEEvent.DATA, pending
+                            pending = ""
+                    yield item
+                pending += separator
+            if pending:
+                yield SSEEvent.DATA, pending
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
@@ -0,0 +1,45 @@
+import inspect
+import time
+from contextlib import aclosing
+from typing import Any, AsyncGenerator, Awaitable, Callable, Dict, List, Tuple, Union
+
+from prometheus_client import Histogram
+
+from app.models.sse import SSEEvent
+
+step_duration = Histogram(
+    "rewrite_pipeline_step_seconds",
+    "Duration of the steps of native rewrite pipelines",
+    ["pipeline", "step"],
+    buckets=(.05, .1, .25, .5, 1, 2, 3, 5, 7.5, 10, 20, 30)
+)
+
+PipelineState = Dict[str, Any]
+PipelineStep = Callable[[PipelineState], Union[AsyncGenerator[Tuple[SSEEvent, str], None], Awaitable[None]]]
+
+
+class StepPipeline:
+    """
+    Runs its steps in order on a shared state, each step reads the outputs of the previous ones from it
+    and adds its own. Steps are coroutines, or async generators of the SSE events they produce on the way,
+    which are streamed to the caller as they come.
+
+    Unlike a LangChain chain consumed through `astream_events`, no callback events are created
+    for steps or tokens, the only per-token work is what the steps do themselves.
+    """
+
+    def __init__(self, name: str, steps: List[Tuple[str, PipelineStep]]):
+        self.name = name
+        self.steps = steps
+
+    async def run(self, state: PipelineState) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        for step_name, step in self.steps:
+            started = time.perf_counter()
+            result = step(state)
+            if inspect.isawaitable(result):
+                await result
+            else:
+                async with aclosing(result) as events:
+                    async for event in events:
+                        yield event
+            step_duration.labels(pipeline=self.name, step=step_name).observe(time.perf_counter() - started)
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import unicodedata
+from typing import List, Optional, Tuple
+
+import structlog
+from prometheus_client import Counter
+
+from app.models.completion import RephraseRequest
+from app.depends.llm import get_llm_models_version
+from app.models.config import RewriteCacheConfig
+from app.models.sse import SSEEvent
+from app.services.cache.base import BaseCacheService
+from app.services.rewrite.actions.base import BaseRephraseAction
+from app.settings import settings
+
+logger = structlog.get_logger(__name__)
+
+cache_requests = Counter(
+    "rewrite_cache_requests_total",
+    "Rewrite result cache lookups",
+    ["task_type", "result"]
+)
+
+
+class RewriteResultCache:
+    """
+    Caches the full event sequence of deterministic rewrites (first rewrite of a text, no prev_rewrites),
+    so repeated requests for the same text can be replayed without calling the LLM.
+    """
+    _cache_key = 'rewrite:result'
+
+    def __init__(self, cache: BaseCacheService, config: Optional[RewriteCacheConfig] = None):
+        self.cache = cache
+        self.config = config or settings.rewrite_cache_config
+        self.prompt_version = self.config.prompt_version or hashlib.sha256(
+            settings.prompts.model_dump_json().encode()
+        ).hexdigest()[:12]
+        self.models_version = self.config.models_version or get_llm_models_version()
+
+    @staticmethod
+    def _normalize_text(text: str) -> str:
+        return unicodedata.normalize("NFC", text).strip()
+
+    def get_key(self, rephrase_request: RephraseRequest, action: BaseRephraseAction) -> str | None:
+        """Returns the cache key for the request, or None if the request shouldn't be cached"""
+        if not self.config.enabled or rephrase_request.prev_rewrites:
+            return None
+        if rephrase_request.completion_task_type.value not in self.config.task_types:
+            return None
+        text = self._normalize_text(rephrase_request.text)
+        if not text or len(text) > self.config.max_text_length:
+            return None
+        digest = hashlib.sha256(json.dumps([
+            rephrase_request.completion_task_type.value,
+            text,
+            action._get_locale_mapping(rephrase_request.locale) if rephrase_request.locale else None,
+            self.models_version,
+            self.prompt_version,
+            action.base_temperature,
+        ]).encode()).hexdigest()
+        return f'{self._cache_key}:{digest}'
+
+    async def get(self, key: str, task_type: str) -> List[Tuple[SSEEvent, str]] | None:
+        try:
+            cached = await self.cache.get(key)
+        except Exception as e:
+            logger.warning("Failed to read rewrite cache", error=str(e))
+            cached = None
+        if cached is None:
+            cache_requests.labels(task_type=task_type, result="miss").inc()
+            return None
+        cache_requests.labels(task_type=task_type, result="hit").inc()
+        return [(SSEEvent(event), content) for event, content in json.loads(cached)]
+
+    async def set(self, key: str, chunks: List[Tuple[SSEEvent, str]]):
+        if not chunks:
+            return
+        value = json.dumps([
+            (event.value if isinstance(event, SSEEvent) else event, content) for event, content in chunks
+        ])
+        try:
+            await self.cache.set(key, value, ttl=self.config.ttl)
+        except Exception as e:
+            logger.warning("Failed to write rewrite cache", error=str(e))
@@ -1,31 +1,54 @@
 import asyncio
-from typing import Dict, Optional, AsyncGenerator
+import json
+from contextlib import aclosing
+from typing import Dict, Optional, AsyncGenerator, Tuple, List
 
 import sentry_sdk
 import structlog
+from prometheus_client import Counter
 
 from app.models.completion import RephraseTaskType, RephraseRequest
 from app.models.sse import SSEEvent
-from app.services.llm.anthropic_service import AnthropicService
-from app.services.llm.openai_service import AsyncOpenAIService
+from app.depends.llm import get_llm_service
 from app.services.rewrite.actions.advanced_improve_writing_action import AdvancedImproveAction
 from app.services.rewrite.actions.base import BaseRephraseAction, ActionFailed
 from app.services.rewrite.actions.concise_action import ConciseAction
 from app.services.rewrite.actions.improve_writing_action import ImproveWritingAction
 from app.services.rewrite.actions.proofread_action import ProofreadAction
+from app.services.rewrite.batching import ChunkBatcher
+from app.services.rewrite.chunked import ChunkedRewriter
+from app.services.rewrite.result_cache import RewriteResultCache
+from app.services.rewrite.scheduler import LLMSlotScheduler, SchedulerLane
+from app.services.rewrite.single_flight import SingleFlight
+from app.services.cache.redis_cache import RedisCacheService
 from app.services.usage.free_tier_usage.base import BaseFreeTierUsageService
-from app.settings import LLMProvider, settings
+from app.settings import settings
+from app.utils.stage_timer import StageTimer
+from app.utils.tokens import estimate_token_count
 
 logger = structlog.get_logger(__name__)
 
+cancelled_streams = Counter(
+    "rewrite_cancelled_streams_total",
+    "Upstream rewrite streams cancelled because all of their clients disconnected",
+    ["task_type"]
+)
+cancelled_tokens_saved = Counter(
+    "rewrite_cancelled_tokens_saved_total",
+    "Estimated completion tokens not generated thanks to cancelled upstream streams",
+    ["task_type"]
+)
+
 
 class UnsupportedRewriteAction(Exception):
     pass
 
 
 class RewriteManager:
-    llm_service = AsyncOpenAIService() if settings.llm_provider == LLMProvider.OPENAI.value else AnthropicService()
+    llm_service = get_llm_service()
     actions_mapping: Dict[RephraseTaskType, BaseRephraseAction] = {}
+    single_flight: SingleFlight[Tuple[SSEEvent, str]] = SingleFlight()
+    scheduler = LLMSlotScheduler()
 
     @classmethod
     def _init_actions_mapping(cls):
@@ -39,20 +62,21 @@ class RewriteManager:
             RephraseTaskType.REPHRASE: ImproveWritingAction( # TODO: Remove this deprecated action
                 llm_service=cls.llm_service,
             ),
-            RephraseTaskType.ADVANCED_IMPROVE: AdvancedImproveAction()
+            RephraseTaskType.ADVANCED_IMPROVE: AdvancedImproveAction(
+                llm_service=cls.llm_service,
+            )
         }
         return actions_mapping
 
     def __init__(
             self,
             usage_service: Optional[BaseFreeTierUsageService] = None,
-            initial_sleep: Optional[float] = 5,
-            streaming_sleep: Optional[float] = 0.5,
-            sse_formatting: Optional[bool] = True
+            sse_formatting: Optional[bool] = True,
+            result_cache: Optional[RewriteResultCache] = None
     ):
         self.usage_service = usage_service
-        self._initial_sleep = initial_sleep
-        self._streaming_sleep = streaming_sleep
+        self.result_cache = result_cache or RewriteResultCache(cache=RedisCacheService())
+        self.chunked_rewriter = ChunkedRewriter()
         self._sse_formatting = sse_formatting
         if not self.actions_mapping:
             self.actions_mapping = self._init_actions_mapping()
@@ -79,49 +103,287 @@ class RewriteManager:
             "event": SSEEvent.THROTTLE.value
         }
 
-    async def rewrite(self, rephrase_request: RephraseRequest) -> AsyncGenerator[str, None]:
-        logger.info("Rewriting", task_type=rephrase_request.completion_task_type)
-        if self.usage_service:
-            try:
-                is_user_allowed = await self.usage_service.is_user_allowed(user_id=rephrase_request.uid)
-            except Exception as e:
-                logger.error("Usage service failed", error=str(e))
-                sentry_sdk.capture_exception(e)
-                is_user_allowed = True
-        else:
-            is_user_allowed = True
-
-        if not is_user_allowed:
-            logger.debug("User not allowed", user_id=rephrase_request.uid)
-            yield self._sse_throttle()
-            await asyncio.sleep(self._initial_sleep)
-
-        action = self.actions_mapping.get(rephrase_request.completion_task_type)
-        if not action:
-            raise UnsupportedRewriteAction(
-                f"Unsupported task type {rephrase_request.completion_task_type}"
-            )
+    async def _get_lane(self, user_id: str) -> SchedulerLane:
+        if not self.usage_service:
+            return SchedulerLane.FREE
+        try:
+            is_user_premium, is_user_allowed = await self.usage_service.get_user_access(user_id=user_id)
+            if is_user_premium:
+                return SchedulerLane.PREMIUM
+        except Exception as e:
+            logger.error("Usage service failed", error=str(e))
+            sentry_sdk.capture_exception(e)
+            return SchedulerLane.FREE
+        return SchedulerLane.FREE if is_user_allowed else SchedulerLane.THROTTLED
 
+    async def _rewrite_text(
+            self,
+            action: BaseRephraseAction,
+            rephrase_request: RephraseRequest,
+            text: str,
+            prev_rewrites: Optional[List[str]]
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        has_output = False
         try:
-            async for event, sse_chunk in action.perform(rephrase_request.text, prev_rewrites=rephrase_request.prev_rewrites, locale=rephrase_request.locale):
-                yield self._format_content(event, sse_chunk)
-                if not is_user_allowed:
-                    await asyncio.sleep(self._streaming_sleep)
+            events = action.perform(text, prev_rewrites=prev_rewrites, locale=rephrase_request.locale)
+            async with aclosing(events):
+                async for event, sse_chunk in events:
+                    has_output = has_output or event == SSEEvent.DATA
+                    yield event, sse_chunk
         except ActionFailed as e:
             sentry_sdk.capture_exception(e)
-            logger.error("Action failed", error=str(e))
+            logger.error("Action failed", error=str(e), has_output=has_output)
+            if has_output:
+                # the client already has part of the rewrite, generating it again would duplicate it
+                yield SSEEvent.ERROR, "rewrite failed"
             # Fallback to improve writing action
-            if e.type == RephraseTaskType.ADVANCED_IMPROVE:
+            elif e.type == RephraseTaskType.ADVANCED_IMPROVE:
                 fallback_action = ImproveWritingAction(
                     llm_service=self.llm_service
                 )
-                async for event, sse_chunk in fallback_action.perform(rephrase_request.text, prev_rewrites=rephrase_request.prev_rewrites):
-                    yield self._format_content(event, sse_chunk)
+                events = fallback_action.perform(text, prev_rewrites=prev_rewrites)
+                async with aclosing(events):
+                    async for event, sse_chunk in events:
+                        yield event, sse_chunk
             else:
                 raise e
 
+    async def _in_slot(
+            self,
+            lane: SchedulerLane,
+            events: AsyncGenerator[Tuple[SSEEvent, str], None]
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        """Streams the events of one upstream rewrite once it got a scheduler slot, which it holds until done"""
+        async with aclosing(events):
+            async with self.scheduler.slot(lane):
+                async for event, sse_chunk in events:
+                    yield event, sse_chunk
+
+    async def _perform_action(
+            self,
+            action: BaseRephraseAction,
+            rephrase_request: RephraseRequest,
+            lane: SchedulerLane
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        chunked = self.chunked_rewriter.split(rephrase_request)
+        if chunked:
+            leading, chunks = chunked
+            # previous rewrites are of the whole text and don't map to its chunks,
+            # repeating them in every chunk's prompt would multiply the prompt by the number of chunks
+            # each chunk opens its own upstream stream, so it waits for a slot of its own
+            events = self.chunked_rewriter.perform(
+                leading,
+                chunks,
+                lambda chunk: self._in_slot(lane, self._rewrite_text(action, rephrase_request, chunk, prev_rewrites=None))
+            )
+        else:
+            events = self._in_slot(
+                lane,
+                self._rewrite_text(action, rephrase_request, rephrase_request.text, rephrase_request.prev_rewrites)
+            )
+
+        emitted_chars = 0
+        try:
+            async with aclosing(events):
+                async for event, sse_chunk in events:
+                    if event == SSEEvent.DATA:
+                        emitted_chars += len(sse_chunk)
+                    yield event, sse_chunk
+                    if event == SSEEvent.ERROR:
+                        # the rewrite can't be completed, remaining chunks are cancelled
+                        break
+        except (asyncio.CancelledError, GeneratorExit):
+            # output is expected to be roughly as long as the input for all rewrite actions
+            tokens_saved = estimate_token_count(rephrase_request.text[emitted_chars:])
+            logger.info("Upstream rewrite cancelled", task_type=rephrase_request.completion_task_type, tokens_saved=tokens_saved)
+            cancelled_streams.labels(task_type=rephrase_request.completion_task_type.value).inc()
+            cancelled_tokens_saved.labels(task_type=rephrase_request.completion_task_type.value).inc(tokens_saved)
+            raise
+
+    async def _perform_and_cache(
+            self,
+            action: BaseRephraseAction,
+            rephrase_request: RephraseRequest,
+            lane: SchedulerLane,
+            cache_key: Optional[str]
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        chunks = []
+        async with aclosing(self._perform_action(action, rephrase_request, lane)) as events:
+            async for event, sse_chunk in events:
+                if event == SSEEvent.ERROR:
+                    cache_key = None
+                if cache_key:
+                    chunks.append((event, sse_chunk))
+                yield event, sse_chunk
+
+        if cache_key:
+            await self.result_cache.set(cache_key, chunks)
+
+    @staticmethod
+    def _single_flight_key(rephrase_request: RephraseRequest, lane: SchedulerLane) -> Tuple:
+        # the flight runs in its leader's lane, premium requests mustn't wait behind a throttled leader
+        return (
+            lane,
+            rephrase_request.completion_task_type,
+            rephrase_request.text,
+            rephrase_request.locale,
+            tuple(rephrase_request.prev_rewrites or ()),
+        )
+
+    async def _perform(
+            self,
+            action: BaseRephraseAction,
+            rephrase_request: RephraseRequest,
+            lane: SchedulerLane
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        local_result = action.perform_locally(
+            rephrase_request.text,
+            prev_rewrites=rephrase_request.prev_rewrites,
+            locale=rephrase_request.locale
+        )
+        if local_result is not None:
+            yield SSEEvent.DATA, local_result
+            return
+
+        cache_key = self.result_cache.get_key(rephrase_request, action)
+        if cache_key:
+            cached = await self.result_cache.get(cache_key, rephrase_request.completion_task_type.value)
+            if cached is not None:
+                logger.debug("Replaying cached rewrite", task_type=rephrase_request.completion_task_type)
+                for event, sse_chunk in cached:
+                    yield event, sse_chunk
+                return
+
+        if settings.single_flight_enabled:
+            stream = self.single_flight.stream(
+                self._single_flight_key(rephrase_request, lane),
+                lambda: self._perform_and_cache(action, rephrase_request, lane, cache_key)
+            )
+        else:
+            stream = self._perform_and_cache(action, rephrase_request, lane, cache_key)
+        async with aclosing(stream):
+            async for event, sse_chunk in stream:
+                yield event, sse_chunk
+
+    def _get_action(self, task_type: RephraseTaskType) -> BaseRephraseAction:
+        action = self.actions_mapping.get(task_type)
+        if not action:
+            raise UnsupportedRewriteAction(
+                f"Unsupported task type {task_type}"
+            )
+        return action
+
+    async def _stream(
+            self,
+            rephrase_request: RephraseRequest,
+            lane: SchedulerLane
+    ) -> AsyncGenerator[Tuple[SSEEvent, str], None]:
+        action = self._get_action(rephrase_request.completion_task_type)
+        batcher = ChunkBatcher(task_type=rephrase_request.completion_task_type.value)
+        async with aclosing(batcher.batch(self._perform(action, rephrase_request, lane))) as events:
+            async for event, sse_chunk in events:
+                yield event, sse_chunk
+
+    @staticmethod
+    def _start_timer(rephrase_request: RephraseRequest) -> StageTimer:
+        return StageTimer.start(
+            task_type=rephrase_request.completion_task_type.value,
+            provider=settings.llm_provider.value,
+            locale=BaseRephraseAction._get_locale_mapping(rephrase_request.locale)
+        )
+
+    async def rewrite(self, rephrase_request: RephraseRequest) -> AsyncGenerator[str, None]:
+        logger.info("Rewriting", task_type=rephrase_request.completion_task_type)
+        timer = self._start_timer(rephrase_request)
+        lane = await self._get_lane(rephrase_request.uid)
+        timer.mark_usage_checked()
+        if lane == SchedulerLane.THROTTLED:
+            logger.debug("User not allowed", user_id=rephrase_request.uid)
+            yield self._sse_throttle()
+
+        failed = False
+        try:
+            async with aclosing(self._stream(rephrase_request, lane)) as events:
+                async for event, sse_chunk in events:
+                    if event == SSEEvent.DATA:
+                        timer.mark_chunk_sent()
+                    failed = failed or event == SSEEvent.ERROR
+                    yield self._format_content(event, sse_chunk)
+        except (asyncio.CancelledError, GeneratorExit):
+            logger.info("Client disconnected, rewrite cancelled", task_type=rephrase_request.completion_task_type)
+            raise
+        timer.finish_stream()
+
         if self._sse_formatting:
             yield self._sse_end_of_stream()
 
-        if self.usage_service:
-            await self.usage_service.update_user_usage(user_id=rephrase_request.uid, usage_delta=1)
+        if self.usage_service and not failed:
+            with timer.measure("usage_update"):
+                await self.usage_service.update_user_usage(user_id=rephrase_request.uid, usage_delta=1)
+
+    @staticmethod
+    def _format_batch_content(index: int, event: SSEEvent, content: str):
+        return {
+            "data": json.dumps({"index": index, "data": content}),
+            "event": event.value
+        }
+
+    async def rewrite_batch(self, rephrase_requests: List[RephraseRequest]) -> AsyncGenerator[Dict[str, str], None]:
+        """
+        Rewrites all requests of one user concurrently and multiplexes them into one SSE stream.
+        Events of each request are tagged with its index, every request ends with its own eos (or error) event
+        and the whole batch with an untagged eos. Usage is checked and updated once for the whole batch.
+        """
+        user_id = rephrase_requests[0].uid
+        logger.info("Rewriting batch", size=len(rephrase_requests))
+        lane = await self._get_lane(user_id)
+        if lane == SchedulerLane.THROTTLED:
+            logger.debug("User not allowed", user_id=user_id)
+            yield self._sse_throttle()
+
+        semaphore = asyncio.Semaphore(settings.batch_rewrite_config.max_concurrency)
+        events: asyncio.Queue[Tuple[int, SSEEvent, str]] = asyncio.Queue()
+        completed = 0
+
+        async def worker(index: int, rephrase_request: RephraseRequest):
+            nonlocal completed
+            # every worker runs in its own task, so each request of the batch gets its own timer
+            timer = self._start_timer(rephrase_request)
+            try:
+                async with semaphore:
+                    async with aclosing(self._stream(rephrase_request, lane)) as stream:
+                        async for event, sse_chunk in stream:
+                            if event == SSEEvent.DATA:
+                                timer.mark_chunk_sent()
+                            events.put_nowait((index, event, sse_chunk))
+                            if event == SSEEvent.ERROR:
+                                # already the final event of this request
+                                return
+                    timer.finish_stream()
+                completed += 1
+                events.put_nowait((index, SSEEvent.EOS, "end of stream"))
+            except Exception as e:
+                logger.error("Batch rewrite failed", index=index, error=str(e))
+                sentry_sdk.capture_exception(e)
+                events.put_nowait((index, SSEEvent.ERROR, "rewrite failed"))
+
+        workers = [asyncio.create_task(worker(index, request)) for index, request in enumerate(rephrase_requests)]
+        try:
+            remaining = len(workers)
+            while remaining:
+                index, event, sse_chunk = await events.get()
+                if event in (SSEEvent.EOS, SSEEvent.ERROR):
+                    remaining -= 1
+                yield self._format_batch_content(index, event, sse_chunk)
+        except (asyncio.CancelledError, GeneratorExit):
+            logger.info("Client disconnected, batch rewrite cancelled")
+            raise
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        yield self._sse_end_of_stream()
+
+        if self.usage_service and completed:
+            await self.usage_service.update_user_usage(user_id=user_id, usage_delta=completed)
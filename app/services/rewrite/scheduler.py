@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import Enum
+from typing import Deque, Dict, Optional
+
+import structlog
+from prometheus_client import Gauge, Histogram
+
+from app.models.config import LLMSchedulerConfig
+from app.settings import settings
+
+logger = structlog.get_logger(__name__)
+
+
+class SchedulerLane(str, Enum):
+    PREMIUM = "premium"
+    FREE = "free"
+    THROTTLED = "throttled"     # free users over their quota
+
+
+queue_depth = Gauge(
+    "llm_scheduler_queue_depth",
+    "Requests waiting for an upstream LLM slot",
+    ["lane"]
+)
+queue_wait = Histogram(
+    "llm_scheduler_wait_seconds",
+    "Time spent waiting for an upstream LLM slot, including the throttling delay",
+    ["lane"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 7.5, 10, 15, 30, 60)
+)
+slots_in_use = Gauge(
+    "llm_scheduler_slots_in_use",
+    "Upstream LLM slots currently taken",
+    ["lane"]
+)
+
+
+class LLMSlotScheduler:
+    """
+    Bounded pool of upstream LLM slots with weighted priority lanes.
+
+    Freed slots are handed out by stride scheduling, so every lane with waiters is served
+    proportionally to its weight. Part of the pool is reserved for premium users, which keeps
+    their latency flat even when free users saturate the rest.
+    """
+
+    def __init__(self, config: Optional[LLMSchedulerConfig] = None):
+        self.config = config or settings.llm_scheduler_config
+        self._weights: Dict[SchedulerLane, int] = {
+            SchedulerLane.PREMIUM: self.config.premium_weight,
+            SchedulerLane.FREE: self.config.free_weight,
+            SchedulerLane.THROTTLED: self.config.throttled_weight,
+        }
+        self._waiters: Dict[SchedulerLane, Deque[asyncio.Future]] = {lane: deque() for lane in SchedulerLane}
+        self._pass: Dict[SchedulerLane, float] = {lane: 0. for lane in SchedulerLane}
+        self._virtual_time = 0.
+        self._in_use: Dict[SchedulerLane, int] = {lane: 0 for lane in SchedulerLane}
+
+    @property
+    def in_use(self) -> int:
+        return sum(self._in_use.values())
+
+    def _can_take(self, lane: SchedulerLane) -> bool:
+        if self.in_use >= self.config.max_concurrency:
+            return False
+        if lane == SchedulerLane.PREMIUM:
+            return True
+        shared_in_use = self.in_use - self._in_use[SchedulerLane.PREMIUM]
+        return shared_in_use < self.config.max_concurrency - self.config.premium_reserved_slots
+
+    def _take(self, lane: SchedulerLane):
+        self._in_use[lane] += 1
+        slots_in_use.labels(lane=lane.value).inc()
+
+    def _release(self, lane: SchedulerLane):
+        self._in_use[lane] -= 1
+        slots_in_use.labels(lane=lane.value).dec()
+        self._wake()
+
+    def _wake(self):
+        while True:
+            lanes = [lane for lane, waiters in self._waiters.items() if waiters and self._can_take(lane)]
+            if not lanes:
+                return
+            lane = min(lanes, key=lambda l: self._pass[l])
+            self._virtual_time = self._pass[lane]
+            self._pass[lane] += 1 / self._weights[lane]
+            waiter = self._waiters[lane].popleft()
+            queue_depth.labels(lane=lane.value).dec()
+            self._take(lane)
+            waiter.set_result(None)
+
+    async def _acquire(self, lane: SchedulerLane):
+        if not self._waiters[lane] and self._can_take(lane):
+            self._take(lane)
+            return
+
+        if not self._waiters[lane]:
+            # a lane coming back from idle doesn't get credit for the time it wasn't waiting
+            self._pass[lane] = max(self._pass[lane], self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        queue_depth.labels(lane=lane.value).inc()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # slot was handed over just before the cancellation
+                self._release(lane)
+            else:
+                self._waiters[lane].remove(waiter)
+                queue_depth.labels(lane=lane.value).dec()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, lane: SchedulerLane):
+        start = time.monotonic()
+        if lane == SchedulerLane.THROTTLED and self.config.throttled_delay:
+            await asyncio.sleep(self.config.throttled_delay)
+        await self._acquire(lane)
+        queue_wait.labels(lane=lane.value).observe(time.monotonic() - start)
+        try:
+            yield
+        finally:
+            self._release(lane)
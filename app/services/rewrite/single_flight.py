@@ -0,0 +1,104 @@
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Callable, Dict, Generic, Hashable, List, Optional, TypeVar
+
+import structlog
+from prometheus_client import Counter, Gauge
+
+logger = structlog.get_logger(__name__)
+
+T = TypeVar("T")
+
+flight_requests = Counter(
+    "rewrite_single_flight_requests_total",
+    "Rewrite streams by single-flight role, followers share the leader's upstream stream",
+    ["role"]
+)
+flights_in_progress = Gauge(
+    "rewrite_single_flight_in_progress",
+    "Upstream streams currently shared by single-flight"
+)
+
+
+class FlightCancelled(Exception):
+    """The upstream stream was cancelled because all of its subscribers left"""
+
+
+class _Flight(Generic[T]):
+    """One upstream stream, buffered so that late subscribers receive the whole sequence"""
+
+    def __init__(self, source: AsyncIterator[T], on_done: Callable[[], None]):
+        self.buffer: List[T] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self._on_done = on_done
+        self.task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source: AsyncIterator[T]):
+        flights_in_progress.inc()
+        try:
+            async for item in source:
+                async with self._changed:
+                    self.buffer.append(item)
+                    self._changed.notify_all()
+        except asyncio.CancelledError:
+            # subscribers that joined before the flight was removed mustn't take the partial buffer as complete
+            self.error = self.error or FlightCancelled("Upstream stream cancelled")
+            raise
+        except BaseException as e:
+            self.error = e
+        finally:
+            flights_in_progress.dec()
+            self._on_done()
+            async with self._changed:
+                self.done = True
+                self._changed.notify_all()
+
+    async def subscribe(self) -> AsyncGenerator[T, None]:
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(lambda: position < len(self.buffer) or self.done)
+                # buffer is append-only, so everything before its current length can be yielded without the lock
+                while position < len(self.buffer):
+                    yield self.buffer[position]
+                    position += 1
+                if self.done and position == len(self.buffer):
+                    break
+            if self.error:
+                raise self.error
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                logger.debug("All single-flight subscribers left, cancelling upstream stream")
+                # removed right away, so that new requests start their own flight instead of joining this one
+                self._on_done()
+                self.error = FlightCancelled("All subscribers left")
+                self.task.cancel()
+
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesces identical concurrent streams: the first caller for a key starts the upstream stream,
+    later callers with the same key subscribe to it and receive the already buffered prefix first.
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight[T]] = {}
+
+    def stream(self, key: Hashable, source_factory: Callable[[], AsyncIterator[T]]) -> AsyncGenerator[T, None]:
+        flight = self._flights.get(key)
+        if flight is None:
+            flight_requests.labels(role="leader").inc()
+            flight = _Flight(source_factory(), on_done=lambda: self._remove(key, flight))
+            self._flights[key] = flight
+        else:
+            flight_requests.labels(role="follower").inc()
+        return flight.subscribe()
+
+    def _remove(self, key: Hashable, flight: "_Flight[T]"):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
@@ -0,0 +1,138 @@
+import asyncio
+import gzip
+import pathlib
+import re
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+import structlog
+from prometheus_client import Counter
+
+from app.models.config import SpellingConfig
+from app.services.spelling.symspell import SymSpell
+from app.settings import settings
+from app.utils.singleton import Singleton
+
+logger = structlog.get_logger(__name__)
+
+spelling_requests = Counter(
+    "spelling_fast_path_total",
+    "Single word spelling requests, answered locally or handed over to the LLM",
+    ["result"]
+)
+
+_data_dir = pathlib.Path(__file__).parent / "data"
+_word_re = re.compile(r"^(\W*)([A-Za-z]+)(\W*)$")
+
+
+class SpellingCorrector(metaclass=Singleton):
+    """
+    In-process corrector for single words, so fixing the spelling of one word doesn't need an LLM round trip.
+    Only confident corrections are returned, everything else is left to the LLM.
+    The dictionary is loaded in a background thread on first use, until then all requests fall back.
+    """
+
+    def __init__(self):
+        self.config: SpellingConfig = settings.spelling_config
+        self._symspell: Optional[SymSpell] = None
+        self._us_to_gb: Dict[str, str] = {}
+        self._gb_to_us: Dict[str, str] = {}
+        self._capitalized: Set[str] = set()
+        self._load_lock = threading.Lock()
+        self._loading = False
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._symspell is not None
+
+    def _load(self):
+        with self._load_lock:
+            if self._symspell is not None:
+                return
+            symspell = SymSpell(max_edit_distance=self.config.max_edit_distance)
+            with gzip.open(_data_dir / "frequency_dictionary_en_82_765.txt.gz", "rt", encoding="utf-8") as f:
+                symspell.load((word, int(count)) for word, count in (line.split() for line in f))
+            with open(_data_dir / "variants_en.tsv", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith("#") or not line.strip():
+                        continue
+                    us, gb = line.split()
+                    self._us_to_gb[us] = gb
+                    self._gb_to_us[gb] = us
+            with open(_data_dir / "capitalized_en.txt", encoding="utf-8") as f:
+                self._capitalized = {line.strip() for line in f if line.strip() and not line.startswith("#")}
+            self._symspell = symspell
+            logger.info("Spelling dictionary loaded")
+
+    def _load_in_background(self):
+        if self._loading:
+            return
+        self._loading = True
+
+        async def load():
+            try:
+                await asyncio.to_thread(self._load)
+            except Exception as e:
+                logger.error("Failed to load spelling dictionary", error=str(e))
+            finally:
+                self._loading = False
+
+        # noinspection PyAsyncCall
+        asyncio.get_running_loop().create_task(load())
+
+    def _apply_locale(self, word: str, mapped_locale: str) -> str:
+        if mapped_locale in ("en_GB", "en_AU"):
+            return self._us_to_gb.get(word, word)
+        return self._gb_to_us.get(word, word)
+
+    def _capitalize(self, word: str) -> str:
+        return word[0].upper() + word[1:] if word in self._capitalized else word
+
+    def _best_correction(self, word: str) -> Tuple[str, bool]:
+        """Returns the best correction of a lowercase word and whether it is confident enough"""
+        if word in self._symspell:
+            count = self._symspell.count(word)
+            if count < self.config.min_word_count:
+                return word, False
+            # a word much rarer than a neighbour (cant, wat, calender) is likely a typo of it
+            neighbours = self._symspell.lookup(word, max_distance=1, skip_term=True)
+            return word, not neighbours or count * self.config.min_dominance >= neighbours[0].count
+        # short words are often abbreviations (thx, pls), names and jargon (async) are just missing
+        # from the dictionary, only a typo of a frequent word at distance 1 is trusted
+        if len(word) < self.config.min_typo_length:
+            return word, False
+        suggestions = self._symspell.lookup(word)
+        if not suggestions or suggestions[0].distance != 1:
+            return word, False
+        best = suggestions[0]
+        # typos rarely hit the first letter, dropping or changing it makes another word (async, sync)
+        if best.term[0] != word[0]:
+            return best.term, False
+        return best.term, len(suggestions) == 1 or best.count >= suggestions[1].count * self.config.min_dominance
+
+    def correct(self, text: str, mapped_locale: str) -> Optional[str]:
+        """Corrected single word text, or None if the LLM should handle it"""
+        if not self.config.enabled:
+            return None
+        if not self.is_loaded:
+            self._load_in_background()
+            spelling_requests.labels(result="not_loaded").inc()
+            return None
+
+        match = _word_re.match(text.strip())
+        if not match:
+            spelling_requests.labels(result="fallback").inc()
+            return None
+        prefix, word, suffix = match.groups()
+        # capitalized words are mostly names, acronyms and brands the dictionary doesn't know
+        if not word.islower():
+            spelling_requests.labels(result="fallback").inc()
+            return None
+        correction, is_confident = self._best_correction(word)
+        if not is_confident:
+            spelling_requests.labels(result="fallback").inc()
+            return None
+
+        spelling_requests.labels(result="hit").inc()
+        correction = self._apply_locale(correction, mapped_locale)
+        return prefix + self._capitalize(correction) + suffix
@@ -0,0 +1,142 @@
+from array import array
+from dataclasses import dataclass
+from itertools import repeat
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+
+@dataclass
+class Suggestion:
+    term: str
+    distance: int
+    count: int
+
+
+def _deletes_by_distance(word: str, max_distance: int) -> List[Set[str]]:
+    """Strings created by deleting characters from word, grouped by the number of deleted characters"""
+    levels = [{word}]
+    seen = {word}
+    for _ in range(max_distance):
+        level = {candidate[:i] + candidate[i + 1:] for candidate in levels[-1] for i in range(len(candidate))}
+        level -= seen
+        seen |= level
+        levels.append(level)
+    return levels
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Optimal string alignment (restricted Damerau-Levenshtein) distance, max_distance + 1 if larger"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    # common prefix and suffix don't change the distance
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+    if not a or not b:
+        return len(a) + len(b) if len(a) + len(b) <= max_distance else max_distance + 1
+    previous_previous: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+class SymSpell:
+    """
+    Symmetric delete spelling correction (https://github.com/wolfgarbe/SymSpell).
+
+    Deletes of every dictionary word's prefix are precomputed, a lookup generates deletes of the input
+    and intersects them with the index, so only a handful of candidates need a real edit distance.
+    The index is kept as sorted numpy arrays (delete hash -> word id, delete level) instead of a dict of lists,
+    about 26 MB for the full English dictionary (2M deletes), next to the words themselves.
+    """
+
+    def __init__(self, max_edit_distance: int = 2, prefix_length: int = 7):
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self._counts: Dict[str, int] = {}
+        self._words: List[str] = []
+        self._lengths = np.empty(0, dtype=np.int16)
+        self._hashes = np.empty(0, dtype=np.int64)
+        self._word_ids = np.empty(0, dtype=np.int32)
+        self._delete_levels = np.empty(0, dtype=np.int8)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self._counts
+
+    def count(self, word: str) -> int:
+        return self._counts.get(word, 0)
+
+    def load(self, entries: Iterable[Tuple[str, int]]):
+        # typed buffers hold the raw values, a list would keep a Python int object per delete
+        hashes = array("q")
+        word_ids = array("i")
+        delete_levels = array("b")
+        for word, count in entries:
+            if word in self._counts:
+                continue
+            self._counts[word] = count
+            word_id = len(self._words)
+            self._words.append(word)
+            for level, deletes in enumerate(_deletes_by_distance(word[:self.prefix_length], self.max_edit_distance)):
+                hashes.extend(map(hash, deletes))
+                word_ids.extend(repeat(word_id, len(deletes)))
+                delete_levels.extend(repeat(level, len(deletes)))
+
+        hashes_array = np.frombuffer(hashes, dtype=np.int64)
+        order = np.argsort(hashes_array, kind="stable")
+        self._hashes = hashes_array[order]
+        self._word_ids = np.frombuffer(word_ids, dtype=np.int32)[order]
+        self._delete_levels = np.frombuffer(delete_levels, dtype=np.int8)[order]
+        self._lengths = np.fromiter((len(word) for word in self._words), dtype=np.int16, count=len(self._words))
+
+    def lookup(self, term: str, max_distance: int | None = None, skip_term: bool = False) -> List[Suggestion]:
+        """
+        Dictionary words with the smallest edit distance to term (up to max_distance), most frequent first.
+        With `skip_term`, the term itself isn't a suggestion, so its closest neighbours are returned.
+        """
+        best_distance = self.max_edit_distance if max_distance is None else min(max_distance, self.max_edit_distance)
+        suggestions: List[Suggestion] = []
+        seen: Set[int] = set()
+        # a word within distance d shares a string with the term that both reach with at most d deletes,
+        # so deletes of more than the best distance found so far (on either side) can be skipped
+        for deleted, deletes in enumerate(_deletes_by_distance(term[:self.prefix_length], best_distance)):
+            if deleted > best_distance:
+                break
+            for delete in deletes:
+                key = hash(delete)
+                start = np.searchsorted(self._hashes, key, side="left")
+                end = np.searchsorted(self._hashes, key, side="right")
+                if start == end:
+                    continue
+                word_ids = self._word_ids[start:end][self._delete_levels[start:end] <= best_distance]
+                word_ids = word_ids[np.abs(self._lengths[word_ids] - len(term)) <= best_distance]
+                for word_id in word_ids.tolist():
+                    if word_id in seen:
+                        continue
+                    seen.add(word_id)
+                    word = self._words[word_id]
+                    if skip_term and word == term:
+                        continue
+                    distance = edit_distance(term, word, best_distance)
+                    if distance > best_distance:
+                        continue
+                    if distance < best_distance:
+                        best_distance = distance
+                        suggestions = [s for s in suggestions if s.distance <= distance]
+                    suggestions.append(Suggestion(term=word, distance=distance, count=self._counts[word]))
+        suggestions.sort(key=lambda s: (s.distance, -s.count))
+        return suggestions
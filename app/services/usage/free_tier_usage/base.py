@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import Tuple
 
 
 class BaseFreeTierUsageService(ABC):
@@ -10,6 +11,11 @@ class BaseFreeTierUsageService(ABC):
     async def is_user_allowed(self, user_id: str) -> bool:
         raise NotImplementedError()
 
+    async def get_user_access(self, user_id: str) -> Tuple[bool, bool]:
+        """Whether the user is premium and whether they are allowed to rewrite"""
+        is_premium = await self.is_user_premium(user_id)
+        return is_premium, is_premium or await self.is_user_allowed(user_id)
+
     @abstractmethod
     async def get_user_usage(self, user_id: str) -> int:
         raise NotImplementedError()
@@ -1,6 +1,5 @@
-import asyncio
 import datetime
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 import sentry_sdk
 import structlog
@@ -8,8 +7,11 @@ from postgrest import APIError
 from sentry_sdk import capture_exception
 from supabase import AsyncClient
 
+from app.repository.usage_repository import UsageRepository
 from app.services.cache.base import BaseCacheService
 from app.services.usage.free_tier_usage.base import BaseFreeTierUsageService
+from app.services.usage.free_tier_usage.user_state_cache import UserStateCache
+from app.services.usage.free_tier_usage.write_behind import CounterUpdate, UsageWriteBehindQueue
 from app.settings import settings
 
 logger = structlog.getLogger(__name__)
@@ -20,9 +22,27 @@ class FreeTierUsageServiceWithCache(BaseFreeTierUsageService):
     _cache_premium_key = 'users:premium'
     _max_usage = settings.throttling_config.limit
 
+    # reads the premium flag (KEYS[1]) and usage (KEYS[2]) of a user in one round trip. Returns whether the user
+    # is allowed (1, 0 or -1 when it depends on a missing key), is premium, which of the keys are missing
+    # and the usage (-1 when missing)
+    _check_user_script = """
+local premium = redis.call('GET', KEYS[1])
+local usage = redis.call('GET', KEYS[2])
+-- the premium flag is stored as bytes(bool), empty when the user isn't premium
+local is_premium = premium and premium ~= ''
+local allowed = -1
+if is_premium or (usage and tonumber(usage) < tonumber(ARGV[1])) then
+    allowed = 1
+elseif premium and usage then
+    allowed = 0
+end
+return {allowed, is_premium and 1 or 0, premium and 0 or 1, usage and 0 or 1, usage and tonumber(usage) or -1}
+"""
+
     def __init__(self, cache: BaseCacheService, db: AsyncClient):
         self.cache = cache
         self.db = db
+        self.usage_repository = UsageRepository(db)
 
     def _usage_key(self, user_id: str):
         return f'{self._cache_usage_key}:{user_id}'
@@ -30,6 +50,37 @@ class FreeTierUsageServiceWithCache(BaseFreeTierUsageService):
     def _premium_key(self, user_id: str):
         return f'{self._cache_premium_key}:{user_id}'
 
+    @staticmethod
+    def _parse_premium(user: Dict[str, Any]) -> Tuple[bool, datetime.datetime | None]:
+        is_active = user.get("is_premium", False)
+        valid_until = user.get("premium_until") if is_active else None
+        valid_until = datetime.datetime.fromisoformat(valid_until) if valid_until else None
+        return is_active, valid_until
+
+    @staticmethod
+    def _parse_usage(period_usage: Dict[str, Any] | None) -> Tuple[int, datetime.datetime | None]:
+        if not period_usage:
+            return 0, None
+        time_to = datetime.datetime.fromisoformat(period_usage["time_to"])
+        time_from = datetime.datetime.fromisoformat(period_usage["time_from"])
+
+        if time_from <=  datetime.datetime.now() < time_to :
+            return period_usage["usage"], time_to
+        return 0, None
+
+    @staticmethod
+    def _premium_cache_entry(is_premium: bool, valid_until: datetime.datetime | None) -> Tuple[bytes, int]:
+        valid_ttl = (valid_until - datetime.datetime.now(tz=datetime.timezone.utc)).total_seconds() if valid_until else None
+        if is_premium and valid_ttl:
+            return bytes(is_premium), int(valid_ttl)
+        return bytes(False), 60*60   # Effectively is premium is False, cache for 1 hour. Webhook will update it
+
+    @staticmethod
+    def _usage_cache_entry(usage: int, time_to: datetime.datetime | None) -> Tuple[int, int] | None:
+        if time_to and time_to > datetime.datetime.now():
+            return usage, int((time_to - datetime.datetime.now()).total_seconds())
+        return None
+
     async def _is_user_premium_db(self, user_id: str) -> Tuple[bool, datetime.datetime | None]:
         try:
             resp = await self.db.table("users").select(
@@ -37,10 +88,7 @@ class FreeTierUsageServiceWithCache(BaseFreeTierUsageService):
             ).eq(
                 "id", user_id
             ).single().execute()
-            is_active = resp.data.get("is_premium", False)
-            valid_until = resp.data.get("premium_until") if is_active else None
-            valid_until = datetime.datetime.fromisoformat(valid_until) if valid_until else None
-            return is_active, valid_until
+            return self._parse_premium(resp.data)
         except APIError as e:
             if e.code == "PGRST116":
                 logger.warning("User not found", user_id=user_id)
@@ -51,23 +99,93 @@ class FreeTierUsageServiceWithCache(BaseFreeTierUsageService):
             return False, None
 
     async def is_user_premium(self, user_id: str) -> bool:
+        user_state = UserStateCache()
+        is_premium = user_state.get_premium(user_id)
+        if is_premium is not None:
+            return is_premium
         is_premium = await self.cache.get(self._premium_key(user_id))
         if is_premium is None:
-            is_premium, valid_until = await self._is_user_premium_db(user_id)
-            valid_ttl = (valid_until - datetime.datetime.now(tz=datetime.timezone.utc)).total_seconds() if valid_until else None
-            if is_premium and valid_ttl:
-                await self.cache.set(self._premium_key(user_id), bytes(is_premium), ttl=int(valid_ttl))
-            else:
-                is_premium = False
-                await self.cache.set(self._premium_key(user_id), bytes(is_premium), ttl=60*60)   # Effectively is premium is False, cache for 1 hour. Webhook will update it
+            is_premium, ttl = self._premium_cache_entry(*await self._is_user_premium_db(user_id))
+            await self.cache.set(self._premium_key(user_id), is_premium, ttl=ttl)
+        user_state.set_premium(user_id, bool(is_premium))
         return bool(is_premium)
 
+    async def _get_user_db(self, user_id: str) -> Tuple[bool, datetime.datetime | None, int, datetime.datetime | None]:
+        """Premium status and current period usage of the user, in a single query"""
+        now = datetime.datetime.now().isoformat()
+        try:
+            # the embedded period_usage is filtered down to the current period, the user is returned either way
+            resp = await self.db.table("users").select(
+                "is_premium, premium_until, period_usage(time_from, time_to, usage)"
+            ).eq(
+                "id", user_id
+            ).lte(
+                "period_usage.time_from", now
+            ).gt(
+                "period_usage.time_to", now
+            ).limit(1, foreign_table="period_usage").single().execute()
+            period_usage = resp.data.get("period_usage") or [None]
+            return *self._parse_premium(resp.data), *self._parse_usage(period_usage[0])
+        except APIError as e:
+            if e.code == "PGRST116":
+                logger.warning("User not found", user_id=user_id)
+                return False, None, 0, None
+            capture_exception(e)
+            raise e
+        except BaseException as e:
+            logger.warning("Failed processing user status", user_id=user_id, error=str(e))
+            capture_exception(e)
+            return False, None, 0, None
+
+    async def _check_user(self, user_id: str, need_premium: bool) -> Tuple[bool, bool]:
+        """
+        Whether the user is premium and allowed, from the worker's user state cache when it's enough to decide.
+        Otherwise keys missing from the cache are backfilled from a single db query, only when the decision
+        depends on them (or `need_premium` and the premium flag is missing).
+        """
+        user_state = UserStateCache()
+        cached_premium, cached_usage = user_state.get(user_id)
+        if cached_premium is not None and (cached_premium or cached_usage is not None):
+            return cached_premium, cached_premium or cached_usage < self._max_usage
+        if not need_premium and cached_usage is not None and cached_usage < self._max_usage:
+            return False, True
+
+        premium_key, usage_key = self._premium_key(user_id), self._usage_key(user_id)
+        result = await self.cache.run_script(self._check_user_script, keys=[premium_key, usage_key], args=[self._max_usage])
+        # the cache failed, everything comes from the db
+        allowed, is_premium, premium_missing, usage_missing, usage = result or (-1, 0, 1, 1, -1)
+        if not premium_missing:
+            user_state.set_premium(user_id, bool(is_premium))
+        if not usage_missing:
+            user_state.set_usage(user_id, usage)
+        if allowed != -1 and not (need_premium and premium_missing):
+            return bool(is_premium), bool(allowed)
+
+        db_premium, valid_until, db_usage, time_to = await self._get_user_db(user_id)
+        entries = {}
+        if premium_missing:
+            entries[premium_key] = self._premium_cache_entry(db_premium, valid_until)
+            is_premium = bool(entries[premium_key][0])
+        usage_entry = self._usage_cache_entry(db_usage, time_to)
+        if usage_missing and usage_entry:
+            entries[usage_key] = usage_entry
+        if entries:
+            await self.cache.set_many(entries)
+        if premium_missing:
+            user_state.set_premium(user_id, bool(is_premium))
+        if usage_missing:
+            user_state.set_usage(user_id, db_usage)
+        if allowed == -1:
+            # a cached usage would have decided already if it was below the limit
+            allowed = is_premium or (usage_missing and db_usage < self._max_usage)
+        return bool(is_premium), bool(allowed)
+
     async def is_user_allowed(self, user_id: str) -> bool:
-        premium, usage = await asyncio.gather(
-            self.is_user_premium(user_id),
-            self.get_user_usage(user_id)
-        )
-        return premium or usage < self._max_usage
+        _, allowed = await self._check_user(user_id, need_premium=False)
+        return allowed
+
+    async def get_user_access(self, user_id: str) -> Tuple[bool, bool]:
+        return await self._check_user(user_id, need_premium=True)
 
     async def _get_user_usage_db(self, user_id: str) -> Tuple[int, datetime.datetime | None]:
         try:
@@ -76,17 +194,7 @@ class FreeTierUsageServiceWithCache(BaseFreeTierUsageService):
             ).eq("user_id", user_id).order(
                 "time_to", desc=True
             ).limit(1).execute()
-
-            if not resp.data:
-                return 0, None
-            data = resp.data[0]
-
-            time_to = datetime.datetime.fromisoformat(data["time_to"])
-            time_from = datetime.datetime.fromisoformat(data["time_from"])
-
-            if time_from <=  datetime.datetime.now() < time_to :
-                return data["usage"], time_to
-            return 0, None
+            return self._parse_usage(resp.data[0] if resp.data else None)
         except APIError as e:
             if e.code == "PGRST116":
                 logger.warning("User not found", user_id=user_id)
@@ -98,46 +206,77 @@ class FreeTierUsageServiceWithCache(BaseFreeTierUsageService):
             capture_exception(e)
             return 0, None
 
-    async def get_user_usage(self, user_id: str) -> int:
+    async def _get_user_usage_cache(self, user_id: str) -> int:
         usage = await self.cache.get(self._usage_key(user_id))
         if usage is None:
             usage, time_to = await self._get_user_usage_db(user_id)
-            if time_to and time_to > datetime.datetime.now():
-                ttl = int((time_to - datetime.datetime.now()).total_seconds())
-                await self.cache.set(self._usage_key(user_id), usage, ttl=ttl)
+            entry = self._usage_cache_entry(usage, time_to)
+            if entry:
+                await self.cache.set(self._usage_key(user_id), entry[0], ttl=entry[1])
         return int(usage)
 
+    async def get_user_usage(self, user_id: str) -> int:
+        user_state = UserStateCache()
+        usage = user_state.get_usage(user_id)
+        if usage is None:
+            usage = await self._get_user_usage_cache(user_id)
+            user_state.set_usage(user_id, usage)
+        return usage
+
     async def _update_user_usage_db(self, user_id: str, usage_delta: int) -> Tuple[int, datetime.datetime]:
-        resp = await self.db.rpc("update_or_insert_period_usage", {
-            "p_uid": user_id,
-            "p_date": datetime.datetime.now().isoformat(),
-            "p_delta": usage_delta,
-            "p_interval_days": settings.throttling_config.period.days,
-        }).execute()
-        if not resp.data:
-            raise ValueError("Failed to update user usage")
-        usage = resp.data[0]
-        return usage.get("usage", 0), datetime.datetime.fromisoformat(usage.get("time_to"))
+        return await self.usage_repository.update_or_insert_period_usage(user_id, usage_delta)
 
     async def update_user_usage(self, user_id: str, usage_delta: int):
         logger.info("Updating user usage", user_id=user_id, usage_delta=usage_delta)
-        usage_cache = await self.get_user_usage(user_id)
-        exists = usage_cache is not None
-        if exists:
-            await self.cache.incr(self._usage_key(user_id), usage_delta)
+        # makes sure the counter is cached for the current period before incrementing it
+        await self._get_user_usage_cache(user_id)
+        # cache is the source of truth for throttling, the database is updated in the background
+        write_behind = UsageWriteBehindQueue()
+        usage = None
+        if write_behind.is_running:
+            usage = await write_behind.submit(
+                user_id,
+                usage_delta,
+                self._usage_key(user_id),
+                period_ttl=int(datetime.timedelta(days=settings.throttling_config.period.days).total_seconds())
+            )
+        queued = usage is not None
+        if not queued:
+            usage = await self.cache.incr(self._usage_key(user_id), usage_delta)
+        user_state = UserStateCache()
+        await user_state.invalidate(user_id, premium=False)
+        if usage >= 0:
+            user_state.set_usage(user_id, usage)
+        if not queued:
+            # written right away when the write-behind is off or couldn't take the delta
+            await self.flush_user_usage(user_id, usage_delta)
 
+    async def flush_user_usage(self, user_id: str, usage_delta: int):
         usage, time_to = await self._update_user_usage_db(user_id, usage_delta)
         logger.debug("Updated user usage in db", user_id=user_id, usage=usage, time_to=time_to)
         ttl = int((time_to - datetime.datetime.now()).total_seconds())
         # TODO: fix db inconsistency for is_premium too
-        if usage != usage_cache + usage_delta:
-            logger.warning("Usage mismatch", user_id=user_id, usage=usage, usage_cache=usage_cache, usage_delta=usage_delta)
+        usage_cache = await self.cache.get(self._usage_key(user_id))
+        if usage_cache is not None and int(usage_cache) != usage:
+            logger.warning("Usage mismatch", user_id=user_id, usage=usage, usage_cache=int(usage_cache), usage_delta=usage_delta)
             sentry_sdk.capture_message(f"Usage mismatch for user {user_id}", level="warning")
         await self.cache.set(self._usage_key(user_id), usage, ttl=ttl)
+        if usage_cache is None or int(usage_cache) != usage:
+            await UserStateCache().invalidate(user_id, premium=False)
+
+    async def flush_usage_batch(self, batch_id: str, usage_deltas: Dict[str, int]) -> Dict[str, CounterUpdate]:
+        usages = await self.usage_repository.update_or_insert_period_usage_batch(batch_id, usage_deltas)
+        logger.debug("Updated users usage in db", batch_id=batch_id, users=len(usage_deltas), applied=len(usages))
+        now = datetime.datetime.now()
+        return {
+            user_id: (self._usage_key(user_id), usage, int((time_to - now).total_seconds()))
+            for user_id, (usage, time_to) in usages.items()
+        }
 
     async def revalidate_user(self, user_id):
         await self.cache.delete(self._premium_key(user_id))
         await self.cache.delete(self._usage_key(user_id))
+        await UserStateCache().invalidate(user_id)
         await self.is_user_premium(user_id)
         await self.get_user_usage(user_id)
         return True
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import uuid
+from contextlib import aclosing
+from typing import Optional, Tuple
+
+import sentry_sdk
+import structlog
+
+from app.models.config import UserStateCacheConfig
+from app.services.cache.base import BaseCacheService
+from app.services.cache.local_cache import LocalTTLCache
+from app.settings import settings
+from app.utils.singleton import Singleton
+
+logger = structlog.getLogger(__name__)
+
+
+class UserStateCache(metaclass=Singleton):
+    """
+    Per-worker cache of the users' premium flags and usage counters in front of Redis, so that hot users skip it.
+
+    Entries are dropped on every worker through a Redis pub/sub channel when a user is revalidated or their usage
+    grows. They also expire on their own, which bounds how stale they get when an invalidation is lost
+    (`usage_max_staleness` for the usage counters). Lookups miss while the worker isn't subscribed to the channel.
+    """
+
+    def __init__(self, config: Optional[UserStateCacheConfig] = None):
+        self.config = config or settings.user_state_cache_config
+        self.premium = LocalTTLCache("user_premium", self.config.max_entries)
+        self.usage = LocalTTLCache("user_usage", self.config.max_entries)
+        # own invalidations are applied locally right away and skipped when they come back from the channel
+        self._origin = uuid.uuid4().hex
+        self._cache: Optional[BaseCacheService] = None
+        self._task: Optional[asyncio.Task] = None
+        self._subscribed = False
+
+    @property
+    def is_running(self) -> bool:
+        return self._subscribed
+
+    def get(self, user_id: str) -> Tuple[Optional[bool], Optional[int]]:
+        """Cached premium flag and usage of the user, None when not cached"""
+        return self.get_premium(user_id), self.get_usage(user_id)
+
+    def get_premium(self, user_id: str) -> Optional[bool]:
+        return self.premium.get(user_id) if self._subscribed else None
+
+    def get_usage(self, user_id: str) -> Optional[int]:
+        return self.usage.get(user_id) if self._subscribed else None
+
+    def set_premium(self, user_id: str, is_premium: bool):
+        if self._subscribed:
+            self.premium.set(user_id, is_premium, self.config.premium_ttl)
+
+    def set_usage(self, user_id: str, usage: int):
+        if self._subscribed:
+            self.usage.set(user_id, usage, self.config.usage_max_staleness)
+
+    def _drop(self, user_id: str, premium: bool, usage: bool):
+        if premium:
+            self.premium.delete(user_id)
+        if usage:
+            self.usage.delete(user_id)
+
+    async def invalidate(self, user_id: str, premium: bool = True, usage: bool = True):
+        """Drops the user's entries on this worker and, through the channel, on all others"""
+        self._drop(user_id, premium, usage)
+        if self._cache is None:
+            return
+        message = json.dumps({"user_id": user_id, "premium": premium, "usage": usage, "origin": self._origin})
+        if not await self._cache.publish(self.config.channel, message):
+            logger.warning("Failed to publish user state invalidation", user_id=user_id)
+
+    def _apply(self, message: bytes):
+        try:
+            invalidation = json.loads(message)
+            if invalidation.get("origin") != self._origin:
+                self._drop(invalidation["user_id"], invalidation.get("premium", True), invalidation.get("usage", True))
+        except (ValueError, KeyError, AttributeError):
+            logger.warning("Invalid user state invalidation", message=message)
+
+    async def start(self, cache: BaseCacheService):
+        self._cache = cache
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._cache = None
+        self.premium.clear()
+        self.usage.clear()
+
+    async def _run(self):
+        while True:
+            try:
+                async with aclosing(await self._cache.subscribe(self.config.channel)) as messages:
+                    # entries cached before a reconnect may have missed invalidations
+                    self.premium.clear()
+                    self.usage.clear()
+                    self._subscribed = True
+                    logger.info("Subscribed to user state invalidations", channel=self.config.channel)
+                    async for message in messages:
+                        self._apply(message)
+            except Exception as e:
+                logger.error("User state invalidations failed, re-subscribing", error=str(e))
+                sentry_sdk.capture_exception(e)
+            finally:
+                self._subscribed = False
+            await asyncio.sleep(self.config.retry_delay)
@@ -0,0 +1,287 @@
+import asyncio
+import time
+import uuid
+from contextlib import suppress
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import sentry_sdk
+import structlog
+from prometheus_client import Counter, Gauge
+
+from app.models.config import UsageWriteBehindConfig
+from app.services.cache.base import BaseCacheService
+from app.services.usage.free_tier_usage.user_state_cache import UserStateCache
+from app.settings import settings
+from app.utils.singleton import Singleton
+
+logger = structlog.getLogger(__name__)
+
+pending_users = Gauge(
+    "usage_write_behind_pending_users",
+    "Users with usage updates waiting in Redis to be written to the database"
+)
+flushed_updates = Counter(
+    "usage_write_behind_flushed_total",
+    "Per-user usage updates written to the database",
+    ["result"]
+)
+flushed_batches = Counter(
+    "usage_write_behind_batches_total",
+    "Bulk usage writes to the database, by result",
+    ["result"]
+)
+flush_errors = Counter(
+    "usage_write_behind_flush_errors_total",
+    "Flushes of the usage write-behind that failed unexpectedly, retried after a backoff"
+)
+
+# key of the user's cached usage counter, the usage in the database and the counter's ttl
+CounterUpdate = Tuple[str, int, int]
+# writes the deltas of a batch (identified by its id) to the database, returns the counters to correct
+FlushCallback = Callable[[str, Dict[str, int]], Awaitable[Dict[str, CounterUpdate]]]
+
+
+class UsageWriteBehindQueue(metaclass=Singleton):
+    """
+    Collects usage deltas per user in a Redis hash and writes them to the database in bulk in the background,
+    so the rewrite stream doesn't wait for the database and the database gets one write per flush instead of
+    one per rewrite. Deltas of the same user are merged between flushes.
+
+    A flush renames the hash to a batch of its own before writing it, the batch is deleted once the database
+    confirmed it. The database skips batch ids it already applied, so batches left behind by a failed write or
+    a crashed worker are retried by any worker (after `stale_batch_timeout`) and still applied exactly once.
+    """
+    _pending_key = "users:usage:pending"
+    _batch_key = "users:usage:batch"           # deltas of a batch being written, by batch id
+    _batches_key = "users:usage:batches"       # ids of the batches being written, with the time they were taken
+
+    # increments the user's usage counter (KEYS[1]) and pending delta (KEYS[2]) at once, so that a delta
+    # counted for throttling is always written to the database. A counter created by the increment (no period yet)
+    # expires after ARGV[3] seconds, like the period the database starts for it. Returns the usage and the number
+    # of pending users
+    _submit_script = """
+local usage = redis.call('INCRBY', KEYS[1], ARGV[2])
+if redis.call('TTL', KEYS[1]) < 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+redis.call('HINCRBY', KEYS[2], ARGV[1], ARGV[2])
+return {usage, redis.call('HLEN', KEYS[2])}
+"""
+    # moves the pending deltas (KEYS[1]) to a new batch (KEYS[2]) and registers it (KEYS[3])
+    _take_batch_script = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+return 1
+"""
+    # deletes a written batch (KEYS[1], ARGV[1]), then sets the usage counters of its users to the database's value
+    # for users without deltas pending anywhere else. The caller lists the other batches being written (ARGV[2] of
+    # them, ids from ARGV[3], keys from KEYS[4]), then gives the counter keys (KEYS[4 + n]...) with user, usage, ttl
+    # in ARGV. Returns 0 if a batch was taken since the caller listed them, else 1 then the corrected users with
+    # their former value
+    _complete_batch_script = """
+local n = tonumber(ARGV[2])
+local listed = {}
+for i = 1, n do
+    listed[ARGV[2 + i]] = true
+end
+for _, batch_id in ipairs(redis.call('HKEYS', KEYS[2])) do
+    if batch_id ~= ARGV[1] and not listed[batch_id] then
+        return {0}
+    end
+end
+redis.call('DEL', KEYS[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+local corrected = {1}
+for j = 0, (#ARGV - 2 - n) / 3 - 1 do
+    local user, usage, ttl = ARGV[3 + n + 3 * j], ARGV[4 + n + 3 * j], ARGV[5 + n + 3 * j]
+    local counter_key = KEYS[4 + n + j]
+    local pending = redis.call('HEXISTS', KEYS[3], user) == 1
+    for i = 1, n do
+        pending = pending or redis.call('HEXISTS', KEYS[3 + i], user) == 1
+    end
+    if not pending then
+        local cached = redis.call('GET', counter_key)
+        -- also when the value matches, so the counter expires with the database's period
+        redis.call('SET', counter_key, usage, 'EX', ttl)
+        if cached and cached ~= usage then
+            table.insert(corrected, user)
+            table.insert(corrected, cached)
+        end
+    end
+end
+return corrected
+"""
+    _complete_batch_attempts = 3
+
+    def __init__(self, config: Optional[UsageWriteBehindConfig] = None):
+        self.config = config or settings.usage_write_behind_config
+        self._cache: Optional[BaseCacheService] = None
+        self._flush: Optional[FlushCallback] = None
+        self._flush_requested = asyncio.Event()
+        self._stop_requested = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._taken: Set[str] = set()     # batches taken by this worker and not completed yet
+        self._stopping = False
+
+    @property
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _get_batch_key(self, batch_id: str) -> str:
+        return f"{self._batch_key}:{batch_id}"
+
+    async def submit(self, user_id: str, usage_delta: int, counter_key: str, period_ttl: int) -> Optional[int]:
+        """
+        Adds the delta to the user's usage counter and to the pending deltas, returns the usage (None on failure).
+        A counter without expiry is given `period_ttl`, the length of a new period.
+        """
+        result = await self._cache.run_script(
+            self._submit_script, keys=[counter_key, self._pending_key], args=[user_id, usage_delta, period_ttl]
+        )
+        if result is None:
+            return None
+        usage, pending = result
+        pending_users.set(pending)
+        if pending >= self.config.max_batch_size:
+            self._flush_requested.set()
+        return usage
+
+    async def start(self, cache: BaseCacheService, flush: FlushCallback):
+        self._cache = cache
+        self._flush = flush
+        self._flush_requested = asyncio.Event()
+        self._stop_requested = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            # not cancelled, so that a flush in progress isn't interrupted halfway through its writes
+            self._stopping = True
+            self._flush_requested.set()
+            self._stop_requested.set()
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        # batches left behind by a previous run are picked up by the first flush
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), timeout=self.config.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            # the flush starting after stop() was called is the last one, it drains everything submitted before
+            stopping = self._stopping
+            try:
+                flushed = await self.flush()
+            except Exception as e:
+                # deltas and batches stay in Redis, the next flush picks them up
+                logger.error("Failed to flush usage updates", error=str(e))
+                sentry_sdk.capture_exception(e)
+                flush_errors.inc()
+                flushed = False
+            if stopping:
+                break
+            failures = 0 if flushed else failures + 1
+            if failures:
+                backoff = min(self.config.flush_interval * 2 ** failures, self.config.max_backoff)
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._stop_requested.wait(), timeout=backoff)
+        # whatever the last flush couldn't write stays in Redis, for the other workers or this one after a restart
+        logger.info("Stopped writing usage updates")
+
+    async def _take_batch(self) -> Optional[str]:
+        batch_id = uuid.uuid4().hex
+        taken = await self._cache.run_script(
+            self._take_batch_script,
+            keys=[self._pending_key, self._get_batch_key(batch_id), self._batches_key],
+            args=[batch_id, time.time()]
+        )
+        pending_users.set(0)
+        if not taken:
+            return None
+        self._taken.add(batch_id)
+        return batch_id
+
+    async def _write_batch(self, batch_id: str) -> bool:
+        deltas = {
+            user_id.decode(): int(delta)
+            for user_id, delta in (await self._cache.hgetall(self._get_batch_key(batch_id))).items()
+        }
+        user_ids = sorted(deltas)
+        updates: Dict[str, CounterUpdate] = {}
+        try:
+            # sorted, so that a retried batch is split the same way and its chunks keep their ids
+            for start in range(0, len(user_ids), self.config.max_batch_size):
+                chunk = {user_id: deltas[user_id] for user_id in user_ids[start:start + self.config.max_batch_size]}
+                updates |= await self._flush(f"{batch_id}:{start}", chunk)
+        except Exception as e:
+            logger.error("Failed to write usage batch", batch_id=batch_id, users=len(deltas), error=str(e))
+            sentry_sdk.capture_exception(e)
+            flushed_batches.labels(result="failure").inc()
+            flushed_updates.labels(result="failure").inc(len(deltas))
+            return False
+        flushed_batches.labels(result="success").inc()
+        flushed_updates.labels(result="success").inc(len(deltas))
+
+        corrected = await self._complete_batch(batch_id, updates)
+        if corrected is None:
+            # written, the id keeps the retry from applying it twice
+            logger.error("Failed to complete usage batch", batch_id=batch_id)
+            return False
+        for user_id, usage_cache in zip(corrected[::2], corrected[1::2]):
+            user_id = user_id.decode()
+            logger.warning("Usage mismatch", user_id=user_id, usage=updates[user_id][1], usage_cache=int(usage_cache))
+            sentry_sdk.capture_message(f"Usage mismatch for user {user_id}", level="warning")
+            await UserStateCache().invalidate(user_id, premium=False)
+        self._taken.discard(batch_id)
+        return True
+
+    async def _complete_batch(self, batch_id: str, updates: Dict[str, CounterUpdate]) -> Optional[List[bytes]]:
+        """Deletes the written batch and corrects the usage counters, returns the corrected users and former values"""
+        counters = [(user_id, update) for user_id, update in updates.items() if update[2] > 0]
+        for _ in range(self._complete_batch_attempts):
+            # every key the script reads is passed in KEYS, so the batches being written are listed beforehand
+            other_ids = [
+                other_id.decode() for other_id in await self._cache.hgetall(self._batches_key)
+                if other_id.decode() != batch_id
+            ]
+            args: List = [batch_id, len(other_ids), *other_ids]
+            for user_id, (_, usage, ttl) in counters:
+                args += [user_id, usage, ttl]
+            result = await self._cache.run_script(
+                self._complete_batch_script,
+                keys=[
+                    self._get_batch_key(batch_id),
+                    self._batches_key,
+                    self._pending_key,
+                    *[self._get_batch_key(other_id) for other_id in other_ids],
+                    *[counter_key for _, (counter_key, _, _) in counters],
+                ],
+                args=args
+            )
+            if result is None:
+                return None
+            if result[0]:
+                return result[1:]
+        return None
+
+    async def flush(self) -> bool:
+        """Writes the pending deltas and stale batches, returns False if some of them failed and were kept"""
+        await self._take_batch()
+        batches = await self._cache.hgetall(self._batches_key)
+        stale_before = time.time() - self.config.stale_batch_timeout
+        # batches of other workers are theirs to write, unless they seem to be gone,
+        # the own ones are retried right away, also after a flush that failed halfway
+        batch_ids = [
+            other_id.decode() for other_id, taken_at in batches.items()
+            if float(taken_at) < stale_before and other_id.decode() not in self._taken
+        ]
+        batch_ids += sorted(self._taken)
+        results = [await self._write_batch(batch_id) for batch_id in batch_ids]
+        return all(results)
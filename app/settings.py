@@ -1,14 +1,11 @@
-from app.models.config import DBConfig, ThrottlingConfig
+from app.models.config import DBConfig, ThrottlingConfig, RewriteCacheConfig, AnalysisCacheConfig, SSEBatchingConfig, \
+    LLMSchedulerConfig, ChunkedRewriteConfig, SpellingConfig, BatchRewriteConfig, UsageWriteBehindConfig, \
+    UserStateCacheConfig, LLMClientConfig, LLMBackendConfig, LLMRouterConfig, LLMProvider, \
+    RateLimitConfig, LLMResilienceConfig, GenerationBudgetConfig, AdvancedImproveFastModeConfig, AdvancedImproveEngine
 from app.models.prompt import PromptsConfig
 from app.utils.filesystem import get_project_root
 from pydantic_settings import BaseSettings, SettingsConfigDict, PydanticBaseSettingsSource, YamlConfigSettingsSource
-from enum import Enum
-from typing import Optional
-
-
-class LLMProvider(str, Enum):
-    OPENAI = "openai"
-    ANTHROPIC = "anthropic"
+from typing import List, Optional
 
 
 class Settings(BaseSettings):
@@ -16,6 +13,7 @@ class Settings(BaseSettings):
     llm_api_key: str
     llm_model: str
     llm_provider: LLMProvider = LLMProvider.OPENAI
+    llm_base_url: Optional[str] = None    # provider default if not set, e.g. the mock LLM server for load tests
     lemonsqueezy_api_key: str
     lemonsqueezy_webhook_secret: str = 'test123'   # TODO: change to real secret
     lemonsqueezy_product_id: int
@@ -30,6 +28,24 @@ class Settings(BaseSettings):
     prompts: PromptsConfig
     db_config: DBConfig
     throttling_config: ThrottlingConfig
+    rewrite_cache_config: RewriteCacheConfig = RewriteCacheConfig()
+    analysis_cache_config: AnalysisCacheConfig = AnalysisCacheConfig()
+    advanced_improve_fast_mode_config: AdvancedImproveFastModeConfig = AdvancedImproveFastModeConfig()
+    advanced_improve_engine: AdvancedImproveEngine = AdvancedImproveEngine.NATIVE
+    single_flight_enabled: bool = True
+    sse_batching_config: SSEBatchingConfig = SSEBatchingConfig()
+    llm_scheduler_config: LLMSchedulerConfig = LLMSchedulerConfig()
+    chunked_rewrite_config: ChunkedRewriteConfig = ChunkedRewriteConfig()
+    spelling_config: SpellingConfig = SpellingConfig()
+    batch_rewrite_config: BatchRewriteConfig = BatchRewriteConfig()
+    usage_write_behind_config: UsageWriteBehindConfig = UsageWriteBehindConfig()
+    user_state_cache_config: UserStateCacheConfig = UserStateCacheConfig()
+    llm_client_config: LLMClientConfig = LLMClientConfig()
+    llm_backends: List[LLMBackendConfig] = []     # defaults to the single llm_provider/llm_api_key/llm_model backend
+    llm_router_config: LLMRouterConfig = LLMRouterConfig()
+    rate_limit_config: RateLimitConfig = RateLimitConfig()
+    llm_resilience_config: LLMResilienceConfig = LLMResilienceConfig()
+    generation_budget_config: GenerationBudgetConfig = GenerationBudgetConfig()
     environment: Optional[str] = None  
 
     model_config = SettingsConfigDict(
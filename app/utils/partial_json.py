@@ -0,0 +1,64 @@
+import json
+from typing import Any, Dict
+
+
+class IncrementalJSONObjectParser:
+    """
+    Parses a JSON object streamed in chunks, returning each top-level member as soon as its value is complete,
+    before the closing brace arrives. Text before the opening brace (e.g. a code block fence) is skipped.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._member = ""           # text of the current top-level member
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def _complete_member(self) -> Dict[str, Any]:
+        try:
+            member = json.loads("{" + self._member + "}")
+        except ValueError:
+            return {}
+        new = {key: value for key, value in member.items() if key not in self.fields}
+        self.fields.update(new)
+        return new
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        """Members completed by the chunk"""
+        completed: Dict[str, Any] = {}
+        for char in chunk:
+            if self.done:
+                break
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+                continue
+            if self._in_string:
+                self._member += char
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        # a closed string at the top level may be the member's value
+                        completed.update(self._complete_member())
+                continue
+            if self._depth == 1 and char in ",}":
+                completed.update(self._complete_member())
+                self._member = ""
+                if char == "}":
+                    self._depth = 0
+                    self.done = True
+                continue
+            if char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+            self._member += char
+        return completed
@@ -0,0 +1,123 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from prometheus_client import Histogram
+
+from app.utils.tokens import CHARS_PER_TOKEN
+
+_labels = ["task_type", "provider", "locale"]
+
+stage_duration = Histogram(
+    "rewrite_stage_seconds",
+    "Duration of each rewrite phase, measured from the end of the previous one",
+    ["stage", *_labels],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+time_to_first_token = Histogram(
+    "rewrite_time_to_first_token_seconds",
+    "Time from receiving a rewrite request to sending its first data chunk",
+    _labels,
+    buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30)
+)
+tokens_per_second = Histogram(
+    "rewrite_tokens_per_second",
+    "Estimated completion tokens per second between the first and the last upstream token",
+    _labels,
+    buckets=(5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500)
+)
+
+_current_timer: ContextVar[Optional["StageTimer"]] = ContextVar("rewrite_stage_timer", default=None)
+
+
+class StageTimer:
+    """
+    Timestamps of one rewrite request, from receiving it to the last upstream token.
+
+    The timer is kept in a context variable, so the LLM services and actions deep down the stream can mark
+    their phases without passing it around. Tasks spawned for a request (single flight, chunks) inherit it,
+    only the first dispatch/connect/token mark counts. Phases that were skipped (cache hits, local results)
+    aren't recorded, the next phase then covers their time.
+    """
+
+    def __init__(self, task_type: str, provider: str, locale: str):
+        self.task_type = task_type
+        self.provider = provider
+        self.locale = locale
+        self.started_at = time.perf_counter()
+        self.usage_checked_at: Optional[float] = None
+        self.dispatched_at: Optional[float] = None
+        self.connected_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.first_chunk_sent = False
+        self.completion_chars = 0
+
+    @classmethod
+    def start(cls, task_type: str, provider: str, locale: str) -> "StageTimer":
+        timer = cls(task_type, provider, locale)
+        _current_timer.set(timer)
+        return timer
+
+    @staticmethod
+    def current() -> Optional["StageTimer"]:
+        return _current_timer.get()
+
+    def _observe(self, stage: str, duration: float):
+        stage_duration.labels(stage=stage, task_type=self.task_type, provider=self.provider, locale=self.locale) \
+            .observe(duration)
+
+    def mark_usage_checked(self):
+        self.usage_checked_at = time.perf_counter()
+        self._observe("usage_check", self.usage_checked_at - self.started_at)
+
+    def mark_dispatched(self):
+        if self.dispatched_at is None:
+            self.dispatched_at = time.perf_counter()
+
+    def mark_connected(self, provider: Optional[str] = None):
+        if self.connected_at is None:
+            self.connected_at = time.perf_counter()
+            if provider:
+                self.provider = provider
+
+    def mark_token(self, content: str):
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        self.last_token_at = now
+        self.completion_chars += len(content)
+
+    def mark_chunk_sent(self):
+        if not self.first_chunk_sent:
+            self.first_chunk_sent = True
+            time_to_first_token.labels(task_type=self.task_type, provider=self.provider, locale=self.locale) \
+                .observe(time.perf_counter() - self.started_at)
+
+    def finish_stream(self):
+        """Records the phases of a stream that ran to completion"""
+        previous = self.usage_checked_at or self.started_at
+        for stage, at in (
+                ("dispatch", self.dispatched_at),
+                ("provider_connect", self.connected_at),
+                ("first_token", self.first_token_at),
+                ("last_token", self.last_token_at),
+        ):
+            if at is None:
+                continue
+            self._observe(stage, at - previous)
+            previous = at
+
+        if self.first_token_at is not None and self.last_token_at > self.first_token_at:
+            tokens = self.completion_chars / CHARS_PER_TOKEN
+            tokens_per_second.labels(task_type=self.task_type, provider=self.provider, locale=self.locale) \
+                .observe(tokens / (self.last_token_at - self.first_token_at))
+
+    @contextmanager
+    def measure(self, stage: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(stage, time.perf_counter() - started_at)
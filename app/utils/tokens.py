@@ -0,0 +1,20 @@
+import math
+
+# rough average for English text with OpenAI/Anthropic tokenizers, good enough for budgets and metrics
+# and much cheaper than running a tokenizer on the request path
+CHARS_PER_TOKEN = 4
+
+
+def estimate_token_count(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+def estimate_max_token_count(text: str) -> int:
+    """
+    Generous token count for generation budgets, which truncate the reply when they're too small:
+    non-ASCII characters (CJK, accented letters, emoji) count as a token each instead of a quarter
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return math.ceil(ascii_chars / CHARS_PER_TOKEN) + len(text) - ascii_chars
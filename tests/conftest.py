@@ -0,0 +1,36 @@
+import json
+import os
+
+import pytest
+
+# the settings are read on import, the tests only need them to be valid
+os.environ.setdefault("LLM_API_KEY", "test")
+os.environ.setdefault("LLM_MODEL", "gpt-4o-mini")
+os.environ.setdefault("LEMONSQUEEZY_API_KEY", "test")
+os.environ.setdefault("LEMONSQUEEZY_PRODUCT_ID", "1")
+os.environ.setdefault("LEMONSQUEEZY_STORE_ID", "1")
+os.environ.setdefault("LEMONSQUEEZY_DEFAULT_VARIANT_ID", "1")
+os.environ.setdefault("SENTRY_DSN", "")
+os.environ.setdefault("MIXPANEL_API_KEY", "test")
+os.environ.setdefault("DB_CONFIG", json.dumps({"url": "http://localhost:54321", "password": "test"}))
+os.environ.setdefault("THROTTLING_CONFIG", json.dumps({"limit": 10, "period": "daily"}))
+os.environ.setdefault("PROMPTS", json.dumps({
+    "base_system_prompt": "system",
+    "fix_grammar_prompt": "fix grammar",
+    "rephrase_prompt": "rephrase",
+    "concise_prompt": "concise",
+    "one_word_prompt": "one word",
+    "context_prompt": "context {}",
+    "postscript": "postscript",
+    "advanced_improve_prompt": {
+        "analyze_prompt": "Analyze {original_message}",
+        "rewrite_prompt": "Rewrite {original_message} {tone} {vocabulary} {formality} {goal} {language}",
+        "humanize_prompt": "Humanize {improved_message} {locale_instructions}",
+    },
+    "locale_instructions": {"en_US": "US English", "en_GB": "British English"},
+}))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
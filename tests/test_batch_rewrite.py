@@ -0,0 +1,150 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.completion import router
+from app.depends.usage import get_usage_service
+from app.models.completion import RephraseRequest
+from app.models.config import BatchRewriteConfig
+from app.models.sse import SSEEvent
+from app.services.rewrite.actions.base import ActionFailed
+from app.services.rewrite.rewrite_manager import RewriteManager
+from app.settings import settings
+
+
+class UsageService:
+    def __init__(self, is_allowed=True):
+        self.is_allowed = is_allowed
+        self.updates = []
+
+    async def get_user_access(self, user_id):
+        return False, self.is_allowed
+
+    async def update_user_usage(self, user_id, usage_delta):
+        self.updates.append((user_id, usage_delta))
+
+
+def requests(*texts):
+    return [RephraseRequest(text=text, completion_task_type="fix_grammar", uid="user") for text in texts]
+
+
+def manager(stream, usage_service=None):
+    manager = RewriteManager(usage_service=usage_service)
+    manager._stream = stream
+    return manager
+
+
+async def collect(events):
+    collected = []
+    async for item in events:
+        if item == RewriteManager._sse_end_of_stream():
+            # the untagged end of the whole batch
+            collected.append((None, item["event"], item["data"]))
+        else:
+            tagged = json.loads(item["data"])
+            collected.append((tagged["index"], item["event"], tagged["data"]))
+    return collected
+
+
+@pytest.mark.anyio
+async def test_events_are_tagged_with_their_index_as_they_arrive():
+    fast_done = asyncio.Event()
+
+    async def stream(rephrase_request, lane):
+        if rephrase_request.text == "slow":
+            await fast_done.wait()
+        yield SSEEvent.DATA, rephrase_request.text.upper()
+        if rephrase_request.text == "fast":
+            fast_done.set()
+
+    assert await collect(manager(stream).rewrite_batch(requests("slow", "fast"))) == [
+        (1, "data", "FAST"),
+        (1, "eos", "end of stream"),
+        (0, "data", "SLOW"),
+        (0, "eos", "end of stream"),
+        (None, "eos", "end of stream"),
+    ]
+
+
+@pytest.mark.anyio
+async def test_failed_requests_end_with_an_error_and_only_completed_ones_are_counted():
+    usage_service = UsageService()
+
+    async def stream(rephrase_request, lane):
+        if rephrase_request.text == "raises":
+            raise ActionFailed(rephrase_request.completion_task_type, "no backend")
+        yield SSEEvent.DATA, rephrase_request.text.upper()
+        if rephrase_request.text == "fails midway":
+            yield SSEEvent.ERROR, "rewrite failed"
+
+    events = await collect(manager(stream, usage_service).rewrite_batch(requests("ok", "raises", "fails midway", "ok")))
+    by_index = {index: [(event, data) for i, event, data in events if i == index] for index in range(4)}
+    assert by_index == {
+        0: [("data", "OK"), ("eos", "end of stream")],
+        1: [("error", "rewrite failed")],
+        2: [("data", "FAILS MIDWAY"), ("error", "rewrite failed")],
+        3: [("data", "OK"), ("eos", "end of stream")],
+    }
+    assert events[-1] == (None, "eos", "end of stream")
+    assert usage_service.updates == [("user", 2)]
+
+
+@pytest.mark.anyio
+async def test_usage_is_not_updated_when_nothing_completed():
+    usage_service = UsageService()
+
+    async def stream(rephrase_request, lane):
+        raise ActionFailed(rephrase_request.completion_task_type, "no backend")
+        yield
+
+    events = await collect(manager(stream, usage_service).rewrite_batch(requests("a", "b")))
+    assert [event for _, event, _ in events] == ["error", "error", "eos"]
+    assert usage_service.updates == []
+
+
+@pytest.mark.anyio
+async def test_concurrency_is_bounded(monkeypatch):
+    monkeypatch.setattr(settings, "batch_rewrite_config", BatchRewriteConfig(max_concurrency=2))
+    running = peak = 0
+
+    async def stream(rephrase_request, lane):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        yield SSEEvent.DATA, rephrase_request.text
+
+    events = await collect(manager(stream).rewrite_batch(requests(*"abcde")))
+    assert sorted(data for _, event, data in events if event == "data") == list("abcde")
+    assert peak == 2
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(router)
+    app.dependency_overrides[get_usage_service] = UsageService
+    return TestClient(app)
+
+
+@pytest.mark.parametrize("body, detail", [
+    ([], "Empty batch"),
+    ([{"text": "a", "completion_task_type": "fix_grammar", "uid": "one"},
+      {"text": "b", "completion_task_type": "fix_grammar", "uid": "other"}], "same user"),
+])
+def test_invalid_batches_are_rejected(client, body, detail):
+    response = client.post("/completion/v2/rephrase/batch", json=body)
+    assert response.status_code == 400
+    assert detail in response.json()["detail"]
+
+
+def test_batches_over_the_limit_are_rejected(client, monkeypatch):
+    monkeypatch.setattr(settings, "batch_rewrite_config", BatchRewriteConfig(max_size=2))
+    body = [{"text": text, "completion_task_type": "fix_grammar", "uid": "user"} for text in "abc"]
+    response = client.post("/completion/v2/rephrase/batch", json=body)
+    assert response.status_code == 400
+    assert "limited to 2" in response.json()["detail"]
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+from app.models.config import SSEBatchingConfig
+from app.models.sse import SSEEvent
+from app.services.rewrite.batching import ChunkBatcher
+
+pytestmark = pytest.mark.anyio
+
+
+def batcher(**config):
+    return ChunkBatcher(task_type="test", config=SSEBatchingConfig(**config))
+
+
+async def data(*chunks):
+    for chunk in chunks:
+        yield SSEEvent.DATA, chunk
+
+
+async def collect(events):
+    return [item async for item in events]
+
+
+async def test_first_chunk_is_sent_right_away_and_the_rest_flushed_on_size():
+    events = batcher(max_chars=5, max_delay_ms=10_000).batch(data("first", "ab", "cd", "ef", "g"))
+    assert await collect(events) == [
+        (SSEEvent.DATA, "first"),
+        (SSEEvent.DATA, "abcdef"),
+        (SSEEvent.DATA, "g"),    # the partial buffer is flushed at the end
+    ]
+
+
+async def test_buffer_is_flushed_once_the_delay_passed():
+    resume = asyncio.Event()
+
+    async def stream():
+        yield SSEEvent.DATA, "first"
+        yield SSEEvent.DATA, "a"
+        yield SSEEvent.DATA, "b"
+        await resume.wait()
+        yield SSEEvent.DATA, "c"
+
+    events = batcher(max_chars=1000, max_delay_ms=10).batch(stream())
+    assert await anext(events) == (SSEEvent.DATA, "first")
+    # the stream is stalled, the buffered chunks mustn't wait for it
+    assert await asyncio.wait_for(anext(events), timeout=1) == (SSEEvent.DATA, "ab")
+    resume.set()
+    assert await collect(events) == [(SSEEvent.DATA, "c")]
+
+
+async def test_other_events_flush_the_buffer_and_pass_through():
+    async def stream():
+        yield SSEEvent.DATA, "first"
+        yield SSEEvent.DATA, "a"
+        yield SSEEvent.ANALYSIS, "{}"
+        yield SSEEvent.DATA, "b"
+        yield SSEEvent.EOS, ""
+
+    events = batcher(max_chars=1000, max_delay_ms=10_000).batch(stream())
+    assert await collect(events) == [
+        (SSEEvent.DATA, "first"),
+        (SSEEvent.DATA, "a"),
+        (SSEEvent.ANALYSIS, "{}"),
+        (SSEEvent.DATA, "b"),
+        (SSEEvent.EOS, ""),
+    ]
+
+
+async def test_disabled_batching_passes_every_chunk_through():
+    events = batcher(enabled=False).batch(data("first", "a", "b"))
+    assert await collect(events) == [(SSEEvent.DATA, chunk) for chunk in ["first", "a", "b"]]
+
+
+async def test_upstream_errors_are_raised():
+    async def stream():
+        yield SSEEvent.DATA, "first"
+        yield SSEEvent.DATA, "a"
+        raise ValueError("llm failed")
+
+    received = []
+    with pytest.raises(ValueError, match="llm failed"):
+        async for item in batcher(max_chars=1000, max_delay_ms=10_000).batch(stream()):
+            received.append(item)
+    assert received == [(SSEEvent.DATA, "first")]
+
+
+async def test_closing_mid_stream_cancels_the_pending_read_and_closes_the_upstream():
+    cancelled, closed = asyncio.Event(), asyncio.Event()
+
+    async def stream():
+        try:
+            yield SSEEvent.DATA, "first"
+            yield SSEEvent.DATA, "a"
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+        finally:
+            closed.set()
+
+    upstream = stream()
+    events = batcher(max_chars=1000, max_delay_ms=10).batch(upstream)
+    assert await anext(events) == (SSEEvent.DATA, "first")
+    # flushed by the timer while the read of the next chunk is still pending
+    assert await asyncio.wait_for(anext(events), timeout=1) == (SSEEvent.DATA, "a")
+    closing = asyncio.ensure_future(events.aclose())
+    done, _ = await asyncio.wait({closing}, timeout=1)
+    closing.cancel()
+    assert done, "the pending read wasn't cancelled"
+
+    assert cancelled.is_set()
+    assert closed.is_set()
+    assert upstream.ag_frame is None
+
+
+async def test_closing_between_chunks_closes_the_upstream():
+    closed = asyncio.Event()
+
+    async def stream():
+        try:
+            yield SSEEvent.DATA, "first"
+            yield SSEEvent.DATA, "a"
+        finally:
+            closed.set()
+
+    upstream = stream()
+    events = batcher().batch(upstream)
+    assert await anext(events) == (SSEEvent.DATA, "first")
+    await events.aclose()
+
+    assert closed.is_set()
+    assert upstream.ag_frame is None
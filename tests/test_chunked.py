@@ -0,0 +1,116 @@
+import asyncio
+from contextlib import aclosing
+
+import pytest
+
+from app.models.completion import RephraseRequest, RephraseTaskType
+from app.models.config import ChunkedRewriteConfig, LLMSchedulerConfig
+from app.models.sse import SSEEvent
+from app.services.rewrite.actions.base import ActionFailed
+from app.services.rewrite.chunked import ChunkedRewriter, split_text
+from app.services.rewrite.rewrite_manager import RewriteManager
+from app.services.rewrite.scheduler import LLMSlotScheduler, SchedulerLane
+
+
+def join(leading, chunks):
+    return leading + "".join(chunk + separator for chunk, separator in chunks)
+
+
+@pytest.mark.parametrize("text", [
+    "One paragraph.\n\nAnother one.\n\n\nAnd a third.",
+    "  leading and trailing whitespace.\n\nSecond.  \n",
+    "A long paragraph. " * 20 + "\n\nShort.",
+    "no separators at all " * 10,
+])
+def test_split_text_joins_back_to_the_original(text):
+    assert join(*split_text(text, 60)) == text
+
+
+def test_split_text_merges_paragraphs_up_to_the_limit():
+    leading, chunks = split_text("a" * 10 + "\n\n" + "b" * 10 + "\n\n" + "c" * 30, 25)
+    assert leading == ""
+    assert [chunk for chunk, _ in chunks] == ["a" * 10 + "\n\n" + "b" * 10, "c" * 30]
+
+
+def test_split_text_falls_back_to_sentences():
+    paragraph = "First sentence here. Second sentence here. Third sentence here."
+    _, chunks = split_text(paragraph, 25)
+    assert [chunk for chunk, _ in chunks] == ["First sentence here.", "Second sentence here.", "Third sentence here."]
+    assert all(len(chunk) <= 25 for chunk, _ in chunks)
+
+
+def test_short_texts_are_not_chunked():
+    rewriter = ChunkedRewriter(ChunkedRewriteConfig(min_text_length=100, max_chunk_length=20))
+    request = RephraseRequest(text="Short.\n\nText.", completion_task_type="fix_grammar", uid="user")
+    assert rewriter.split(request) is None
+
+
+@pytest.mark.anyio
+async def test_chunks_are_streamed_in_order():
+    rewriter = ChunkedRewriter(ChunkedRewriteConfig(max_parallel=3))
+
+    async def rewrite_chunk(chunk: str):
+        # later chunks finish first
+        await asyncio.sleep(0.01 * (3 - int(chunk)))
+        yield SSEEvent.DATA, chunk.upper()
+
+    events = rewriter.perform(" ", [("1", "\n\n"), ("2", "\n\n"), ("3", "")], rewrite_chunk)
+    async with aclosing(events):
+        output = "".join([data async for _, data in events])
+    assert output == " 1\n\n2\n\n3"
+
+
+async def collect(events):
+    async with aclosing(events):
+        return [event async for event in events]
+
+
+@pytest.mark.anyio
+async def test_failure_after_streamed_chunks_ends_with_an_error():
+    rewriter = ChunkedRewriter(ChunkedRewriteConfig(max_parallel=1))
+
+    async def rewrite_chunk(chunk: str):
+        if chunk == "2":
+            raise ActionFailed(RephraseTaskType.FIX_GRAMMAR, "upstream failed")
+        yield SSEEvent.DATA, chunk
+
+    events = await collect(rewriter.perform(" ", [("1", "\n\n"), ("2", "\n\n"), ("3", "")], rewrite_chunk))
+    assert events == [(SSEEvent.DATA, " "), (SSEEvent.DATA, "1"), (SSEEvent.ERROR, "rewrite failed")]
+
+
+@pytest.mark.anyio
+async def test_failure_before_any_output_is_raised():
+    rewriter = ChunkedRewriter(ChunkedRewriteConfig())
+
+    async def rewrite_chunk(chunk: str):
+        if chunk == "1":
+            raise ActionFailed(RephraseTaskType.FIX_GRAMMAR, "upstream failed")
+        yield SSEEvent.DATA, chunk
+
+    with pytest.raises(ActionFailed):
+        await collect(rewriter.perform(" ", [("1", "\n\n"), ("2", "")], rewrite_chunk))
+
+
+@pytest.mark.anyio
+async def test_every_chunk_takes_a_scheduler_slot():
+    manager = RewriteManager()
+    manager.scheduler = LLMSlotScheduler(LLMSchedulerConfig(max_concurrency=2, premium_reserved_slots=0))
+    manager.chunked_rewriter = ChunkedRewriter(ChunkedRewriteConfig(min_text_length=10, max_chunk_length=10, max_parallel=4))
+    streams = peak = 0
+
+    class Action:
+        async def perform(self, text, prev_rewrites=None, locale=None):
+            nonlocal streams, peak
+            streams += 1
+            peak = max(peak, streams)
+            assert streams <= manager.scheduler.in_use
+            await asyncio.sleep(0.01)
+            streams -= 1
+            yield SSEEvent.DATA, text.upper()
+
+    text = "\n\n".join(["paragraph"] * 6)
+    request = RephraseRequest(text=text, completion_task_type="fix_grammar", uid="user")
+    events = await collect(manager._perform_action(Action(), request, SchedulerLane.FREE))
+    assert "".join(data for _, data in events) == text.upper()
+    assert peak == 2
+    assert manager.scheduler.in_use == 0
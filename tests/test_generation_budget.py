@@ -0,0 +1,47 @@
+import pytest
+
+from app.models.sse import SSEEvent
+from app.services.llm.llm_service import CompletionTruncated, record_completion
+from app.services.rewrite.actions.base import ActionFailed
+from app.services.rewrite.actions.concise_action import ConciseAction
+from app.utils.tokens import estimate_max_token_count
+
+
+@pytest.mark.parametrize("text, tokens", [
+    ("", 0),
+    ("four", 1),
+    ("A plain English sentence.", 7),
+    ("日本語の文章", 6),
+    ("Größe", 3),
+])
+def test_non_ascii_characters_count_as_a_token_each(text, tokens):
+    assert estimate_max_token_count(text) == tokens
+
+
+@pytest.mark.parametrize("text", ["word " * 200, "日本語の文章です。" * 60, "https://example.com/a?b=c&d=e " * 40])
+def test_budget_leaves_room_for_token_dense_text(text):
+    action = ConciseAction(llm_service=None)
+    # a quarter of the characters is the usual estimate for English, dense text needs up to one token per character
+    dense_tokens = len(text) if not text.isascii() else len(text) // 2
+    assert action._get_max_tokens(text) >= dense_tokens
+
+
+def test_truncated_completion_is_raised():
+    record_completion("backend", truncated=False, max_tokens=10)
+    with pytest.raises(CompletionTruncated):
+        record_completion("backend", truncated=True, max_tokens=10)
+
+
+@pytest.mark.anyio
+async def test_truncated_rewrite_fails_the_action():
+    class LLM:
+        async def generate_stream(self, messages, **kwargs):
+            yield "Part of the"
+            record_completion("backend", truncated=True, max_tokens=kwargs["max_tokens"])
+
+    events = ConciseAction(llm_service=LLM()).perform("Some text to shorten.", prev_rewrites=None)
+    received = []
+    with pytest.raises(ActionFailed):
+        async for event in events:
+            received.append(event)
+    assert received == [(SSEEvent.DATA, "Part of the")]
@@ -0,0 +1,65 @@
+import json
+from contextlib import aclosing
+
+import pytest
+
+from app.services.rewrite.actions.advanced_improve_writing_action import _analysis_fields
+from app.utils.partial_json import IncrementalJSONObjectParser
+
+ANALYSIS = {"tone": "formal, \"dry\"", "vocabulary": "plain", "formality": "high", "goal": "inform", "language": "en"}
+
+
+def feed(chunks):
+    parser = IncrementalJSONObjectParser()
+    return parser, [parser.feed(chunk) for chunk in chunks]
+
+
+def test_members_are_returned_as_soon_as_complete():
+    parser, completed = feed(['```json\n{"a": "x', 'y", "b": [1, {"c": ', '2}]', ', "d": 3', '}\n```'])
+    assert completed == [{}, {"a": "xy"}, {}, {"b": [1, {"c": 2}]}, {"d": 3}]
+    assert parser.fields == {"a": "xy", "b": [1, {"c": 2}], "d": 3}
+    assert parser.done
+
+
+@pytest.mark.parametrize("size", [1, 2, 7])
+def test_any_chunking_parses_the_whole_object(size):
+    text = json.dumps({"s": "a,b}\\\"c{", "n": None, "o": {"k": ["}", "]"]}, "t": True})
+    parser, _ = feed([text[i:i + size] for i in range(0, len(text), size)])
+    assert parser.fields == json.loads(text)
+
+
+def test_text_after_the_object_is_ignored():
+    parser, completed = feed(['{"a": 1}', ' {"b": 2}'])
+    assert completed == [{"a": 1}, {}]
+    assert parser.fields == {"a": 1}
+
+
+async def tokens(text: str, size: int = 5):
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+async def collect(updates):
+    async with aclosing(updates):
+        return [fields async for fields in updates]
+
+
+@pytest.mark.anyio
+async def test_analysis_fields_stop_after_the_last_field():
+    read = []
+
+    async def reply():
+        async for token in tokens(json.dumps(ANALYSIS) + "\nThis analysis is based on..."):
+            read.append(token)
+            yield token
+
+    updates = await collect(_analysis_fields(reply()))
+    assert updates[-1] == ANALYSIS
+    assert [len(fields) for fields in updates] == sorted(len(fields) for fields in updates)
+    assert "based on" not in "".join(read)
+
+
+@pytest.mark.anyio
+async def test_incomplete_analysis_is_rejected():
+    with pytest.raises(ValueError):
+        await collect(_analysis_fields(tokens(json.dumps({"tone": "formal"}))))
@@ -0,0 +1,55 @@
+from contextlib import aclosing
+
+import pytest
+
+from app.models.sse import SSEEvent
+from app.services.rewrite.pipeline import PipelineState, StepPipeline
+
+pytestmark = pytest.mark.anyio
+
+
+async def analyse(state: PipelineState):
+    state["words"] = state["text"].split()
+
+
+async def shout(state: PipelineState):
+    for word in state["words"]:
+        yield SSEEvent.DATA, word.upper()
+    state["shouted"] = True
+
+
+async def collect(pipeline: StepPipeline, state: PipelineState):
+    async with aclosing(pipeline.run(state)) as events:
+        return [event async for event in events]
+
+
+async def test_steps_share_the_state_in_order():
+    state = {"text": "two words"}
+    events = await collect(StepPipeline("test", [("analyse", analyse), ("shout", shout)]), state)
+    assert events == [(SSEEvent.DATA, "TWO"), (SSEEvent.DATA, "WORDS")]
+    assert state == {"text": "two words", "words": ["two", "words"], "shouted": True}
+
+
+async def test_failing_step_stops_the_pipeline():
+    async def fail(state: PipelineState):
+        raise ValueError("step failed")
+
+    state = {"text": "text"}
+    with pytest.raises(ValueError):
+        await collect(StepPipeline("test", [("analyse", analyse), ("fail", fail), ("shout", shout)]), state)
+    assert "shouted" not in state
+
+
+async def test_closing_the_run_closes_the_current_step():
+    closed = []
+
+    async def endless(state: PipelineState):
+        try:
+            while True:
+                yield SSEEvent.DATA, "token"
+        finally:
+            closed.append(True)
+
+    async with aclosing(StepPipeline("test", [("endless", endless)]).run({})) as events:
+        assert await events.__anext__() == (SSEEvent.DATA, "token")
+    assert closed == [True]
@@ -0,0 +1,97 @@
+from contextlib import aclosing
+from typing import List, Optional
+
+import pytest
+
+from app.models.config import LLMResilienceConfig, LLMRouterConfig
+from app.models.message import UserMessage
+from app.services.llm.resilience import AttemptBudget, StreamTimeout, resilient_stream
+from app.services.llm.router import LLMBackend, LLMRouter
+from app.settings import settings
+
+pytestmark = pytest.mark.anyio
+
+CONFIG = LLMResilienceConfig(retry_base_delay=0, first_token_timeout=0.5, inter_token_timeout=0.5)
+
+
+class Upstream:
+    """Opened streams yield `tokens`, the first `failures` of them fail after `fail_after` tokens"""
+
+    def __init__(self, tokens: List[str], failures: int = 0, fail_after: int = 0):
+        self.tokens = tokens
+        self.failures = failures
+        self.fail_after = fail_after
+        self.opened = []
+
+    async def open(self, partial: str, max_tokens: Optional[int]):
+        self.opened.append((partial, max_tokens))
+        failing = len(self.opened) <= self.failures
+        for index, token in enumerate(self.tokens if not partial else self.tokens[self.fail_after:]):
+            if failing and index == self.fail_after:
+                raise StreamTimeout("upstream stalled")
+            yield token
+
+
+async def collect(upstream: Upstream, **kwargs) -> str:
+    stream = resilient_stream(upstream.open, lambda e: isinstance(e, StreamTimeout), "test", config=CONFIG, **kwargs)
+    async with aclosing(stream):
+        return "".join([token async for token in stream])
+
+
+async def test_failure_before_the_first_token_is_retried():
+    upstream = Upstream(["a", "b"], failures=2)
+    assert await collect(upstream) == "ab"
+    assert upstream.opened == [("", None)] * 3
+
+
+async def test_retries_are_bounded_by_the_budget():
+    upstream = Upstream(["a"], failures=5)
+    with pytest.raises(StreamTimeout):
+        await collect(upstream, budget=AttemptBudget(retries=1, deadline=float("inf")))
+    assert len(upstream.opened) == 2
+
+
+async def test_resume_continues_within_the_remaining_max_tokens():
+    upstream = Upstream(["a" * 40, "b" * 40, "c"], failures=1, fail_after=2)
+    assert await collect(upstream, max_tokens=100) == "a" * 40 + "b" * 40 + "c"
+    assert upstream.opened == [("", 100), ("a" * 40 + "b" * 40, 80)]
+
+
+async def test_stream_out_of_max_tokens_is_not_resumed():
+    upstream = Upstream(["a" * 40, "b"], failures=1, fail_after=1)
+    with pytest.raises(StreamTimeout):
+        await collect(upstream, max_tokens=10)
+    assert len(upstream.opened) == 1
+
+
+def test_reserved_retries_are_only_taken_by_the_router():
+    budget = AttemptBudget(retries=2, deadline=float("inf"), reserved=1)
+    assert budget.take()
+    assert not budget.take()
+    assert budget.take(reserved=True)
+    assert not budget.take(reserved=True)
+
+
+async def test_router_and_backends_share_the_retries(monkeypatch):
+    monkeypatch.setattr(settings, "llm_resilience_config", CONFIG)
+
+    class Failing:
+        def __init__(self):
+            self.upstream = Upstream(["a"], failures=100)
+
+        def generate_stream(self, messages, attempt_budget=None, **kwargs):
+            return resilient_stream(
+                self.upstream.open, lambda e: True, "test", budget=attempt_budget, config=CONFIG
+            )
+
+    first, second = Failing(), Failing()
+    router = LLMRouter(
+        [LLMBackend("first", first), LLMBackend("second", second)],
+        LLMRouterConfig(explore_ratio=0, hedge_enabled=False)
+    )
+    with pytest.raises(StreamTimeout):
+        async with aclosing(router.generate_stream([UserMessage(content="x")])) as stream:
+            await stream.__anext__()
+    # one retry on the first backend, the other one is kept for the second backend
+    assert len(first.upstream.opened) == 2
+    assert len(second.upstream.opened) == 1
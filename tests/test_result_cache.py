@@ -0,0 +1,46 @@
+import pytest
+
+from app.depends import llm
+from app.models.completion import RephraseRequest
+from app.models.config import LLMBackendConfig, RewriteCacheConfig
+from app.services.rewrite.actions.concise_action import ConciseAction
+from app.services.rewrite.result_cache import RewriteResultCache
+from app.settings import settings, LLMProvider
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    def configure(*models):
+        monkeypatch.setattr(settings, "llm_backends", [
+            LLMBackendConfig(provider=LLMProvider.OPENAI, api_key="key", model=model) for model in models
+        ])
+        llm.get_llm_models_version.cache_clear()
+    yield configure
+    llm.get_llm_models_version.cache_clear()
+
+
+def key(**request) -> str:
+    cache = RewriteResultCache(cache=None, config=RewriteCacheConfig(task_types=["concise"]))
+    request = RephraseRequest(**{"text": "Some text.", "completion_task_type": "concise", "uid": "user"} | request)
+    return cache.get_key(request, ConciseAction(llm_service=None))
+
+
+def test_key_depends_on_every_model_the_router_may_use(backends):
+    backends("model-a", "model-b")
+    both = key()
+    backends("model-b", "model-a", "model-a")
+    assert key() == both
+    backends("model-a")
+    assert key() != both
+
+
+def test_key_ignores_the_default_model_when_backends_are_configured(backends, monkeypatch):
+    backends("model-a", "model-b")
+    before = key()
+    monkeypatch.setattr(settings, "llm_model", "another-model")
+    assert key() == before
+
+
+def test_requests_with_prev_rewrites_are_not_cached(backends):
+    backends("model-a")
+    assert key(prev_rewrites=["Earlier rewrite."]) is None
@@ -0,0 +1,92 @@
+import asyncio
+from typing import List
+
+import pytest
+
+from app.models.config import LLMRouterConfig
+from app.models.message import UserMessage
+from app.services.llm.llm_service import CompletionTruncated, LLMServiceBase
+from app.services.llm.router import LLMBackend, LLMRouter
+
+pytestmark = pytest.mark.anyio
+
+MESSAGES = [UserMessage(content="x" * 400)]
+
+
+class Service(LLMServiceBase):
+    """Streams its name, taking `ttfts[i]` seconds to the first token of its i-th call (the last one afterwards)"""
+
+    def __init__(self, name: str, ttfts: List[float], fail: bool = False):
+        self.name = name
+        self.ttfts = ttfts
+        self.fail = fail
+        self.calls = 0
+
+    async def generate_stream(self, messages, **kwargs):
+        ttft = self.ttfts[min(self.calls, len(self.ttfts) - 1)]
+        self.calls += 1
+        await asyncio.sleep(ttft)
+        if self.fail:
+            raise RuntimeError(f"{self.name} failed")
+        yield self.name
+        yield f"#{self.calls}"
+
+    async def generate(self, messages, **kwargs):
+        return self.name
+
+
+def router(*services: Service, **config) -> LLMRouter:
+    config = LLMRouterConfig(**{"explore_ratio": 0, "hedge_delay": 0.05, "hedge_budget_burst": 10_000} | config)
+    router = LLMRouter([LLMBackend(service.name, service) for service in services], config)
+    router._hedge_budget = config.hedge_budget_burst
+    return router
+
+
+async def stream(router: LLMRouter) -> str:
+    return "".join([token async for token in router.generate_stream(MESSAGES)])
+
+
+async def test_late_stream_is_hedged_on_the_next_backend():
+    slow, fast = Service("slow", [1]), Service("fast", [0.01])
+    assert await stream(router(slow, fast)) == "fast#1"
+    assert slow.calls == fast.calls == 1
+
+
+async def test_single_backend_is_hedged_with_a_second_request():
+    only = Service("only", [1, 0.01])
+    assert await stream(router(only)) == "only#2"
+    assert only.calls == 2
+
+
+async def test_single_backend_is_not_hedged_when_disabled():
+    only = Service("only", [0.1, 0.01])
+    assert await stream(router(only, hedge_same_backend=False)) == "only#1"
+    assert only.calls == 1
+
+
+async def test_hedges_are_paid_from_the_budget():
+    only = Service("only", [0.1, 0.01])
+    hedged = router(only)
+    hedged._hedge_budget = 0
+    assert await stream(hedged) == "only#1"
+    assert only.calls == 1
+
+
+async def test_failed_call_is_retried_on_the_next_backend():
+    broken, healthy = Service("broken", [0], fail=True), Service("healthy", [0])
+    assert await stream(router(broken, healthy)) == "healthy#1"
+    with pytest.raises(RuntimeError):
+        await stream(router(Service("broken", [0], fail=True)))
+
+
+async def test_truncated_streams_dont_count_against_the_backend():
+    class Truncating(Service):
+        async def generate_stream(self, messages, **kwargs):
+            yield "part"
+            raise CompletionTruncated("out of max_tokens")
+
+    backend = Truncating("only", [0])
+    routed = router(backend)
+    with pytest.raises(CompletionTruncated):
+        await stream(routed)
+    assert routed.backends[0].error_rate == 0
@@ -0,0 +1,71 @@
+import asyncio
+from collections import Counter
+
+import pytest
+
+from app.models.config import LLMSchedulerConfig
+from app.services.rewrite.scheduler import LLMSlotScheduler, SchedulerLane
+
+pytestmark = pytest.mark.anyio
+
+
+def scheduler(**config) -> LLMSlotScheduler:
+    return LLMSlotScheduler(LLMSchedulerConfig(**{"throttled_delay": 0} | config))
+
+
+async def test_concurrency_is_bounded():
+    slots = scheduler(max_concurrency=2, premium_reserved_slots=0)
+    async with slots.slot(SchedulerLane.FREE):
+        async with slots.slot(SchedulerLane.FREE):
+            waiting = asyncio.create_task(slots._acquire(SchedulerLane.FREE))
+            await asyncio.sleep(0)
+            assert not waiting.done()
+            assert slots.in_use == 2
+        await waiting
+        assert slots.in_use == 2
+        slots._release(SchedulerLane.FREE)
+    assert slots.in_use == 0
+
+
+async def test_reserved_slots_are_premium_only():
+    slots = scheduler(max_concurrency=2, premium_reserved_slots=1)
+    async with slots.slot(SchedulerLane.FREE):
+        free = asyncio.create_task(slots._acquire(SchedulerLane.FREE))
+        await asyncio.sleep(0)
+        assert not free.done()
+        async with slots.slot(SchedulerLane.PREMIUM):
+            assert slots.in_use == 2
+        free.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await free
+    assert slots.in_use == 0
+
+
+async def test_freed_slots_are_shared_by_weight():
+    slots = scheduler(max_concurrency=1, premium_reserved_slots=0, premium_weight=3, free_weight=1)
+    order = []
+
+    async def request(lane: SchedulerLane):
+        async with slots.slot(lane):
+            order.append(lane)
+            await asyncio.sleep(0)
+
+    async with slots.slot(SchedulerLane.FREE):
+        tasks = [asyncio.create_task(request(lane)) for lane in [SchedulerLane.PREMIUM] * 6 + [SchedulerLane.FREE] * 6]
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+
+    assert Counter(order[:8]) == {SchedulerLane.PREMIUM: 6, SchedulerLane.FREE: 2}
+
+
+async def test_cancelled_waiter_leaves_the_queue():
+    slots = scheduler(max_concurrency=1, premium_reserved_slots=0)
+    async with slots.slot(SchedulerLane.FREE):
+        waiting = asyncio.create_task(slots._acquire(SchedulerLane.FREE))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+    assert slots.in_use == 0
+    async with slots.slot(SchedulerLane.FREE):
+        assert slots.in_use == 1
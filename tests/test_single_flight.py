@@ -0,0 +1,96 @@
+import asyncio
+from contextlib import aclosing
+
+import pytest
+
+from app.services.rewrite.single_flight import FlightCancelled, SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+class Source:
+    """Upstream stream yielding one item per release, counting how often it was started"""
+
+    def __init__(self, items):
+        self.items = items
+        self.started = 0
+        self._released = asyncio.Semaphore(0)
+
+    def release(self, count: int = 1):
+        for _ in range(count):
+            self._released.release()
+
+    async def stream(self):
+        self.started += 1
+        for item in self.items:
+            await self._released.acquire()
+            yield item
+
+
+async def collect(stream):
+    async with aclosing(stream):
+        return [item async for item in stream]
+
+
+async def test_followers_share_the_upstream_stream():
+    flight, source = SingleFlight(), Source(["a", "b", "c"])
+    leader = asyncio.create_task(collect(flight.stream("key", source.stream)))
+    follower = asyncio.create_task(collect(flight.stream("key", source.stream)))
+    await asyncio.sleep(0)
+    source.release(3)
+
+    assert await leader == ["a", "b", "c"]
+    assert await follower == ["a", "b", "c"]
+    assert source.started == 1
+
+
+async def test_late_joiner_receives_the_buffered_prefix():
+    flight, source = SingleFlight(), Source(["a", "b"])
+    source.release()
+    leader = flight.stream("key", source.stream)
+    assert await leader.__anext__() == "a"
+
+    late = flight.stream("key", source.stream)
+    source.release()
+    assert await collect(late) == ["a", "b"]
+    assert await collect(leader) == ["b"]
+    assert source.started == 1
+
+
+async def test_errors_are_raised_to_every_subscriber():
+    async def failing():
+        yield "a"
+        raise ValueError("upstream failed")
+
+    flight = SingleFlight()
+    streams = [flight.stream("key", failing), flight.stream("key", failing)]
+    for stream in streams:
+        with pytest.raises(ValueError):
+            await collect(stream)
+
+
+async def test_flight_is_removed_once_done():
+    flight, source = SingleFlight(), Source(["a"])
+    source.release(2)
+    await collect(flight.stream("key", source.stream))
+    await asyncio.sleep(0)
+
+    await collect(flight.stream("key", source.stream))
+    assert source.started == 2
+
+
+async def test_cancelled_flight_is_not_joined():
+    flight, source = SingleFlight(), Source(["a", "b"])
+    source.release()
+    leader = flight.stream("key", source.stream)
+    assert await leader.__anext__() == "a"
+    # joined before the leader leaves, but not iterated yet
+    joiner = flight.stream("key", source.stream)
+    await leader.aclose()
+
+    with pytest.raises(FlightCancelled):
+        await collect(joiner)
+    # a request arriving while the cancellation is in progress starts its own flight
+    source.release(2)
+    assert await collect(flight.stream("key", source.stream)) == ["a", "b"]
+    assert source.started == 2
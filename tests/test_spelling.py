@@ -0,0 +1,88 @@
+import pytest
+
+from app.services.spelling.corrector import SpellingCorrector
+from app.services.spelling.symspell import SymSpell, edit_distance
+
+DICTIONARY = [
+    ("the", 23_000_000_000), ("can", 1_200_000_000), ("what", 800_000_000), ("receive", 88_000_000),
+    ("relieve", 3_000_000), ("cant", 8_000_000), ("wat", 3_000_000), ("form", 200_000_000),
+    ("from", 2_300_000_000), ("apple", 50_000_000), ("able", 110_000_000), ("spelling", 7_000_000),
+    ("quixotic", 150_000), ("sync", 6_783_321), ("subbase", 60_806), ("kerensky", 40_000), ("catgut", 15_133),
+    ("i", 3_086_225_277), ("a", 9_081_174_698), ("tuesday", 69_843_013),
+]
+
+
+@pytest.fixture
+def symspell() -> SymSpell:
+    symspell = SymSpell(max_edit_distance=2)
+    symspell.load(DICTIONARY)
+    return symspell
+
+
+@pytest.fixture
+def corrector(symspell) -> SpellingCorrector:
+    corrector = SpellingCorrector()
+    corrector._symspell = symspell
+    corrector._capitalized = {"i", "tuesday"}
+    return corrector
+
+
+@pytest.mark.parametrize("a, b, distance", [
+    ("teh", "the", 1),          # transposition
+    ("speling", "spelling", 1),
+    ("recieve", "receive", 1),
+    ("abc", "abc", 0),
+    ("kitten", "sitting", 3),   # over the limit
+])
+def test_edit_distance(a, b, distance):
+    assert edit_distance(a, b, max_distance=2) == min(distance, 3)
+
+
+def test_lookup_returns_the_closest_most_frequent_words(symspell):
+    assert [s.term for s in symspell.lookup("recieve")] == ["receive", "relieve"]
+    assert [s.term for s in symspell.lookup("teh")][:1] == ["the"]
+    assert symspell.lookup("the")[0].distance == 0
+
+
+def test_lookup_can_skip_the_term(symspell):
+    assert [s.term for s in symspell.lookup("cant", max_distance=1, skip_term=True)] == ["can"]
+
+
+def test_index_holds_every_delete(symspell):
+    assert len(symspell._hashes) == len(symspell._word_ids) == len(symspell._delete_levels)
+    assert (symspell._hashes[:-1] <= symspell._hashes[1:]).all()
+
+
+@pytest.mark.parametrize("word, expected", [
+    ("recieve", ("receive", True)),
+    ("speling", ("spelling", True)),
+    ("from", ("from", True)),
+    ("form", ("form", True)),           # frequent enough next to "from"
+    ("cant", ("cant", False)),          # much rarer than "can"
+    ("wat", ("wat", False)),            # much rarer than "what"
+    ("quixotic", ("quixotic", False)),  # under min_word_count
+    ("aple", ("able", False)),          # "apple" is a close rival
+])
+def test_best_correction(corrector, word, expected):
+    assert corrector._best_correction(word) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("recieve", "receive"),
+    ("speling!", "spelling!"),
+    ("i", "I"),
+    ("tuesday", "Tuesday"),
+    ("tuesdy", "Tuesday"),
+    # left to the LLM
+    ("Supabase", None),
+    ("supabase", None),     # distance 2
+    ("Zelensky", None),
+    ("ChatGPT", None),
+    ("chatgpt", None),
+    ("async", None),        # a typo wouldn't drop the first letter
+    ("thx", None),          # too short to tell from an abbreviation
+    ("h3llo", None),
+    ("Recieve", None),
+])
+def test_correct(corrector, text, expected):
+    assert corrector.correct(text, "en_US") == expected
@@ -0,0 +1,202 @@
+import asyncio
+import time
+
+import fakeredis
+import pytest
+
+from app.models.config import UsageWriteBehindConfig
+from app.services.cache.redis_cache import RedisCacheService
+from app.services.usage.free_tier_usage.write_behind import UsageWriteBehindQueue
+from app.utils.singleton import Singleton
+
+pytestmark = pytest.mark.anyio
+
+# fails scripts touching a key they weren't given in KEYS, as Redis Cluster would.
+# fakeredis shares the redis table between scripts, the original call is kept aside for the next ones
+STRICT_KEYS = """
+redis.original_call = redis.original_call or redis.call
+local call = redis.original_call
+local declared = {}
+for _, key in ipairs(KEYS) do
+    declared[tostring(key)] = true
+end
+redis.call = function(command, key, ...)
+    if not declared[tostring(key)] then
+        error('undeclared key ' .. tostring(key))
+    end
+    return call(command, key, ...)
+end
+"""
+
+
+class Database:
+    def __init__(self):
+        self.usage = {}
+        self.applied = set()
+
+    async def flush(self, batch_id, deltas):
+        if batch_id not in self.applied:
+            self.applied.add(batch_id)
+            for user_id, delta in deltas.items():
+                self.usage[user_id] = self.usage.get(user_id, 0) + delta
+        return {user_id: (f"usage:{user_id}", self.usage[user_id], 60) for user_id in deltas}
+
+
+@pytest.fixture(autouse=True)
+def fresh_queue(monkeypatch):
+    # every test builds its queue with its own config
+    monkeypatch.delitem(Singleton._instances, UsageWriteBehindQueue, raising=False)
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    for name in ["_submit_script", "_take_batch_script", "_complete_batch_script"]:
+        monkeypatch.setattr(UsageWriteBehindQueue, name, STRICT_KEYS + getattr(UsageWriteBehindQueue, name))
+    cache = RedisCacheService()
+    monkeypatch.setattr(cache, "redis", fakeredis.aioredis.FakeRedis())
+    return cache
+
+
+@pytest.fixture
+def queue(cache):
+    queue = UsageWriteBehindQueue(UsageWriteBehindConfig(max_batch_size=2, stale_batch_timeout=60))
+    queue._cache = cache
+    return queue
+
+
+async def submit(queue, user_id, delta):
+    return await queue.submit(user_id, delta, f"usage:{user_id}", period_ttl=3600)
+
+
+async def test_submitted_deltas_are_counted_and_merged(queue, cache):
+    assert await submit(queue, "a", 2) == 2
+    assert await submit(queue, "a", 3) == 5
+    assert await cache.redis.hgetall(queue._pending_key) == {b"a": b"5"}
+    assert not queue._flush_requested.is_set()
+    await submit(queue, "b", 1)
+    assert queue._flush_requested.is_set()
+
+
+async def test_counters_without_a_period_expire(queue, cache):
+    database = Database()
+    queue._flush = database.flush
+    await cache.redis.set("usage:b", 1, ex=60)
+    await submit(queue, "a", 2)
+    await submit(queue, "b", 1)
+    assert 0 < await cache.redis.ttl("usage:a") <= 3600
+    assert 0 < await cache.redis.ttl("usage:b") <= 60
+
+    # the database agrees with the counters, they still take the period's expiry
+    database.usage = {"a": 0, "b": 1}
+    assert await queue.flush()
+    assert await cache.redis.get("usage:a") == b"2"
+    assert 0 < await cache.redis.ttl("usage:a") <= 60
+    assert 0 < await cache.redis.ttl("usage:b") <= 60
+
+
+async def test_flush_writes_pending_deltas_once(queue, cache):
+    database = Database()
+    queue._flush = database.flush
+    for user_id, delta in [("a", 2), ("b", 1), ("c", 4), ("a", 1)]:
+        await submit(queue, user_id, delta)
+
+    assert await queue.flush()
+    assert database.usage == {"a": 3, "b": 1, "c": 4}
+    assert len(database.applied) == 2   # split by max_batch_size
+    assert await cache.redis.keys("users:usage:*") == []
+
+
+async def test_stale_batches_are_retried_and_applied_once(queue, cache):
+    database = Database()
+    queue._flush = database.flush
+    await submit(queue, "a", 2)
+    batch_id = await queue._take_batch()
+    # written by a worker that crashed before completing it
+    await database.flush(f"{batch_id}:0", {"a": 2})
+    await cache.redis.hset(queue._batches_key, batch_id, time.time() - 120)
+
+    assert await queue.flush()
+    assert database.usage == {"a": 2}
+    assert await cache.redis.keys("users:usage:*") == []
+
+
+async def test_counters_are_corrected_unless_deltas_are_pending(queue, cache):
+    database = Database()
+    queue._flush = database.flush
+    await submit(queue, "a", 2)
+    await submit(queue, "b", 1)
+    batch_id = await queue._take_batch()
+    await cache.redis.set("usage:a", 7)
+    # taken by another worker, not written yet
+    await submit(queue, "b", 1)
+    other_id = await queue._take_batch()
+
+    assert await queue._write_batch(batch_id)
+    assert await cache.redis.get("usage:a") == b"2"
+    assert await cache.redis.get("usage:b") == b"2"
+    assert await cache.redis.hkeys(queue._batches_key) == [other_id.encode()]
+
+
+async def test_batches_taken_while_completing_are_listed_again(queue, cache, monkeypatch):
+    database = Database()
+    queue._flush = database.flush
+    await submit(queue, "a", 2)
+    batch_id = await queue._take_batch()
+    await database.flush(f"{batch_id}:0", {"a": 2})
+    listed = []
+    hgetall = cache.hgetall
+
+    async def take_another_batch(key):
+        batches = await hgetall(key)
+        if not listed:
+            # taken between listing the batches and running the script
+            await submit(queue, "a", 1)
+            listed.append(await queue._take_batch())
+        return batches
+
+    monkeypatch.setattr(cache, "hgetall", take_another_batch)
+    assert await queue._complete_batch(batch_id, {"a": ("usage:a", 2, 60)}) == []
+    # "a" still has a delta in the other batch, its counter is left alone
+    assert await cache.redis.get("usage:a") == b"3"
+
+
+async def test_stop_drains_deltas_submitted_during_a_flush(queue, cache):
+    database = Database()
+    flushing = asyncio.Event()
+
+    async def slow_flush(batch_id, deltas):
+        flushing.set()
+        await asyncio.sleep(0.05)
+        return await database.flush(batch_id, deltas)
+
+    await queue.start(cache, slow_flush)
+    await submit(queue, "a", 1)
+    queue._flush_requested.set()
+    await flushing.wait()
+    await submit(queue, "b", 2)
+    await queue.stop()
+
+    assert database.usage == {"a": 1, "b": 2}
+    assert await cache.redis.keys("users:usage:*") == []
+
+
+async def test_failed_flushes_are_retried_after_a_backoff(cache, monkeypatch):
+    queue = UsageWriteBehindQueue(UsageWriteBehindConfig(flush_interval=0.01, max_backoff=0.02))
+    database = Database()
+    hgetall, failures = cache.hgetall, []
+
+    async def unreliable_hgetall(key):
+        if len(failures) < 2:
+            failures.append(key)
+            raise ConnectionError("redis down")
+        return await hgetall(key)
+
+    monkeypatch.setattr(cache, "hgetall", unreliable_hgetall)
+    await queue.start(cache, database.flush)
+    await submit(queue, "a", 1)
+    await asyncio.sleep(0.2)
+    assert queue.is_running
+    await queue.stop()
+
+    assert len(failures) == 2
+    assert database.usage == {"a": 1}